@@ -1,8 +1,14 @@
 import streamlit as st
 from utils import save_the_api_key
 from helper_texts import homepage_helpers
+from instrumentation import render_performance_panel
+from profiling import start_rerun_profile, finish_rerun_profile
+from prefetch import start_cache_warmer
+import api_server  # noqa: F401 (serves the JSON API if API_SERVER_PORT is set)
 
 st.set_page_config(page_title="COVID-19 Analysis Hub", page_icon="🦠", layout="wide")
+start_rerun_profile(__file__)
+start_cache_warmer()
 
 # Add custom CSS to style the page link
 st.markdown(
@@ -91,3 +97,6 @@ if st.session_state.show_tech_info:
 
 if st.session_state.show_errors_button:
     st.write(homepage_helpers["errors_text"])
+
+render_performance_panel()
+finish_rerun_profile()
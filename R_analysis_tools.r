@@ -29,6 +29,11 @@ fetch_covidcast_data <- function(
   return(response)
 }
 
+fetch_covidcast_metadata <- function() {
+  metadata <- pub_covidcast_meta()
+  return(metadata)
+}
+
 calculate_correlation <- function(df, value1_name, value2_name, cor_by="geo_value", lag=0, method="pearson") {
   df <- as_epi_df(df)
   cor_value <- epi_cor(df,
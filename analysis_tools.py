@@ -1,10 +1,38 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import timedelta
 import pandas as pd
 from rpy2.robjects import r
 from rpy2.robjects import pandas2ri
 from rpy2.robjects import conversion, default_converter
-from rpy2.robjects import NULL
+from rpy2.robjects import NULL, StrVector
 from datetime import date
-import streamlit as st
+from instrumentation import span, timed
+from data_cache import SignalKey, signal_cache, LATEST_DATA_TTL_S
+from single_flight import SingleFlight
+from fetch_scheduler import fetch_scheduler, INTERACTIVE, PREFETCH
+from profiling import profiled
+from correlation_engine import align_signals
+from utils import (
+    covidcast_metadata,
+    r_lock,
+    epirange_to_dates,
+    load_data,
+    to_epidate_range,
+    to_epiweek_range,
+)
+from signal_store import signal_store, partition_key
+from arrow_plane import arrow_plane
+from geo_aggregation import (
+    DERIVABLE_GEO_TYPES,
+    aggregate_counties,
+    compare_aggregates,
+    estimate_population,
+    is_count_signal,
+    load_population,
+)
 
 
 class NoCovidcastDataError(Exception):
@@ -13,46 +41,421 @@ class NoCovidcastDataError(Exception):
     pass
 
 
+# Identical requests made concurrently by different sessions are coalesced,
+# so that e.g. several users opening the same view trigger a single fetch
+fetch_flight = SingleFlight("fetch")
+
+# Single-region requests for these geo_types fetch all regions at once (see signal_store)
+BULK_GEO_TYPES = {
+    geo_type.strip()
+    for geo_type in os.environ.get("BULK_FETCH_GEO_TYPES", "hrr,msa").split(",")
+    if geo_type.strip()
+}
+
+# These geo_types are computed from the county data of a signal (see geo_aggregation)
+DERIVED_GEO_TYPES = {
+    geo_type.strip()
+    for geo_type in os.environ.get("DERIVED_GEO_TYPES", "").split(",")
+    if geo_type.strip() in DERIVABLE_GEO_TYPES
+}
+
+# County populations for aggregating proportions: a CSV file (fips, population), or
+# estimated from JHU's cumulative cases as counts and per 100,000 people
+COUNTY_POPULATION_FILE = os.environ.get("COUNTY_POPULATION_FILE")
+POPULATION_SIGNALS = (
+    ("jhu-csse", "confirmed_cumulative_num"),
+    ("jhu-csse", "confirmed_cumulative_prop"),
+)
+POPULATION_DATE = 20220101
+
+# Signals are read from {source}_{signal}.csv files in this directory (e.g. written
+# with DataFrame.to_csv from fetched data) instead of the API, e.g. to run the app
+# or api_server locally without network access
+OFFLINE_DATA_DIR = os.environ.get("OFFLINE_DATA_DIR")
+
+# compare_forecasters fits each forecaster (on the latest and the as-of data) in
+# its own process with its own R session
+FORECAST_WORKERS = int(os.environ.get("FORECAST_WORKERS", 6))
+_forecast_executor = None
+_forecast_executor_lock = threading.Lock()
+
+# Long date ranges are fetched in chunks of this many days by iter_covidcast_data_chunks;
+# the chunks' R calls take turns (see utils.r_lock)
+FETCH_CHUNK_DAYS = int(os.environ.get("FETCH_CHUNK_DAYS", 365))
+_chunk_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("FETCH_CHUNK_WORKERS", 4)),
+    thread_name_prefix="fetch-chunk",
+)
+
+
+@timed()
 def fetch_covidcast_data(
+    geo_type,
+    geo_value,
+    source_and_signal,
+    init_date,
+    final_date,
+    time_type,
+    as_of=None,
+    priority=INTERACTIVE,
+    bulk=None,
+):
+    """
+    Fetch a signal through the process-wide cache shared by all sessions.
+
+    The returned frame shares its data with the cache and other sessions (see
+    data_cache): columns can be added or replaced, but writing into its data in
+    place raises a ValueError. Requests to the API are
+    queued in the fetch scheduler with the given `priority` (see fetch_scheduler).
+
+    geo_value="*" fetches all geo_values of the geo_type in one request and keeps them
+    in the signal store. With `bulk` (by default for the geo_types in
+    BULK_FETCH_GEO_TYPES), a single-region request is answered by such a bulk fetch,
+    so that browsing further regions costs no additional requests.
+    """
+    source, signal = source_and_signal
+    key = SignalKey(
+        source, signal, geo_type, geo_value, time_type, init_date, final_date, as_of
+    )
+    if geo_type in DERIVED_GEO_TYPES and _has_county_data(source_and_signal, time_type):
+        df = signal_cache.get(key)
+        if df is None:
+            df = fetch_flight.do(key, lambda: _derive_from_counties(key, priority))
+        return df.copy(deep=False)
+    if geo_value == "*":
+        return _fetch_bulk(key, priority)
+
+    df = signal_cache.get(key)
+    if df is None:
+        df = _slice_from_wider_range(key, priority)
+    if df is None:
+        df = _slice_from_store(key)
+    if df is not None:
+        return df
+
+    if bulk is None:
+        bulk = geo_type in BULK_GEO_TYPES
+    if bulk:
+        fetch_covidcast_data(
+            geo_type,
+            "*",
+            source_and_signal,
+            init_date,
+            final_date,
+            time_type,
+            as_of=as_of,
+            priority=priority,
+        )
+        df = _slice_from_store(key)
+        # The bulk data may not fit into the store's memory budget
+        if df is not None:
+            return df
+
+    def load():
+        # Data as of a fixed date never changes; the latest revision may
+        ttl = None if as_of is not None else LATEST_DATA_TTL_S
+        # Another server process may have fetched it already (see arrow_plane)
+        df = arrow_plane.get_or_load(
+            key,
+            lambda: _schedule_fetch(
+                lambda: _fetch_covidcast_data_from_api(
+                    geo_type,
+                    geo_value,
+                    source_and_signal,
+                    init_date,
+                    final_date,
+                    time_type,
+                    as_of=as_of,
+                ),
+                priority=priority,
+                key=key,
+            ),
+            ttl=ttl,
+        )
+        signal_cache.put(key, df, ttl=ttl)
+        return df
+
+    # A user waiting for data that is being prefetched should not wait behind batch jobs
+    fetch_scheduler.promote(key, priority)
+    return fetch_flight.do(key, load).copy(deep=False)
+
+
+def _fetch_bulk(key, priority):
+    init, final = epirange_to_dates(key.init_date, key.final_date, key.time_type)
+    df = signal_store.select(partition_key(key), init, final)
+    if df is not None:
+        return df
+
+    def load():
+        ttl = None if key.as_of is not None else LATEST_DATA_TTL_S
+        # Written to the plane in the order of the signal store's partitions, so
+        # that the store can keep the memory-mapped frame as it is
+        df = arrow_plane.get_or_load(
+            key,
+            lambda: _schedule_fetch(
+                lambda: _fetch_covidcast_data_from_api(
+                    key.geo_type,
+                    "*",
+                    (key.source, key.signal),
+                    key.init_date,
+                    key.final_date,
+                    key.time_type,
+                    as_of=key.as_of,
+                ).sort_values(["geo_value", "time_value"], kind="stable", ignore_index=True),
+                priority=priority,
+                key=key,
+            ),
+            ttl=ttl,
+        )
+        signal_store.put(partition_key(key), df, init, final, ttl=ttl)
+        return df
+
+    fetch_scheduler.promote(key, priority)
+    return fetch_flight.do(key, load).copy(deep=False)
+
+
+def _has_county_data(source_and_signal, time_type):
+    source, signal = source_and_signal
+    return bool(
+        (
+            (covidcast_metadata["data_source"] == source)
+            & (covidcast_metadata["signal"] == signal)
+            & (covidcast_metadata["time_type"] == time_type)
+            & (covidcast_metadata["geo_type"] == "county")
+        ).any()
+    )
+
+
+def county_population(priority=INTERACTIVE):
+    """Population by county fips, from COUNTY_POPULATION_FILE or estimated from JHU data."""
+    if COUNTY_POPULATION_FILE:
+        return load_population(COUNTY_POPULATION_FILE)
+    num_df, prop_df = (
+        fetch_covidcast_data(
+            "county",
+            "*",
+            source_and_signal,
+            POPULATION_DATE,
+            POPULATION_DATE,
+            "day",
+            priority=priority,
+        )
+        for source_and_signal in POPULATION_SIGNALS
+    )
+    return estimate_population(num_df, prop_df)
+
+
+def _derive_from_counties(key, priority):
+    # One bulk fetch of the county data serves every region and coarser geo_type
+    county_df = fetch_covidcast_data(
+        "county",
+        "*",
+        (key.source, key.signal),
+        key.init_date,
+        key.final_date,
+        key.time_type,
+        as_of=key.as_of,
+        priority=priority,
+    )
+    population = None if is_count_signal(key.signal) else county_population(priority)
+    df = aggregate_counties(
+        county_df,
+        key.geo_type,
+        population=population,
+        geo_values=None if key.geo_value == "*" else [key.geo_value],
+    )
+    if df.empty:
+        raise _no_data_error(key)
+    signal_cache.put(
+        key, df, ttl=None if key.as_of is not None else LATEST_DATA_TTL_S
+    )
+    return df
+
+
+def compare_derived_with_api(
+    geo_type,
+    source_and_signal,
+    init_date,
+    final_date,
+    time_type,
+    as_of=None,
+    priority=INTERACTIVE,
+):
+    """
+    Compare a signal aggregated from its county data with the API's own aggregates.
+
+    Args:
+        geo_type: One of geo_aggregation.DERIVABLE_GEO_TYPES
+        source_and_signal: Tuple of (source, signal)
+        init_date, final_date, time_type, as_of, priority: As for fetch_covidcast_data
+
+    Returns:
+        tuple: (pd.DataFrame of the differences per region and date, dict summary),
+            see geo_aggregation.compare_aggregates
+    """
+    key = SignalKey(
+        *source_and_signal, geo_type, "*", time_type, init_date, final_date, as_of
+    )
+    derived_df = _derive_from_counties(key, priority)
+    api_df = _schedule_fetch(
+        lambda: _fetch_covidcast_data_from_api(
+            geo_type,
+            "*",
+            source_and_signal,
+            init_date,
+            final_date,
+            time_type,
+            as_of=as_of,
+        ),
+        priority=priority,
+        key=key,
+    )
+    return compare_aggregates(derived_df, api_df)
+
+
+def _slice_from_store(key):
+    """Answer a single-region request from a bulk fetch in the signal store, if any."""
+    init, final = epirange_to_dates(key.init_date, key.final_date, key.time_type)
+    df = signal_store.slice(partition_key(key), key.geo_value, init, final)
+    if df is not None and df.empty:
+        raise _no_data_error(key)
+    return df
+
+
+def is_data_cached(key):
+    """Whether a request for `key` would be answered without a new API request."""
+    if key.geo_value == "*":
+        init, final = epirange_to_dates(key.init_date, key.final_date, key.time_type)
+        return signal_store.covers(partition_key(key), init, final)
+    return signal_cache.peek(key) is not None
+
+
+def _covers(wider, key):
+    """Whether `wider` is a request for the same series over a date range containing `key`'s."""
+    if not isinstance(wider, SignalKey) or wider == key:
+        return False
+    if wider._replace(init_date=None, final_date=None) != key._replace(
+        init_date=None, final_date=None
+    ):
+        return False
+    wider_init, wider_final = epirange_to_dates(
+        wider.init_date, wider.final_date, wider.time_type
+    )
+    init, final = epirange_to_dates(key.init_date, key.final_date, key.time_type)
+    return wider_init <= init and final <= wider_final
+
+
+def _slice_from_wider_range(key, priority):
+    """
+    Answer a request from cached (or currently fetched) data of the same series over a
+    wider date range, e.g. the full range kept warm by the prefetcher. Returns None if
+    there is no such data.
+    """
+    wider_key, df = signal_cache.find(lambda other: _covers(other, key))
+    if df is None:
+        wider_key = fetch_flight.find(lambda other: _covers(other, key))
+        if wider_key is None:
+            return None
+        fetch_scheduler.promote(wider_key, priority)
+        try:
+            df = fetch_flight.wait(wider_key)
+        except Exception:
+            # Let the caller fetch its own range (and report its own error)
+            return None
+        df = df if df is not None else signal_cache.peek(wider_key)
+        if df is None:
+            return None
+
+    init, final = epirange_to_dates(key.init_date, key.final_date, key.time_type)
+    df = df[(df["time_value"] >= init) & (df["time_value"] <= final)]
+    if df.empty:
+        raise _no_data_error(key)
+    return df
+
+
+def _no_data_error(key):
+    return NoCovidcastDataError(
+        f"No data returned from pub_covidcast for:\n"
+        f" source: {key.source}\n"
+        f" signal: {key.signal}\n"
+        f" geo_type: {key.geo_type}\n"
+        f" geo_value: {key.geo_value}\n"
+        f" init_date: {key.init_date}\n"
+        f" final_date: {key.final_date}\n"
+        f" time_type: {key.time_type}\n"
+        f" as_of: {key.as_of}.\n"
+        "This is likely because the data for the requested signal at the given date "
+        "was available only much later. Try removing this signal or investigating a "
+        "later time period."
+    )
+
+
+def _schedule_fetch(fetch, priority, key):
+    # Files in OFFLINE_DATA_DIR do not count towards the API quota
+    if OFFLINE_DATA_DIR:
+        return fetch()
+    return fetch_scheduler.run(fetch, priority=priority, key=key)
+
+
+def _fetch_covidcast_data_from_api(
     geo_type, geo_value, source_and_signal, init_date, final_date, time_type, as_of=None
 ):
+    if OFFLINE_DATA_DIR:
+        return _read_offline_data(
+            geo_type,
+            geo_value,
+            source_and_signal,
+            init_date,
+            final_date,
+            time_type,
+            as_of=as_of,
+        )
+
     source, signal = source_and_signal
-    with conversion.localconverter(default_converter + pandas2ri.converter):
-        r.source("R_analysis_tools.r")
+    with r_lock, conversion.localconverter(default_converter):
+        with span("r.source"):
+            r.source("R_analysis_tools.r")
 
         r_as_of = NULL if as_of is None else as_of
 
         try:
-            df = r.fetch_covidcast_data(
-                geo_type=geo_type,
-                geo_value=geo_value,
-                source=source,
-                signal=signal,
-                init_date=init_date,
-                final_date=final_date,
-                time_type=time_type,
-                as_of=r_as_of,
-            )
+            # The R call is kept under the default converter so that the time spent
+            # in the network/R and in the pandas2ri conversion can be told apart
+            with span("r.fetch_covidcast_data"):
+                r_df = r.fetch_covidcast_data(
+                    geo_type=geo_type,
+                    geo_value=geo_value,
+                    source=source,
+                    signal=signal,
+                    init_date=init_date,
+                    final_date=final_date,
+                    time_type=time_type,
+                    as_of=r_as_of,
+                )
         except Exception as e:
             if "EmptyResponseError" in str(e):
-                raise NoCovidcastDataError(
-                    f"No data returned from pub_covidcast for:\n"
-                    f" source: {source}\n"
-                    f" signal: {signal}\n"
-                    f" geo_type: {geo_type}\n"
-                    f" geo_value: {geo_value}\n"
-                    f" init_date: {init_date}\n"
-                    f" final_date: {final_date}\n"
-                    f" time_type: {time_type}\n"
-                    f" as_of: {as_of}.\n"
-                    "This is likely because the data for the requested signal at the given date "
-                    "was available only much later. Try removing this signal or investigating a "
-                    "later time period."
+                raise _no_data_error(
+                    SignalKey(
+                        source,
+                        signal,
+                        geo_type,
+                        geo_value,
+                        time_type,
+                        init_date,
+                        final_date,
+                        as_of,
+                    )
                 )
             else:
                 # Handle other errors
                 raise e
 
+    with r_lock, conversion.localconverter(
+        default_converter + pandas2ri.converter
+    ) as cv:
+        with span("pandas2ri.rpy2py"):
+            df = cv.rpy2py(r_df)
+
     # Convert Unix timestamps to datetime
     try:
         df["time_value"] = pd.to_datetime(df["time_value"], unit="D").dt.date
@@ -63,8 +466,224 @@ def fetch_covidcast_data(
     return df
 
 
-def fetch_covidcast_data_multi(
+def _read_offline_data(
     geo_type, geo_value, source_and_signal, init_date, final_date, time_type, as_of=None
+):
+    key = SignalKey(
+        *source_and_signal, geo_type, geo_value, time_type, init_date, final_date, as_of
+    )
+    try:
+        with span("offline.read_csv"):
+            df = load_data(*source_and_signal, directory=OFFLINE_DATA_DIR)
+    except FileNotFoundError:
+        raise _no_data_error(key)
+
+    # Files may hold several geo_types and time_types, and need not label the signal
+    for column, value in [
+        ("source", source_and_signal[0]),
+        ("signal", source_and_signal[1]),
+        ("geo_type", geo_type),
+        ("time_type", time_type),
+    ]:
+        if column in df:
+            df = df[df[column] == value]
+        else:
+            df[column] = value
+    df["time_value"] = pd.to_datetime(df["time_value"]).dt.date
+    init, final = epirange_to_dates(init_date, final_date, time_type)
+    df = df[(df["time_value"] >= init) & (df["time_value"] <= final)]
+    if geo_value != "*":
+        df = df[df["geo_value"] == geo_value]
+    if as_of is not None and "issue" in df:
+        # The latest revision of each value published by that date
+        df = df.assign(issue=pd.to_datetime(df["issue"]).dt.date)
+        df = df[df["issue"] <= date.fromisoformat(as_of)]
+        df = df.sort_values("issue").drop_duplicates(
+            ["geo_value", "time_value"], keep="last"
+        )
+    if df.empty:
+        raise _no_data_error(key)
+    return df.sort_values(["geo_value", "time_value"], ignore_index=True)
+
+
+def split_date_range(init_date, final_date, time_type, chunk_days=FETCH_CHUNK_DAYS):
+    """
+    Split an epirange into consecutive epiranges covering at most `chunk_days` days
+    (whole epiweeks for weekly data).
+
+    Args:
+        init_date: First date (YYYYMMDD) or epiweek (YYYYWW) of the range
+        final_date: Last date or epiweek of the range
+        time_type: "day" or "week"
+        chunk_days: Maximum length of a chunk in days (0 disables chunking)
+
+    Returns:
+        list: (init_date, final_date) tuples in chronological order
+    """
+    if chunk_days <= 0:
+        return [(init_date, final_date)]
+    init, final = epirange_to_dates(init_date, final_date, time_type)
+    if time_type == "week":
+        chunk_days = max(7, chunk_days - chunk_days % 7)
+        to_epirange = to_epiweek_range
+    else:
+        to_epirange = to_epidate_range
+
+    chunks = []
+    start = init
+    while start <= final:
+        end = min(start + timedelta(days=chunk_days - 1), final)
+        chunks.append(to_epirange(start, end))
+        start = end + timedelta(days=1)
+    return chunks
+
+
+def iter_covidcast_data_chunks(
+    geo_type,
+    geo_value,
+    sources_and_signals,
+    init_date,
+    final_date,
+    time_type,
+    as_of=None,
+    priority=INTERACTIVE,
+):
+    """
+    Fetch one or more signals in date chunks in parallel, yielding each chunk as soon
+    as it arrives, so that callers can show the data progressively.
+
+    Ranges longer than FETCH_CHUNK_DAYS are split with split_date_range; each chunk
+    is fetched with fetch_covidcast_data (so it is cached, coalesced and scheduled
+    like any other request). Once all chunks of a signal have arrived, they are
+    cached as a whole under the full range. Chunks without data are skipped;
+    NoCovidcastDataError is only raised if a signal has no data at all.
+
+    Closing the generator early (e.g. when Streamlit interrupts the script) cancels
+    the chunks that have not started yet.
+
+    Args:
+        geo_type, geo_value, init_date, final_date, time_type, as_of, priority:
+            As for fetch_covidcast_data
+        sources_and_signals: List of (source, signal) tuples
+
+    Yields:
+        tuple: (source_and_signal, chunk DataFrame)
+    """
+    requests = []
+    for source_and_signal in sources_and_signals:
+        key = SignalKey(
+            *source_and_signal,
+            geo_type,
+            geo_value,
+            time_type,
+            init_date,
+            final_date,
+            as_of,
+        )
+        # Cached (or bulk-fetched) data is returned at once
+        if (
+            is_data_cached(key)
+            or geo_type in BULK_GEO_TYPES
+            or geo_type in DERIVED_GEO_TYPES
+            or geo_value == "*"
+        ):
+            chunks = [(init_date, final_date)]
+        else:
+            chunks = split_date_range(init_date, final_date, time_type)
+        requests.extend((source_and_signal, chunk) for chunk in chunks)
+
+    @profiled
+    def fetch_chunk(source_and_signal, chunk):
+        try:
+            return fetch_covidcast_data(
+                geo_type,
+                geo_value,
+                source_and_signal,
+                chunk[0],
+                chunk[1],
+                time_type,
+                as_of=as_of,
+                priority=priority,
+            )
+        except NoCovidcastDataError:
+            return None
+
+    futures = {
+        _chunk_executor.submit(fetch_chunk, source_and_signal, chunk): (
+            source_and_signal,
+            position,
+        )
+        for position, (source_and_signal, chunk) in enumerate(requests)
+    }
+    received = {source_and_signal: [] for source_and_signal in sources_and_signals}
+    try:
+        for future in as_completed(futures):
+            source_and_signal, position = futures[future]
+            df = future.result()
+            received[source_and_signal].append((position, df))
+            if df is not None:
+                yield source_and_signal, df
+    finally:
+        for future in futures:
+            future.cancel()
+
+    for source_and_signal, chunks in received.items():
+        key = SignalKey(
+            *source_and_signal,
+            geo_type,
+            geo_value,
+            time_type,
+            init_date,
+            final_date,
+            as_of,
+        )
+        # Epiweek ranges do not sort as integers, so restore the order of submission
+        frames = [df for _, df in sorted(chunks, key=lambda c: c[0]) if df is not None]
+        if not frames:
+            raise _no_data_error(key)
+        if len(chunks) > 1:
+            signal_cache.put(
+                key,
+                pd.concat(frames, ignore_index=True),
+                ttl=None if as_of is not None else LATEST_DATA_TTL_S,
+            )
+
+
+def fetch_covidcast_metadata():
+    """
+    Fetch the current COVIDcast metadata (one row per source/signal/time_type/geo_type).
+
+    min_time/max_time are converted to dates; last_update is a Unix timestamp.
+    """
+
+    def fetch():
+        with r_lock, conversion.localconverter(default_converter):
+            with span("r.source"):
+                r.source("R_analysis_tools.r")
+            with span("r.fetch_covidcast_metadata"):
+                r_df = r.fetch_covidcast_metadata()
+        with r_lock, conversion.localconverter(
+            default_converter + pandas2ri.converter
+        ) as cv:
+            with span("pandas2ri.rpy2py"):
+                return cv.rpy2py(r_df)
+
+    metadata = fetch_scheduler.run(fetch, priority=PREFETCH, key="covidcast_metadata")
+    for column in ["min_time", "max_time"]:
+        metadata[column] = pd.to_datetime(metadata[column], unit="D").dt.date
+    return metadata
+
+
+def fetch_covidcast_data_multi(
+    geo_type,
+    geo_value,
+    source_and_signal,
+    init_date,
+    final_date,
+    time_type,
+    as_of=None,
+    priority=INTERACTIVE,
+    bulk=None,
 ):
     dataframes = []
     for source_and_signal in source_and_signal:
@@ -76,12 +695,15 @@ def fetch_covidcast_data_multi(
             final_date,
             time_type,
             as_of=as_of,
+            priority=priority,
+            bulk=bulk,
         )
         dataframes.append(df)
 
     return merge_dataframes(*dataframes)
 
 
+@timed()
 def merge_dataframes(*dfs):
     """
     Merge multiple dataframes containing COVIDcast data.
@@ -131,130 +753,218 @@ def merge_dataframes(*dfs):
     return result[final_columns]
 
 
-def calculate_epi_correlation(df1, df2, cor_by="geo_value", lag=0, method="pearson"):
-    df = merge_dataframes(df1, df2)
-
-    # Extract column names based on source and signal from original dataframes
-    value1_name = f"value_{df1['source'].iloc[0]}_{df1['signal'].iloc[0]}"
-    value2_name = f"value_{df2['source'].iloc[0]}_{df2['signal'].iloc[0]}"
-
-    with conversion.localconverter(default_converter + pandas2ri.converter):
-        r.source("R_analysis_tools.r")
-
-        corr_df = r.calculate_correlation(
-            df,
-            value1_name=value1_name,
-            value2_name=value2_name,
-            cor_by=cor_by,
-            lag=lag,
-            method=method,
-        )
-
-    return corr_df
-
+def iter_lag_correlations(df1, df2, cor_by, lags, method):
+    """
+    Yield (lag, correlation) for each lag in `lags`, in the given order.
 
-def get_lags_and_correlations(
-    df1, df2, cor_by="geo_value", max_lag=14, method="pearson"
-):
-    # Merge once at the beginning
-    merged_df = merge_dataframes(df1, df2)
+    The signals are aligned and converted to R once; each lag is a separate R call,
+    so callers can report progress or stop between lags.
 
+    epi_cor shifts by rows, so the signals are aligned as in correlation_engine
+    (every time step between the first and last date, with missing values where a
+    signal has none): a shift by one row is then a shift by one time step, and the
+    correlations agree with those of the lag slider even when dates are missing.
+    """
     value1_name = f"value_{df1['source'].iloc[0]}_{df1['signal'].iloc[0]}"
     value2_name = f"value_{df2['source'].iloc[0]}_{df2['signal'].iloc[0]}"
 
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-
-    try:
-        status_text.text("Calculating correlations...")
-        # Calculate correlations with progress updates
-        lags_and_correlations = {}
-        total_lags = 2 * max_lag + 1
-
-        with conversion.localconverter(default_converter + pandas2ri.converter):
-            r_df = pandas2ri.py2rpy(merged_df)
-            r.source("R_analysis_tools.r")
+    # Align once at the beginning
+    _, times, values = align_signals({value1_name: df1, value2_name: df2})
+    merged_df = pd.DataFrame(
+        {
+            "geo_type": df1["geo_type"].iloc[0],
+            "geo_value": df1["geo_value"].iloc[0],
+            "time_type": df1["time_type"].iloc[0],
+            "time_value": times,
+            value1_name: values[:, 0],
+            value2_name: values[:, 1],
+        }
+    )
 
-            for i, lag in enumerate(range(-max_lag, max_lag + 1)):
+    with conversion.localconverter(default_converter + pandas2ri.converter):
+        with r_lock:
+            with span("pandas2ri.py2rpy"):
+                r_df = pandas2ri.py2rpy(merged_df)
+            with span("r.source"):
+                r.source("R_analysis_tools.r")
+
+        # Locked per lag, so that other sessions' R calls can run in between and
+        # the lock is not held while the caller handles a result
+        for lag in lags:
+            with r_lock, span("r.calculate_correlation"):
                 corr = r.calculate_correlation(
                     r_df, value1_name, value2_name, cor_by, lag, method
                 )
-                lags_and_correlations[lag] = corr.iloc[0]["cor"]
+            yield lag, corr.iloc[0]["cor"]
 
-                # Update progress
-                progress = (i + 1) / total_lags
-                progress_bar.progress(progress)
-                status_text.text(f"Calculating correlations... ({i + 1}/{total_lags})")
 
-        return lags_and_correlations
-    finally:
-        # Clean up progress indicators
-        progress_bar.empty()
-        status_text.empty()
+def run_epi_predict(
+    df, predictors, predicted, forecaster_type, prediction_length, on_progress=None
+):
+    """
+    Run the R forecaster without any Streamlit UI (e.g. in the job queue worker).
 
+    Args:
+        df: Merged signals, as returned by fetch_covidcast_data_multi
+        predictors: List of (source, signal) tuples used as predictors
+        predicted: (source, signal) tuple of the predicted signal
+        forecaster_type: Name of the epipredict forecaster
+        prediction_length: Number of days ahead to forecast
+        on_progress: Optional callable taking the fraction done and a step label
+            such as "(3/14)"
 
-def epi_predict(
-    df, predictors, predicted, forecaster_type, prediction_length, is_as_of=False
-):
+    Returns:
+        pd.DataFrame: One row per forecast, with target_date and forecast_date as dates
+    """
+    on_progress = on_progress or (lambda progress, step: None)
     predictor_col_names = [f"value_{source}_{signal}" for source, signal in predictors]
     source, signal = predicted
     predicted_col_names = f"value_{source}_{signal}"
 
-    # Initialize progress tracking
-    progress_bar = st.progress(0)
-    status_text = st.empty()
+    with conversion.localconverter(default_converter + pandas2ri.converter) as cv:
+        with r_lock:
+            with span("r.source"):
+                r.source("R_analysis_tools.r")
 
-    if not is_as_of:
-        status_text_as_of = "Step 1: Generating forecast using latest available data..."
-    else:
-        status_text_as_of = "Step 2: Generating forecast using data available at the time of prediction..."
+            # Convert the training data once instead of on every call below
+            with span("pandas2ri.py2rpy"):
+                r_df = cv.py2rpy(df)
+            r_predictor_col_names = StrVector(predictor_col_names)
 
-    try:
-        with conversion.localconverter(default_converter + pandas2ri.converter):
-            r.source("R_analysis_tools.r")
-
-            if forecaster_type == "cdc_baseline_forecaster":
-                status_text.text(status_text_as_of)
+        if forecaster_type == "cdc_baseline_forecaster":
+            on_progress(0.0, "")
+            with r_lock, span("r.epi_predict"):
                 forecast = r.epi_predict(
-                    df,
-                    predictor_col_names,
+                    r_df,
+                    r_predictor_col_names,
                     predicted_col_names,
                     forecaster_type,
                     prediction_length,
                 )
-                progress_bar.progress(1.0)
-            else:
-                forecasts = []
-                for ahead in range(1, prediction_length + 1):
-                    # Update progress
-                    progress = ahead / prediction_length
-                    progress_bar.progress(progress)
-                    status_text.text(
-                        f"{status_text_as_of} ({ahead}/{prediction_length})"
-                    )
+            on_progress(1.0, "")
+        else:
+            forecasts = []
+            for ahead in range(1, prediction_length + 1):
+                # Update progress
+                on_progress(ahead / prediction_length, f"({ahead}/{prediction_length})")
 
+                with r_lock, span("r.epi_predict"):
                     single_forecast = r.epi_predict(
-                        df,
-                        predictor_col_names,
+                        r_df,
+                        r_predictor_col_names,
                         predicted_col_names,
                         forecaster_type,
                         ahead,
                     )
-                    forecasts.append(single_forecast)
+                forecasts.append(single_forecast)
 
-                forecast = pd.concat(forecasts, ignore_index=True)
+            forecast = pd.concat(forecasts, ignore_index=True)
 
-            # Convert dates for both cases
-            forecast["target_date"] = forecast["target_date"].apply(
-                lambda x: date.fromordinal(x)
-            )
-            forecast["forecast_date"] = forecast["forecast_date"].apply(
-                lambda x: date.fromordinal(x)
+        # Convert dates for both cases
+        forecast["target_date"] = forecast["target_date"].apply(
+            lambda x: date.fromordinal(x)
+        )
+        forecast["forecast_date"] = forecast["forecast_date"].apply(
+            lambda x: date.fromordinal(x)
+        )
+
+    return forecast
+
+
+def _get_forecast_executor():
+    # Kept for the lifetime of the process, as starting R in the workers takes
+    # seconds; spawned, as forking a process with an R session is not safe
+    global _forecast_executor
+    with _forecast_executor_lock:
+        if _forecast_executor is None:
+            _forecast_executor = ProcessPoolExecutor(
+                max_workers=FORECAST_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
             )
+        return _forecast_executor
+
+
+@timed()
+def compare_forecasters(
+    df,
+    df_as_of,
+    predictors,
+    predicted,
+    forecaster_types,
+    prediction_length,
+    on_progress=None,
+):
+    """
+    Fit several forecasters on the latest and on the as-of data concurrently.
 
-        return forecast
+    Each (forecaster, data version) pair runs run_epi_predict in a worker process,
+    so a comparison takes about as long as the slowest single fit.
 
+    Args:
+        df: Merged signals (latest data), as returned by fetch_covidcast_data_multi
+        df_as_of: The same signals as available at the time of the prediction
+        predictors: List of (source, signal) tuples used as predictors
+        predicted: (source, signal) tuple of the predicted signal
+        forecaster_types: Names of the epipredict forecasters to compare
+        prediction_length: Number of days ahead to forecast
+        on_progress: Optional callable taking the fraction of fits done
+
+    Returns:
+        dict: forecaster_type -> (forecast on the latest data, forecast on the
+            as-of data), as returned by run_epi_predict
+    """
+    on_progress = on_progress or (lambda progress: None)
+    executor = _get_forecast_executor()
+    futures = {
+        executor.submit(
+            run_epi_predict,
+            data,
+            list(predictors),
+            predicted,
+            forecaster_type,
+            prediction_length,
+        ): (forecaster_type, is_as_of)
+        for forecaster_type in forecaster_types
+        for is_as_of, data in ((False, df), (True, df_as_of))
+    }
+    results = {}
+    try:
+        for done, future in enumerate(as_completed(futures), start=1):
+            results[futures[future]] = future.result()
+            on_progress(done / len(futures))
     finally:
-        # Clean up progress indicators
-        progress_bar.empty()
-        status_text.empty()
+        for future in futures:
+            future.cancel()
+    return {
+        forecaster_type: (results[forecaster_type, False], results[forecaster_type, True])
+        for forecaster_type in forecaster_types
+    }
+
+
+def score_forecast(df_forecast, df_actual):
+    """
+    Accuracy of a forecast against the values observed since.
+
+    Args:
+        df_forecast: Forecast as returned by run_epi_predict
+        df_actual: Observed values of the predicted signal (time_value, value)
+
+    Returns:
+        dict: Number of target dates with an observed value, mean absolute error,
+            root mean squared error and share of observed values within the 90%
+            prediction interval
+    """
+    scored = pd.merge(
+        df_forecast[["target_date", ".pred", ".pred_lower", ".pred_upper"]],
+        df_actual[["time_value", "value"]],
+        left_on="target_date",
+        right_on="time_value",
+    ).dropna(subset=["value"])
+    errors = scored[".pred"] - scored["value"]
+    inside = scored["value"].between(scored[".pred_lower"], scored[".pred_upper"])
+    return {
+        "n": len(scored),
+        "mae": errors.abs().mean(),
+        "rmse": (errors**2).mean() ** 0.5,
+        "coverage_90": inside.mean(),
+    }
@@ -0,0 +1,493 @@
+"""
+Headless JSON API for fetching signals, lag correlations and forecasts.
+
+Endpoints (POST with a JSON body, except for /health and /metrics):
+
+    POST /v1/fetch       {"signals": ["jhu-csse:confirmed_7dav_incidence_prop"],
+                          "geo_type": "state", "regions": ["ny", "ca"],
+                          "init_date": "2021-01-01", "final_date": "2021-06-30",
+                          "as_of": "2021-07-01"}
+    POST /v1/lag-sweep   {"pairs": [["jhu-csse:confirmed_7dav_incidence_prop",
+                                     "jhu-csse:deaths_7dav_incidence_prop"]],
+                          "geo_type": "state", "regions": ["ny", "ca"],
+                          "max_lag": 28, "method": "pearson"}
+    POST /v1/forecast    {"predictors": ["jhu-csse:confirmed_7dav_incidence_prop"],
+                          "predicted": "jhu-csse:deaths_7dav_incidence_prop",
+                          "geo_type": "state", "regions": ["ny", "ca"],
+                          "forecast_date": "2021-06-01", "prediction_length": 14,
+                          "forecasters": ["arx_forecaster", "flatline_forecaster"]}
+    GET  /health
+    GET  /metrics        Span timings in Prometheus text format
+
+A request is a batch: every signal (pair, or forecast) is computed for every
+region. The items run concurrently and are streamed back as newline-delimited JSON
+as soon as each one completes, in completion order; every line carries the "index"
+of its item in the batch, and failed items carry an "error" instead of a result.
+The dates, max_lag and forecasters are optional; by default the full date range
+shared by the signals is used, as in batch.py. "regions" may only be left out for
+geo_type "nation" (it then defaults to ["us"]). max_lag and prediction_length count
+time steps of the signals: days for daily signals, weeks for weekly ones.
+
+The handlers call the same pipeline nodes as the pages (see pipeline), so results
+are cached, coalesced and scheduled like the UI's: started within the Streamlit
+process with API_SERVER_PORT, the API shares its caches and worker pools; run on its
+own (`python api_server.py --port 8600`), it shares data with the app through
+SIGNAL_STORE_DIR, ARROW_PLANE_DIR and the job queue. Fetches are sent with BATCH
+priority, so they never delay users of the app. With OFFLINE_DATA_DIR, the API runs
+(and can be tried out) locally against CSV files instead of the COVIDcast API.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import tornado.ioloop
+import tornado.web
+from tornado.iostream import StreamClosedError
+
+from analysis_tools import NoCovidcastDataError, score_forecast
+from correlation_engine import best_lags
+from fetch_scheduler import BATCH
+from helper_texts import forecasters_info
+from instrumentation import register_metrics, span, to_prometheus_text
+from pipeline import (
+    fetch_signal,
+    fetch_signals,
+    forecaster_comparison,
+    lag_correlations,
+    shared_dates,
+)
+from utils import covidcast_metadata, to_epidate_range, to_epiweek_range
+
+API_SERVER_PORT = int(os.environ.get("API_SERVER_PORT", 0))
+API_SERVER_ADDRESS = os.environ.get("API_SERVER_ADDRESS", "127.0.0.1")
+API_SERVER_THREADS = int(os.environ.get("API_SERVER_THREADS", 8))
+# Upper bound on the number of items (signals x regions) of one request
+MAX_BATCH_ITEMS = int(os.environ.get("API_MAX_BATCH_ITEMS", 1000))
+
+_executor = ThreadPoolExecutor(
+    max_workers=API_SERVER_THREADS, thread_name_prefix="api-server"
+)
+_counts = {"requests": 0, "items": 0, "errors": 0, "disconnects": 0}
+_counts_lock = threading.Lock()
+
+
+def _count(name, n=1):
+    with _counts_lock:
+        _counts[name] += n
+
+
+register_metrics("api_server", lambda: dict(_counts))
+
+
+class BadRequest(tornado.web.HTTPError):
+    def __init__(self, message):
+        super().__init__(400, reason="Bad Request", log_message=message)
+
+
+def _jsonable(value):
+    """`value` with dates as ISO strings, numpy values as Python ones and NaN as None."""
+    if isinstance(value, dict):
+        return {key: _jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_jsonable(item) for item in value]
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return None if np.isnan(value) else float(value)
+    return value
+
+
+def _records(df):
+    """Rows of a DataFrame as dicts, with missing values as None."""
+    return df.astype(object).where(df.notna(), None).to_dict("records")
+
+
+def _signal(text):
+    source, _, signal = str(text).partition(":")
+    if not source or not signal:
+        raise BadRequest(f"Expected source:signal, got {text!r}")
+    return source, signal
+
+
+def _iso_date(body, name, default=None):
+    value = body.get(name)
+    if value is None:
+        return default
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise BadRequest(f"{name} must be a YYYY-MM-DD date, got {value!r}")
+
+
+def _list(body, name, default=None):
+    value = body.get(name, default)
+    if not isinstance(value, list) or not value:
+        raise BadRequest(f"{name} must be a non-empty list")
+    return value
+
+
+def _int(body, name, default, minimum=0):
+    value = body.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise BadRequest(f"{name} must be an integer, got {body.get(name)!r}")
+    if value < minimum:
+        raise BadRequest(f"{name} must be at least {minimum}")
+    return value
+
+
+def _regions(body, geo_type):
+    if "regions" not in body and geo_type != "nation":
+        raise BadRequest(f"regions is required for geo_type {geo_type!r}")
+    regions = _list(body, "regions", ["us"])
+    if not all(isinstance(region, str) for region in regions):
+        raise BadRequest("regions must be a list of strings")
+    return regions
+
+
+def _step(time_type):
+    return timedelta(days=7 if time_type == "week" else 1)
+
+
+def _epirange(init_date, final_date, time_type):
+    if time_type == "week":
+        return to_epiweek_range(init_date, final_date)
+    return to_epidate_range(init_date, final_date)
+
+
+def _date_range(body, geo_type, sources_and_signals):
+    """(init_date, final_date, time_type, epirange) of a request, as in batch.py."""
+    try:
+        shared_init_date, shared_final_date, time_type = shared_dates(
+            covidcast_metadata, geo_type, *sources_and_signals
+        )
+    except (KeyError, IndexError, ValueError) as e:
+        raise BadRequest(f"No shared date range for these signals: {str(e)}")
+    init_date = max(_iso_date(body, "init_date", shared_init_date), shared_init_date)
+    final_date = min(
+        _iso_date(body, "final_date", shared_final_date), shared_final_date
+    )
+    if init_date > final_date:
+        raise BadRequest("init_date is after final_date")
+    return init_date, final_date, time_type, _epirange(init_date, final_date, time_type)
+
+
+def fetch_item(geo_type, region, source_and_signal, epirange, time_type, as_of):
+    df = fetch_signal(
+        geo_type,
+        region,
+        source_and_signal,
+        epirange[0],
+        epirange[-1],
+        time_type,
+        as_of=as_of,
+        priority=BATCH,
+    )
+    return {"rows": _records(df)}
+
+
+def lag_sweep_item(geo_type, region, pair, epirange, time_type, max_lag, method):
+    df1, df2 = (
+        fetch_signal(
+            geo_type,
+            region,
+            source_and_signal,
+            epirange[0],
+            epirange[-1],
+            time_type,
+            priority=BATCH,
+        )
+        for source_and_signal in pair
+    )
+    # Same node and arguments as the correlation page, so results are shared
+    tensor = lag_correlations(
+        {"signal1": df1, "signal2": df2}, max_lag=max_lag, method=method
+    )
+    best = best_lags(tensor).iloc[0]
+    return {
+        "lags": tensor.lags,
+        "correlations": tensor.values[0],
+        "best_lag": best["best_lag"],
+        "best_correlation": best["correlation"],
+    }
+
+
+def forecast_item(
+    geo_type,
+    region,
+    predictors,
+    predicted,
+    forecasters,
+    epirange_train,
+    time_type,
+    forecast_date,
+    prediction_length,
+):
+    predictors_and_predicted = list(dict.fromkeys(predictors + [predicted]))
+    final_date = forecast_date + prediction_length * _step(time_type)
+    # As on the forecasting page: the latest data, and the data as it was available
+    # at the end of the forecast period
+    df_merged, df_merged_as_of = (
+        fetch_signals(
+            geo_type,
+            region,
+            predictors_and_predicted,
+            epirange_train[0],
+            epirange_train[-1],
+            time_type,
+            as_of=as_of,
+            priority=BATCH,
+        )
+        for as_of in (None, final_date.strftime("%Y-%m-%d"))
+    )
+    forecasts = forecaster_comparison(
+        df_merged,
+        df_merged_as_of,
+        predictors,
+        predicted,
+        forecasters,
+        prediction_length,
+    )
+    try:
+        epirange_predict = _epirange(forecast_date, final_date, time_type)
+        df_actual = fetch_signal(
+            geo_type,
+            region,
+            predicted,
+            epirange_predict[0],
+            epirange_predict[-1],
+            time_type,
+            priority=BATCH,
+        )
+    except NoCovidcastDataError:
+        df_actual = None
+    return {
+        "forecasts": {
+            forecaster_type: {
+                data_version: {
+                    "rows": _records(df),
+                    "scores": None
+                    if df_actual is None
+                    else score_forecast(df, df_actual),
+                }
+                for data_version, df in [
+                    ("latest", df_forecast),
+                    ("as_of", df_forecast_as_of),
+                ]
+            }
+            for forecaster_type, (df_forecast, df_forecast_as_of) in forecasts.items()
+        }
+    }
+
+
+def _run_item(index, labels, func, *args):
+    try:
+        with span("api_server.item"):
+            return {"index": index, **labels, **func(*args)}
+    except Exception as e:
+        _count("errors")
+        return {"index": index, **labels, "error": str(e)}
+
+
+class JsonHandler(tornado.web.RequestHandler):
+    def write_error(self, status_code, **kwargs):
+        exception = kwargs.get("exc_info", (None, None))[1]
+        message = getattr(exception, "log_message", None) or self._reason
+        self.finish({"error": message})
+
+    def body(self):
+        try:
+            body = json.loads(self.request.body or b"{}")
+        except ValueError as e:
+            raise BadRequest(f"Invalid JSON: {str(e)}")
+        if not isinstance(body, dict):
+            raise BadRequest("The body must be a JSON object")
+        return body
+
+
+class BatchHandler(JsonHandler):
+    """Runs the items of a batch request concurrently and streams them as NDJSON."""
+
+    def items(self, body):
+        """(labels, function, arguments) of each item of the request."""
+        raise NotImplementedError
+
+    async def post(self):
+        items = list(self.items(self.body()))
+        if len(items) > MAX_BATCH_ITEMS:
+            raise BadRequest(
+                f"{len(items)} items requested, at most {MAX_BATCH_ITEMS} allowed"
+            )
+        _count("requests")
+        _count("items", len(items))
+
+        self.set_header("Content-Type", "application/x-ndjson")
+        futures = [
+            asyncio.wrap_future(_executor.submit(_run_item, index, labels, func, *args))
+            for index, (labels, func, args) in enumerate(items)
+        ]
+        try:
+            for future in asyncio.as_completed(futures):
+                line = json.dumps(_jsonable(await future), allow_nan=False)
+                self.write(line + "\n")
+                await self.flush()
+        except StreamClosedError:
+            # The client went away; items that have not started are dropped
+            _count("disconnects")
+            for future in futures:
+                future.cancel()
+
+
+class FetchHandler(BatchHandler):
+    def items(self, body):
+        geo_type = body.get("geo_type", "nation")
+        regions = _regions(body, geo_type)
+        signals = [_signal(text) for text in _list(body, "signals")]
+        _, _, time_type, epirange = _date_range(body, geo_type, signals)
+        as_of = _iso_date(body, "as_of")
+        as_of = as_of.isoformat() if as_of else None
+        for source_and_signal in signals:
+            for region in regions:
+                labels = {"signal": ":".join(source_and_signal), "geo_value": region}
+                args = (geo_type, region, source_and_signal, epirange, time_type, as_of)
+                yield labels, fetch_item, args
+
+
+class LagSweepHandler(BatchHandler):
+    def items(self, body):
+        geo_type = body.get("geo_type", "nation")
+        regions = _regions(body, geo_type)
+        method = body.get("method", "pearson")
+        if method not in ("pearson", "kendall", "spearman"):
+            raise BadRequest(f"Unknown method: {method}")
+        for pair in _list(body, "pairs"):
+            if not isinstance(pair, list) or len(pair) != 2:
+                raise BadRequest("Each pair must be a list of two source:signal")
+            pair = [_signal(text) for text in pair]
+            init_date, final_date, time_type, epirange = _date_range(
+                body, geo_type, pair
+            )
+            # Same default as the correlation page: half of the date range
+            days = (final_date - init_date).days
+            max_lag = _int(
+                body,
+                "max_lag",
+                (days // 2) if time_type == "day" else (days // 7) // 2,
+            )
+            for region in regions:
+                labels = {
+                    "signal1": ":".join(pair[0]),
+                    "signal2": ":".join(pair[1]),
+                    "geo_value": region,
+                    "method": method,
+                }
+                args = (geo_type, region, pair, epirange, time_type, max_lag, method)
+                yield labels, lag_sweep_item, args
+
+
+class ForecastHandler(BatchHandler):
+    def items(self, body):
+        geo_type = body.get("geo_type", "nation")
+        regions = _regions(body, geo_type)
+        predictors = [_signal(text) for text in _list(body, "predictors")]
+        predicted = _signal(body.get("predicted"))
+        forecasters = _list(body, "forecasters", ["arx_forecaster"])
+        unknown = set(forecasters) - set(forecasters_info)
+        if unknown:
+            raise BadRequest(f"Unknown forecasters: {', '.join(sorted(unknown))}")
+        forecast_date = _iso_date(body, "forecast_date")
+        if forecast_date is None:
+            raise BadRequest("forecast_date is required")
+        prediction_length = _int(body, "prediction_length", 14, minimum=1)
+        shared_init_date, _, time_type, _ = _date_range(
+            {}, geo_type, list(dict.fromkeys(predictors + [predicted]))
+        )
+        epirange_train = _epirange(shared_init_date, forecast_date, time_type)
+        for region in regions:
+            labels = {"geo_value": region}
+            args = (
+                geo_type,
+                region,
+                predictors,
+                predicted,
+                forecasters,
+                epirange_train,
+                time_type,
+                forecast_date,
+                prediction_length,
+            )
+            yield labels, forecast_item, args
+
+
+class HealthHandler(JsonHandler):
+    def get(self):
+        self.finish({"status": "ok"})
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.finish(to_prometheus_text())
+
+
+def make_app():
+    return tornado.web.Application(
+        [
+            (r"/v1/fetch", FetchHandler),
+            (r"/v1/lag-sweep", LagSweepHandler),
+            (r"/v1/forecast", ForecastHandler),
+            (r"/health", HealthHandler),
+            (r"/metrics", MetricsHandler),
+        ]
+    )
+
+
+def serve(port, address=API_SERVER_ADDRESS):
+    """Run the API on the current thread until the process exits."""
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    make_app().listen(port, address=address)
+    print(f"API server listening on http://{address}:{port}")
+    tornado.ioloop.IOLoop.current().start()
+
+
+_started = False
+_started_lock = threading.Lock()
+
+
+def start_in_background(port, address=API_SERVER_ADDRESS):
+    """Serve the API from a thread of this process (e.g. the Streamlit server)."""
+    global _started
+    with _started_lock:
+        if _started:
+            return
+        _started = True
+    threading.Thread(
+        target=serve, args=(port, address), daemon=True, name="api-server"
+    ).start()
+
+
+if API_SERVER_PORT and __name__ != "__main__":
+    start_in_background(API_SERVER_PORT)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the JSON API on its own.")
+    parser.add_argument("--port", type=int, default=API_SERVER_PORT or 8600)
+    parser.add_argument("--address", default=API_SERVER_ADDRESS)
+    args = parser.parse_args(argv)
+    serve(args.port, args.address)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+Shared-memory data plane for several Streamlit server replicas on one host.
+
+With ARROW_PLANE_DIR set (ideally on a tmpfs such as /dev/shm), fetched signals
+and merged frames are written once as Arrow IPC files into that directory, and
+every replica (and any other process, e.g. R with arrow::read_ipc_file) reads
+them memory-mapped instead of fetching and holding its own copy. Numeric columns
+without missing values are handed to pandas without a copy; the pages of the
+file are shared by all processes through the OS page cache.
+
+Files are named after a digest of their key (a SignalKey, like the fetch cache,
+or a pipeline node key) and hold the key and expiry time in their schema metadata,
+so each file is complete in itself and is replaced atomically. A per-key fcntl lock
+lets one replica fetch a missing key while the others wait for its file. Files
+beyond ARROW_PLANE_MAX_BYTES are removed oldest first; processes still mapping a
+removed file keep their view of it.
+
+Without ARROW_PLANE_DIR the plane is disabled and loads go straight through.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+
+import pyarrow as pa
+
+from instrumentation import register_metrics, span
+
+METADATA_KEY = b"covid_hub"
+
+
+def _digest(key):
+    return hashlib.sha1(repr(tuple(key)).encode()).hexdigest()
+
+
+class ArrowPlane:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.write_errors = 0
+        self.lock_wait_s = 0.0
+        if directory:
+            os.makedirs(os.path.join(directory, "locks"), exist_ok=True)
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{_digest(key)}.arrow")
+
+    def get(self, key):
+        """The frame stored for `key` (memory-mapped), or None if missing or expired."""
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            with span("arrow_plane.read"):
+                source = pa.memory_map(path, "r")
+                reader = pa.ipc.open_file(source)
+                meta = json.loads(reader.schema.metadata[METADATA_KEY])
+                if meta["expires_at"] is not None and meta["expires_at"] < time.time():
+                    self._remove_if_same(path, source)
+                    df = None
+                else:
+                    df = reader.read_all().to_pandas(split_blocks=True)
+        except (OSError, KeyError, ValueError, pa.ArrowInvalid):
+            df = None
+        with self._lock:
+            if df is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return df
+
+    def _remove_if_same(self, path, source):
+        # Another replica may have replaced the expired file in the meantime
+        try:
+            if os.stat(path).st_ino == os.fstat(source.fileno()).st_ino:
+                os.remove(path)
+        except OSError:
+            pass
+
+    def put(self, key, df, ttl=None):
+        """Write `df` for `key`, replacing any previous file; `ttl` in seconds."""
+        if not self.enabled:
+            return
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        meta = {
+            "key": [str(part) for part in key],
+            "expires_at": None if not ttl else time.time() + ttl,
+        }
+        try:
+            with span("arrow_plane.write"):
+                table = pa.Table.from_pandas(df)
+                table = table.replace_schema_metadata(
+                    {**(table.schema.metadata or {}), METADATA_KEY: json.dumps(meta)}
+                )
+                with pa.OSFile(tmp_path, "wb") as sink:
+                    with pa.ipc.new_file(sink, table.schema) as writer:
+                        writer.write_table(table)
+                os.replace(tmp_path, path)
+        except (OSError, pa.ArrowException, TypeError, ValueError) as e:
+            # Frames Arrow cannot represent stay local to this process
+            print(f"Error: {str(e)}")
+            with self._lock:
+                self.write_errors += 1
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            return
+        with self._lock:
+            self.writes += 1
+        self._enforce_budget()
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """Exclusive lock on `key` across processes (and threads)."""
+        if not self.enabled:
+            yield
+            return
+        path = os.path.join(self.directory, "locks", f"{_digest(key)}.lock")
+        with open(path, "a") as f:
+            start = time.perf_counter()
+            fcntl.flock(f, fcntl.LOCK_EX)
+            with self._lock:
+                self.lock_wait_s += time.perf_counter() - start
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get_or_load(self, key, load, ttl=None):
+        """
+        Return the frame for `key` from the plane, or call `load()` and share its result.
+
+        Only one process loads a given key at a time; the others wait for it and
+        read its file. The loading process also returns the memory-mapped frame, so
+        that it does not keep a copy of its own.
+        """
+        df = self.get(key)
+        if df is not None:
+            return df
+        with self.lock(key):
+            df = self.get(key)
+            if df is None:
+                loaded = load()
+                self.put(key, loaded, ttl=ttl)
+                df = self.get(key) if self.enabled else None
+                if df is None:
+                    df = loaded
+        return df
+
+    def _files(self):
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(".arrow"):
+                    with contextlib.suppress(OSError):
+                        stat = entry.stat()
+                        files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files
+
+    def _enforce_budget(self):
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            total -= size
+
+    def stats(self):
+        files = self._files() if self.enabled else []
+        with self._lock:
+            return {
+                "enabled": int(self.enabled),
+                "files": len(files),
+                "bytes": sum(size for _, size, _ in files),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "writes": self.writes,
+                "write_errors": self.write_errors,
+                "lock_wait_s": round(self.lock_wait_s, 3),
+            }
+
+
+arrow_plane = ArrowPlane(
+    directory=os.environ.get("ARROW_PLANE_DIR") or None,
+    max_bytes=int(os.environ.get("ARROW_PLANE_MAX_BYTES", 4 * 1024**3)),
+)
+
+register_metrics("arrow_plane", arrow_plane.stats)
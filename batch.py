@@ -0,0 +1,415 @@
+"""
+Command-line batch runs of lag-correlation sweeps and forecasts, without the UI.
+
+Examples (from the repository root):
+
+    # Best time lag between cases and deaths for every state
+    python batch.py correlate \\
+        --pair jhu-csse:confirmed_7dav_incidence_prop jhu-csse:deaths_7dav_incidence_prop \\
+        --geo-type state --regions all --output reports/correlations.parquet
+
+    # 14-day ARX forecasts of deaths from cases for two states
+    python batch.py forecast \\
+        --predictors jhu-csse:confirmed_7dav_incidence_prop \\
+        --predicted jhu-csse:deaths_7dav_incidence_prop \\
+        --geo-type state --regions ny ca --forecast-date 2021-06-01 \\
+        --output reports/forecasts.parquet
+
+    # Differences between state series aggregated from county data and the API's
+    python batch.py check-aggregates \\
+        --signals jhu-csse:confirmed_7dav_incidence_prop --geo-types state msa \\
+        --output reports/aggregates.parquet
+
+Data is fetched in this process through the fetch scheduler with BATCH priority,
+so all tasks share one rate limit; for several regions, each signal is fetched
+once for all regions of the geo_type (see signal_store). The R computations are
+then fanned out over a pool of `--workers` processes (default: all cores), each
+with its own R session.
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, timedelta
+
+import pandas as pd
+
+from analysis_tools import (
+    NoCovidcastDataError,
+    compare_derived_with_api,
+    fetch_covidcast_data,
+    fetch_covidcast_data_multi,
+)
+from fetch_scheduler import BATCH
+from geo_aggregation import DERIVABLE_GEO_TYPES
+from geo_codes import hss_region_to_display, nation_to_display, state_abbrvs_to_display
+from utils import get_shared_dates, to_epidate_range, to_epiweek_range
+
+ALL_REGIONS = {
+    "nation": nation_to_display,
+    "state": state_abbrvs_to_display,
+    "hhs": hss_region_to_display,
+}
+
+
+def parse_signal(text):
+    """Parse "source:signal" into a (source, signal) tuple."""
+    source, _, signal = text.partition(":")
+    if not source or not signal:
+        raise argparse.ArgumentTypeError(f"Expected source:signal, got {text!r}")
+    return source, signal
+
+
+def expand_regions(geo_type, regions):
+    if regions == ["all"]:
+        if geo_type not in ALL_REGIONS:
+            raise ValueError(
+                f"--regions all is only supported for {', '.join(ALL_REGIONS)}; "
+                f"list the {geo_type} codes explicitly"
+            )
+        return list(ALL_REGIONS[geo_type])
+    return regions
+
+
+def _to_epirange(init_date, final_date, time_type):
+    if time_type == "week":
+        return to_epiweek_range(init_date, final_date)
+    return to_epidate_range(init_date, final_date)
+
+
+def _date_range(metadata, geo_type, sources_and_signals, init_date, final_date):
+    shared_init_date, shared_final_date, time_type = get_shared_dates(
+        metadata, geo_type, *sources_and_signals
+    )
+    init_date = max(init_date, shared_init_date) if init_date else shared_init_date
+    final_date = min(final_date, shared_final_date) if final_date else shared_final_date
+    return init_date, final_date, time_type
+
+
+# Tasks run in the worker processes; they only do R work on data fetched beforehand
+
+
+def _correlate_task(task):
+    from analysis_tools import iter_lag_correlations
+
+    lags_and_correlations = dict(
+        iter_lag_correlations(
+            task["df1"],
+            task["df2"],
+            "geo_value",
+            range(-task["max_lag"], task["max_lag"] + 1),
+            task["method"],
+        )
+    )
+    best_lag = max(lags_and_correlations, key=lags_and_correlations.get)
+    return pd.DataFrame(
+        {
+            **task["labels"],
+            "lag": list(lags_and_correlations),
+            "correlation": list(lags_and_correlations.values()),
+            "is_best": [lag == best_lag for lag in lags_and_correlations],
+        }
+    )
+
+
+def _forecast_task(task):
+    from analysis_tools import run_epi_predict
+
+    forecast = run_epi_predict(
+        task["df"],
+        task["predictors"],
+        task["predicted"],
+        task["forecaster_type"],
+        task["prediction_length"],
+    )
+    for column, value in task["labels"].items():
+        forecast[column] = value
+    return forecast
+
+
+def build_correlate_tasks(args, metadata):
+    tasks = []
+    for source_and_signal1, source_and_signal2 in args.pair:
+        init_date, final_date, time_type = _date_range(
+            metadata,
+            args.geo_type,
+            [source_and_signal1, source_and_signal2],
+            args.init_date,
+            args.final_date,
+        )
+        date_range = _to_epirange(init_date, final_date, time_type)
+        days = (final_date - init_date).days
+        max_lag = args.max_lag
+        if max_lag is None:
+            # Same default as the correlation page: half of the date range
+            max_lag = (days // 2) if time_type == "day" else (days // 7) // 2
+
+        regions = expand_regions(args.geo_type, args.regions)
+        bulk = len(regions) > 1
+        for region in regions:
+            labels = {
+                "source1": source_and_signal1[0],
+                "signal1": source_and_signal1[1],
+                "source2": source_and_signal2[0],
+                "signal2": source_and_signal2[1],
+                "geo_type": args.geo_type,
+                "geo_value": region,
+                "time_type": time_type,
+                "init_date": init_date,
+                "final_date": final_date,
+                "method": args.method,
+            }
+            try:
+                df1, df2 = (
+                    fetch_covidcast_data(
+                        args.geo_type,
+                        region,
+                        source_and_signal,
+                        date_range[0],
+                        date_range[-1],
+                        time_type,
+                        priority=BATCH,
+                        bulk=bulk,
+                    )
+                    for source_and_signal in (source_and_signal1, source_and_signal2)
+                )
+            except NoCovidcastDataError:
+                print(f"Skipping {labels}: no data")
+                continue
+            tasks.append(
+                {
+                    "df1": df1,
+                    "df2": df2,
+                    "max_lag": max_lag,
+                    "method": args.method,
+                    "labels": labels,
+                }
+            )
+    return tasks
+
+
+def build_forecast_tasks(args, metadata):
+    predictors_and_predicted = list(dict.fromkeys(args.predictors + [args.predicted]))
+    shared_init_date, _, time_type = _date_range(
+        metadata, args.geo_type, predictors_and_predicted, None, None
+    )
+    date_range_train = _to_epirange(shared_init_date, args.forecast_date, time_type)
+    # --prediction-length counts time steps: days, or weeks for weekly signals
+    step = timedelta(days=7 if time_type == "week" else 1)
+    final_date = args.forecast_date + args.prediction_length * step
+
+    tasks = []
+    regions = expand_regions(args.geo_type, args.regions)
+    bulk = len(regions) > 1
+    for region in regions:
+        # As on the forecasting page: the latest data, and the data as it was
+        # available at the end of the forecast period
+        for data_version, as_of in [
+            ("latest", None),
+            ("as_of", final_date.strftime("%Y-%m-%d")),
+        ]:
+            labels = {
+                "geo_type": args.geo_type,
+                "geo_value": region,
+                "forecaster_type": args.forecaster,
+                "data_version": data_version,
+            }
+            try:
+                df = fetch_covidcast_data_multi(
+                    args.geo_type,
+                    region,
+                    predictors_and_predicted,
+                    date_range_train[0],
+                    date_range_train[-1],
+                    time_type,
+                    as_of=as_of,
+                    priority=BATCH,
+                    bulk=bulk,
+                )
+            except NoCovidcastDataError:
+                print(f"Skipping {labels}: no data")
+                continue
+            tasks.append(
+                {
+                    "df": df,
+                    "predictors": args.predictors,
+                    "predicted": args.predicted,
+                    "forecaster_type": args.forecaster,
+                    "prediction_length": args.prediction_length,
+                    "labels": labels,
+                }
+            )
+    return tasks
+
+
+def check_aggregates(args, metadata):
+    """Compare county aggregates with the API's; returns (frames, failed count)."""
+    frames = []
+    failed = 0
+    for source_and_signal in args.signals:
+        for geo_type in args.geo_types:
+            labels = f"{source_and_signal[0]}:{source_and_signal[1]} {geo_type}"
+            try:
+                init_date, final_date, time_type = _date_range(
+                    metadata,
+                    geo_type,
+                    [source_and_signal],
+                    args.init_date,
+                    args.final_date,
+                )
+                date_range = _to_epirange(init_date, final_date, time_type)
+                differences, summary = compare_derived_with_api(
+                    geo_type,
+                    source_and_signal,
+                    date_range[0],
+                    date_range[-1],
+                    time_type,
+                    priority=BATCH,
+                )
+            except Exception as e:
+                failed += 1
+                print(f"Error: {str(e)} ({labels})")
+                continue
+            print(
+                f"{labels}: {summary['rows']} values compared, median relative "
+                f"difference {summary['median_rel_diff']:.4f}, 95th percentile "
+                f"{summary['p95_rel_diff']:.4f}, max {summary['max_rel_diff']:.4f}; "
+                f"{summary['only_api']} only from the API, "
+                f"{summary['only_derived']} only derived"
+            )
+            differences.insert(0, "source", source_and_signal[0])
+            differences.insert(1, "signal", source_and_signal[1])
+            differences.insert(2, "geo_type", geo_type)
+            frames.append(differences)
+    return frames, failed
+
+
+def run_tasks(task_func, tasks, workers):
+    """Run `task_func` over `tasks` in a process pool; returns (frames, failed count)."""
+    frames = []
+    failed = 0
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = {executor.submit(task_func, task): task for task in tasks}
+        for i, future in enumerate(as_completed(futures), start=1):
+            labels = futures[future]["labels"]
+            try:
+                frames.append(future.result())
+                print(f"[{i}/{len(tasks)}] done: {labels}")
+            except Exception as e:
+                failed += 1
+                print(f"[{i}/{len(tasks)}] Error: {str(e)} ({labels})")
+    return frames, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run lag-correlation sweeps and forecasts for many signals and regions."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--geo-type", required=True)
+    common.add_argument(
+        "--regions",
+        nargs="+",
+        required=True,
+        help="geo_values, or 'all' for nation, state and hhs",
+    )
+    common.add_argument("--output", required=True, help="Parquet file to write")
+    common.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes for the R computations (default: all cores)",
+    )
+    common.add_argument(
+        "--metadata",
+        default="csv_data/covidcast_metadata.csv",
+        help="COVIDcast metadata CSV used for the available date ranges",
+    )
+
+    correlate = subparsers.add_parser(
+        "correlate", parents=[common], help="Lag-correlation sweeps"
+    )
+    correlate.add_argument(
+        "--pair",
+        nargs=2,
+        type=parse_signal,
+        action="append",
+        required=True,
+        metavar=("SOURCE:SIGNAL1", "SOURCE:SIGNAL2"),
+        help="Signals to correlate (repeat for several pairs)",
+    )
+    correlate.add_argument(
+        "--method", choices=["pearson", "kendall", "spearman"], default="pearson"
+    )
+    correlate.add_argument(
+        "--max-lag", type=int, help="Default: half of the date range"
+    )
+    correlate.add_argument("--init-date", type=date.fromisoformat)
+    correlate.add_argument("--final-date", type=date.fromisoformat)
+
+    forecast = subparsers.add_parser("forecast", parents=[common], help="Forecasts")
+    forecast.add_argument("--predictors", nargs="+", type=parse_signal, required=True)
+    forecast.add_argument("--predicted", type=parse_signal, required=True)
+    forecast.add_argument(
+        "--forecaster",
+        choices=["arx_forecaster", "flatline_forecaster", "cdc_baseline_forecaster"],
+        default="arx_forecaster",
+    )
+    forecast.add_argument(
+        "--prediction-length",
+        type=int,
+        default=14,
+        help="number of time steps (days, or weeks for weekly signals) to forecast",
+    )
+    forecast.add_argument("--forecast-date", type=date.fromisoformat, required=True)
+
+    aggregates = subparsers.add_parser(
+        "check-aggregates",
+        help="Compare signals aggregated from county data with the API's aggregates",
+    )
+    aggregates.add_argument("--signals", nargs="+", type=parse_signal, required=True)
+    aggregates.add_argument(
+        "--geo-types", nargs="+", choices=DERIVABLE_GEO_TYPES, required=True
+    )
+    aggregates.add_argument("--init-date", type=date.fromisoformat)
+    aggregates.add_argument("--final-date", type=date.fromisoformat)
+    aggregates.add_argument("--output", required=True, help="Parquet file to write")
+    aggregates.add_argument(
+        "--metadata",
+        default="csv_data/covidcast_metadata.csv",
+        help="COVIDcast metadata CSV used for the available date ranges",
+    )
+
+    args = parser.parse_args(argv)
+    metadata = pd.read_csv(args.metadata)
+
+    if args.command == "correlate":
+        tasks = build_correlate_tasks(args, metadata)
+        frames, failed = run_tasks(_correlate_task, tasks, args.workers)
+    elif args.command == "check-aggregates":
+        tasks = [
+            (signal, geo_type) for signal in args.signals for geo_type in args.geo_types
+        ]
+        frames, failed = check_aggregates(args, metadata)
+    else:
+        tasks = build_forecast_tasks(args, metadata)
+        frames, failed = run_tasks(_forecast_task, tasks, args.workers)
+
+    if frames:
+        output_dir = os.path.dirname(args.output)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        pd.concat(frames, ignore_index=True).to_parquet(args.output, index=False)
+        print(f"Wrote {sum(len(df) for df in frames)} rows to {args.output}")
+    if failed:
+        print(f"{failed} of {len(tasks)} tasks failed")
+    return 1 if failed or not frames else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
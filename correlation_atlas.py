@@ -0,0 +1,535 @@
+"""
+Precomputed lag correlations for the signal pairs and regions users ask about.
+
+The atlas keeps, for each tracked (pair of signals, region), both series on a
+regular time grid and, for every lag, the sufficient statistics of the Pearson
+correlation: n, Σx, Σy, Σx², Σy² and Σxy over the complete pairs (x at t - lag,
+y at t). They are stored in a SQLite database (CORRELATION_ATLAS_DB).
+
+A pair of observations belongs to the later of its two times. When new data
+arrives, only the pairs whose later time is at or after the first new or revised
+value are subtracted (with their old values) and added again, so a daily refresh
+costs O(lags) per new day instead of a full recomputation. A query for a
+shorter date range subtracts the pairs outside of it the same way.
+
+Only Pearson correlations are maintained incrementally. Rank correlations have
+no such statistics (a new value can change every rank), and the atlas keeps no
+rank structures: Spearman correlations are recomputed from the stored series with
+correlation_engine on every lookup, which takes milliseconds and needs no request
+to the API but is not incremental. They are counted as "series_hits", apart from
+the Pearson "hits". Kendall correlations are not answered by the atlas.
+
+Pairs are tracked when a user calculates their best time lag; the refresher
+thread keeps tracked pairs up to date over the full range of the signals, every
+CORRELATION_ATLAS_REFRESH_SECONDS. The atlas is off unless CORRELATION_ATLAS_ENABLED
+is set, and the refresher only runs in the app (start_atlas_refresher), not in
+every process importing this module.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from datetime import date, timedelta
+
+import numpy as np
+
+from analysis_tools import fetch_covidcast_data, fetch_covidcast_metadata
+from correlation_engine import align_signals, lag_correlation_matrices
+from fetch_scheduler import PREFETCH
+from instrumentation import register_metrics, span
+from utils import (
+    covidcast_metadata,
+    get_shared_dates,
+    to_epidate_range,
+    to_epiweek_range,
+)
+
+CORRELATION_ATLAS_ENABLED = os.environ.get(
+    "CORRELATION_ATLAS_ENABLED", ""
+).strip().lower() in ("1", "true", "yes")
+CORRELATION_ATLAS_DB = os.environ.get(
+    "CORRELATION_ATLAS_DB", os.path.join("atlas", "atlas.sqlite")
+)
+REFRESH_INTERVAL_S = float(os.environ.get("CORRELATION_ATLAS_REFRESH_SECONDS", 3600))
+
+ATLAS_METHODS = ("pearson", "spearman")
+MIN_PERIODS = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS atlas (
+    key TEXT PRIMARY KEY,
+    source1 TEXT NOT NULL,
+    signal1 TEXT NOT NULL,
+    source2 TEXT NOT NULL,
+    signal2 TEXT NOT NULL,
+    geo_type TEXT NOT NULL,
+    geo_value TEXT NOT NULL,
+    time_type TEXT NOT NULL,
+    start TEXT,
+    through TEXT,
+    x BLOB,
+    y BLOB,
+    shift_x REAL,
+    shift_y REAL,
+    max_lag INTEGER,
+    stats BLOB,
+    tracked_at REAL NOT NULL,
+    updated_at REAL,
+    hits INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+# Columns of the per-lag statistics
+N, SUM_X, SUM_Y, SUM_XX, SUM_YY, SUM_XY = range(6)
+
+
+def _connect():
+    directory = os.path.dirname(CORRELATION_ATLAS_DB)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(
+        CORRELATION_ATLAS_DB, timeout=30, isolation_level=None
+    )
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(_SCHEMA)
+    return connection
+
+
+def atlas_key(source_and_signal1, source_and_signal2, geo_type, geo_value, time_type):
+    return hashlib.sha1(
+        repr(
+            (
+                tuple(source_and_signal1),
+                tuple(source_and_signal2),
+                geo_type,
+                geo_value,
+                time_type,
+            )
+        ).encode()
+    ).hexdigest()
+
+
+def _step(time_type):
+    return timedelta(days=7 if time_type == "week" else 1)
+
+
+def _lag_sums(x, y, lags, later=(0, None), earlier=(0, None)):
+    """
+    Sufficient statistics of the pairs (x[i - lag], y[i]) for each lag.
+
+    Only pairs whose later position is in `later` and whose earlier position is in
+    `earlier` ([start, stop) ranges, None for the end of the series) are included.
+
+    Returns:
+        np.ndarray: Shape (lag, 6), columns N, SUM_X, SUM_Y, SUM_XX, SUM_YY, SUM_XY
+    """
+    length = len(y)
+    later = (later[0], length if later[1] is None else later[1])
+    earlier = (earlier[0], length if earlier[1] is None else earlier[1])
+    sums = np.zeros((len(lags), 6))
+    for k, lag in enumerate(lags):
+        # Pair i has its earlier value at i - a and its later value at i + b
+        a, b = max(lag, 0), max(-lag, 0)
+        lo = max(later[0] - b, earlier[0] + a, a)
+        hi = min(later[1] - b, earlier[1] + a, length - b)
+        if hi <= lo:
+            continue
+        xs = x[lo - lag : hi - lag]
+        ys = y[lo:hi]
+        both = np.isfinite(xs) & np.isfinite(ys)
+        xs = xs[both]
+        ys = ys[both]
+        sums[k] = (
+            len(xs),
+            xs.sum(),
+            ys.sum(),
+            (xs * xs).sum(),
+            (ys * ys).sum(),
+            (xs * ys).sum(),
+        )
+    return sums
+
+
+def _pearson(sums):
+    n = sums[:, N]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        var_x = n * sums[:, SUM_XX] - sums[:, SUM_X] ** 2
+        var_y = n * sums[:, SUM_YY] - sums[:, SUM_Y] ** 2
+        cor = (n * sums[:, SUM_XY] - sums[:, SUM_X] * sums[:, SUM_Y]) / np.sqrt(
+            var_x * var_y
+        )
+    cor[(n < MIN_PERIODS) | (var_x <= 0) | (var_y <= 0)] = np.nan
+    return np.clip(cor, -1.0, 1.0)
+
+
+def _first_difference(old, new):
+    """First position where `new` differs from `old` (NaN equal to NaN)."""
+    overlap = min(len(old), len(new))
+    same = (old[:overlap] == new[:overlap]) | (
+        np.isnan(old[:overlap]) & np.isnan(new[:overlap])
+    )
+    changed = np.flatnonzero(~same)
+    return int(changed[0]) if len(changed) else overlap
+
+
+class _Entry:
+    """One (pair, region): series on the time grid and per-lag statistics."""
+
+    def __init__(self, row):
+        self.key = row["key"]
+        self.time_type = row["time_type"]
+        self.start = None if row["start"] is None else date.fromisoformat(row["start"])
+        # End of the date range fetched at the last refresh (data may end earlier)
+        self.through = (
+            None if row["through"] is None else date.fromisoformat(row["through"])
+        )
+        self.x = _from_blob(row["x"])
+        self.y = _from_blob(row["y"])
+        self.shift_x = row["shift_x"]
+        self.shift_y = row["shift_y"]
+        self.max_lag = row["max_lag"] or 0
+        self.stats = _from_blob(row["stats"], (-1, 6))
+
+    @property
+    def lags(self):
+        return list(range(-self.max_lag, self.max_lag + 1))
+
+    def _centered(self):
+        return self.x - self.shift_x, self.y - self.shift_y
+
+    def update(self, start, through, x, y):
+        """Replace the series, recomputing only the pairs affected by the changes."""
+        self.through = through
+        if self.start != start or self.x is None:
+            # First build, or the series now start at another date
+            self.start = start
+            self.x, self.y = x, y
+            with np.errstate(invalid="ignore"):
+                self.shift_x = float(np.nanmean(x)) if np.isfinite(x).any() else 0.0
+                self.shift_y = float(np.nanmean(y)) if np.isfinite(y).any() else 0.0
+            self.max_lag = max(self.max_lag, len(y) // 2)
+            self.stats = _lag_sums(*self._centered(), self.lags)
+            return len(y)
+
+        changed = min(_first_difference(self.x, x), _first_difference(self.y, y))
+        if changed == len(self.y) == len(y):
+            return 0
+        old_x, old_y = self._centered()
+        self.stats -= _lag_sums(old_x, old_y, self.lags, later=(changed, None))
+        self.x, self.y = x, y
+        self.stats += _lag_sums(*self._centered(), self.lags, later=(changed, None))
+        # The page sweeps up to half the date range; keep up with the longer series
+        self.extend(len(y) // 2)
+        return len(y) - changed
+
+    def extend(self, max_lag):
+        """Add the statistics of lags up to max_lag."""
+        if max_lag <= self.max_lag:
+            return False
+        x, y = self._centered()
+        new_lags = list(range(self.max_lag + 1, max_lag + 1))
+        self.stats = np.concatenate(
+            [
+                _lag_sums(x, y, [-lag for lag in reversed(new_lags)]),
+                self.stats,
+                _lag_sums(x, y, new_lags),
+            ]
+        )
+        self.max_lag = max_lag
+        return True
+
+    def positions(self, init_date, final_date):
+        """Grid positions [first, last] of a date range, clipped to the series."""
+        step = _step(self.time_type)
+        first = max(0, (init_date - self.start) // step)
+        last = min(len(self.y) - 1, (final_date - self.start) // step)
+        return first, last
+
+    def correlations(self, first, last, max_lag, method):
+        """Correlations at lags -max_lag..max_lag over grid positions [first, last]."""
+        lags = list(range(-max_lag, max_lag + 1))
+        x, y = self._centered()
+        if method == "spearman":
+            X = np.column_stack([x, y])[first : last + 1]
+            return lags, lag_correlation_matrices(X, lags, method, MIN_PERIODS)[:, 0, 1]
+
+        k = self.max_lag - max_lag
+        sums = self.stats[k : len(self.stats) - k].copy()
+        outside = first + len(y) - 1 - last
+        if outside > last + 1 - first:
+            # Cheaper to sum the pairs inside the range
+            sums = _lag_sums(x, y, lags, later=(0, last + 1), earlier=(first, None))
+        elif outside:
+            sums -= _lag_sums(x, y, lags, later=(last + 1, None))
+            sums -= _lag_sums(x, y, lags, later=(0, last + 1), earlier=(0, first))
+        return lags, _pearson(sums)
+
+
+def _to_blob(array):
+    return None if array is None else np.ascontiguousarray(array, float).tobytes()
+
+
+def _from_blob(blob, shape=(-1,)):
+    return None if blob is None else np.frombuffer(blob).reshape(shape).copy()
+
+
+def _save(connection, entry):
+    connection.execute(
+        "UPDATE atlas SET start = ?, through = ?, x = ?, y = ?, shift_x = ?, shift_y = ?, "
+        "max_lag = ?, stats = ?, updated_at = ? WHERE key = ?",
+        (
+            entry.start.isoformat(),
+            entry.through.isoformat(),
+            _to_blob(entry.x),
+            _to_blob(entry.y),
+            entry.shift_x,
+            entry.shift_y,
+            entry.max_lag,
+            _to_blob(entry.stats),
+            time.time(),
+            entry.key,
+        ),
+    )
+
+
+def track_pair(source_and_signal1, source_and_signal2, geo_type, geo_value, time_type):
+    """Add a pair of signals in a region to the atlas; built by the next refresh."""
+    if not CORRELATION_ATLAS_ENABLED:
+        return
+    key = atlas_key(
+        source_and_signal1, source_and_signal2, geo_type, geo_value, time_type
+    )
+    connection = _connect()
+    try:
+        connection.execute(
+            "INSERT OR IGNORE INTO atlas (key, source1, signal1, source2, signal2, "
+            "geo_type, geo_value, time_type, tracked_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                key,
+                *source_and_signal1,
+                *source_and_signal2,
+                geo_type,
+                geo_value,
+                time_type,
+                time.time(),
+            ),
+        )
+    finally:
+        connection.close()
+    atlas_refresher.wake()
+
+
+def lookup_lag_correlations(
+    source_and_signal1,
+    source_and_signal2,
+    geo_type,
+    geo_value,
+    time_type,
+    init_date,
+    final_date,
+    max_lag,
+    method="pearson",
+):
+    """
+    Lag correlations from the atlas, if it covers the query.
+
+    Args:
+        source_and_signal1: Signal 1 as a (source, signal) tuple (the lagged one)
+        source_and_signal2: Signal 2
+        geo_type, geo_value, time_type: The region and time unit
+        init_date, final_date: Date range (dates) of the query
+        max_lag: Lags from -max_lag to max_lag are returned
+        method: "pearson" (from the stored sufficient statistics) or "spearman"
+            (recomputed from the stored series)
+
+    Returns:
+        dict: lag -> correlation (NaN where undefined), or None if the pair is not
+            in the atlas, its data ends before final_date or the method is not
+            supported
+    """
+    if not CORRELATION_ATLAS_ENABLED or method not in ATLAS_METHODS:
+        return None
+    key = atlas_key(
+        source_and_signal1, source_and_signal2, geo_type, geo_value, time_type
+    )
+    with span("correlation_atlas.lookup"), _lock:
+        connection = _connect()
+        try:
+            row = connection.execute(
+                "SELECT * FROM atlas WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or row["start"] is None:
+                _counts["misses"] += 1
+                return None
+            entry = _Entry(row)
+            if final_date > entry.through:
+                # Data has arrived since the last refresh
+                _counts["misses"] += 1
+                return None
+            if entry.extend(max_lag):
+                _save(connection, entry)
+            connection.execute("UPDATE atlas SET hits = hits + 1 WHERE key = ?", (key,))
+        finally:
+            connection.close()
+        _counts["hits" if method == "pearson" else "series_hits"] += 1
+    first, last = entry.positions(init_date, final_date)
+    lags, correlations = entry.correlations(first, last, max_lag, method)
+    return {lag: float(cor) for lag, cor in zip(lags, correlations)}
+
+
+def _to_epirange(init_date, final_date, time_type):
+    if time_type == "week":
+        return to_epiweek_range(init_date, final_date)
+    return to_epidate_range(init_date, final_date)
+
+
+def _on_grid(df, start, step, length):
+    """Values of a single-region signal at start + i * step, NaN where missing."""
+    values = np.full(length, np.nan)
+    if df.empty:
+        return values
+    _, times, X = align_signals({"signal": df})
+    positions = np.array([(t - start) // step for t in times])
+    inside = (positions >= 0) & (positions < length)
+    values[positions[inside]] = X[inside, 0]
+    return values
+
+
+def refresh_entry(row, metadata, priority=PREFETCH):
+    """
+    Bring an atlas entry up to the latest data of its signals.
+
+    Returns the number of grid positions whose pairs were recomputed.
+    """
+    sources_and_signals = [
+        (row["source1"], row["signal1"]),
+        (row["source2"], row["signal2"]),
+    ]
+    init_date, final_date, time_type = get_shared_dates(
+        metadata, row["geo_type"], *sources_and_signals
+    )
+    date_range = _to_epirange(init_date, final_date, time_type)
+    df1, df2 = (
+        fetch_covidcast_data(
+            row["geo_type"],
+            row["geo_value"],
+            source_and_signal,
+            date_range[0],
+            date_range[-1],
+            time_type,
+            priority=priority,
+        )
+        for source_and_signal in sources_and_signals
+    )
+    times = sorted(set(df1["time_value"]) | set(df2["time_value"]))
+    start, step = times[0], _step(time_type)
+    length = (times[-1] - start) // step + 1
+    x = _on_grid(df1, start, step, length)
+    y = _on_grid(df2, start, step, length)
+
+    with _lock:
+        connection = _connect()
+        try:
+            current = connection.execute(
+                "SELECT * FROM atlas WHERE key = ?", (row["key"],)
+            ).fetchone()
+            entry = _Entry(current)
+            recomputed = entry.update(start, final_date, x, y)
+            # The date range fetched is saved even if no value has changed
+            _save(connection, entry)
+        finally:
+            connection.close()
+    return recomputed
+
+
+class AtlasRefresher:
+    def __init__(self, interval):
+        self.interval = interval
+        self._wake = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.refreshed = 0
+        self.up_to_date = 0
+        self.errors = 0
+
+    def start(self):
+        # Called by every session; only the first one starts the thread
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, daemon=True, name="atlas-refresher"
+                )
+                self._thread.start()
+
+    def wake(self):
+        """Refresh now, e.g. to build a newly tracked pair."""
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            try:
+                with span("correlation_atlas.refresh"):
+                    self.refresh_once()
+            except Exception as e:
+                self.errors += 1
+                print(f"Error: {str(e)}")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def refresh_once(self):
+        try:
+            metadata = fetch_covidcast_metadata()
+        except Exception as e:
+            print(f"Using bundled metadata for the correlation atlas: {str(e)}")
+            metadata = covidcast_metadata
+
+        connection = _connect()
+        try:
+            rows = connection.execute(
+                "SELECT key, source1, signal1, source2, signal2, geo_type, "
+                "geo_value FROM atlas ORDER BY hits DESC"
+            ).fetchall()
+        finally:
+            connection.close()
+        for row in rows:
+            try:
+                if refresh_entry(row, metadata):
+                    self.refreshed += 1
+                else:
+                    self.up_to_date += 1
+            except Exception as e:
+                self.errors += 1
+                print(f"Could not refresh atlas entry {row['key']}: {str(e)}")
+
+    def stats(self):
+        connection = _connect()
+        try:
+            entries = connection.execute("SELECT COUNT(*) FROM atlas").fetchone()[0]
+        finally:
+            connection.close()
+        return {
+            "entries": entries,
+            **_counts,
+            "refreshed": self.refreshed,
+            "up_to_date": self.up_to_date,
+            "errors": self.errors,
+        }
+
+
+_lock = threading.Lock()
+_counts = {"hits": 0, "series_hits": 0, "misses": 0}
+
+atlas_refresher = AtlasRefresher(REFRESH_INTERVAL_S)
+
+if CORRELATION_ATLAS_ENABLED:
+    register_metrics("correlation_atlas", atlas_refresher.stats)
+
+
+def start_atlas_refresher():
+    """Start the atlas refresher in this process if CORRELATION_ATLAS_ENABLED is set."""
+    if CORRELATION_ATLAS_ENABLED:
+        atlas_refresher.start()
@@ -0,0 +1,619 @@
+"""
+Vectorized lag correlations between many signals at once.
+
+All signals are aligned once on a common time axis. Each lag then takes a few
+matrix products that give the correlation of every pair of signals, instead of
+one R call per pair and lag. The results form a (pair x lag) tensor.
+
+Lags follow epi_cor's convention (as in iter_lag_correlations): at lag L,
+signal 1 at time t - L is correlated with signal 2 at time t. Observations where
+either value is missing are dropped pairwise.
+
+Pearson and Kendall's tau-b are computed for all pairs at once. Spearman ranks
+each signal once per lag window. Pairs involving a signal with gaps in the window
+need ranks over their common observations, so they are recomputed one by one.
+"""
+
+import multiprocessing
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.stats import rankdata
+
+from instrumentation import timed
+
+CorrelationTensor = namedtuple("CorrelationTensor", ["names", "pairs", "lags", "values"])
+RegionCorrelation = namedtuple("RegionCorrelation", ["geo_values", "lags", "values"])
+RollingCorrelation = namedtuple(
+    "RollingCorrelation", ["window_ends", "lags", "values", "window"]
+)
+BootstrapResult = namedtuple(
+    "BootstrapResult",
+    [
+        "lags",
+        "correlations",  # point estimates from the data itself
+        "lower",  # per-lag confidence interval of the correlation
+        "upper",
+        "best_lag",
+        "best_lag_interval",  # (lower, upper) confidence interval of the best lag
+        "best_correlation",
+        "best_correlation_interval",
+        "replicate_best_lags",
+        "block_length",
+        "confidence",
+    ],
+)
+
+BOOTSTRAP_WORKERS = int(os.environ.get("BOOTSTRAP_WORKERS", os.cpu_count() or 1))
+# Below this many (replicate x lag x pair of values) operations, starting worker
+# processes costs more than it saves
+BOOTSTRAP_PARALLEL_MIN_WORK = 5 * 10**7
+_bootstrap_executor = None
+_bootstrap_executor_lock = threading.Lock()
+
+# Upper bound on the size of the pairwise-difference blocks used for Kendall's tau
+KENDALL_BLOCK_BYTES = 64 * 1024**2
+
+
+def align_signals(frames):
+    """
+    Align signals of a single region on a common time axis.
+
+    Args:
+        frames: Dict mapping a signal name to a DataFrame with time_value and value
+            columns, as returned by fetch_covidcast_data
+
+    Returns:
+        tuple: (names, time values, values array of shape (time, signal) with NaN
+            where a signal has no value)
+    """
+    columns = {}
+    for name, df in frames.items():
+        if df["geo_value"].nunique() > 1:
+            raise ValueError(f"{name} has more than one geo_value")
+        columns[name] = df.groupby("time_value")["value"].mean()
+    aligned = _fill_time_axis(pd.DataFrame(columns).sort_index())
+    return list(aligned.columns), aligned.index.to_numpy(), aligned.to_numpy(float)
+
+
+def _fill_time_axis(aligned):
+    # Fill in missing dates so that a shift by one row is a shift by one time step
+    if len(aligned) > 1:
+        step = pd.Series(aligned.index).diff().min()
+        full_index = pd.date_range(aligned.index[0], aligned.index[-1], freq=step)
+        aligned = aligned.reindex(full_index.date)
+    return aligned
+
+
+def align_regions(df1, df2):
+    """
+    Align two signals on a common time axis, one column per region.
+
+    Args:
+        df1: Signal 1 for any number of geo_values, as returned by
+            fetch_covidcast_data (e.g. with geo_value="*")
+        df2: Signal 2
+
+    Returns:
+        tuple: (geo_values present in both signals, time values, values of signal 1
+            and of signal 2 as arrays of shape (time, region) with NaN where a region
+            has no value)
+    """
+    tables = [
+        df.pivot_table(
+            index="time_value", columns="geo_value", values="value", aggfunc="mean"
+        )
+        for df in (df1, df2)
+    ]
+    geo_values = sorted(set(tables[0].columns) & set(tables[1].columns))
+    times = _fill_time_axis(
+        pd.DataFrame(index=tables[0].index.union(tables[1].index))
+    ).index
+    X1, X2 = (
+        table.reindex(index=times, columns=geo_values).to_numpy(float)
+        for table in tables
+    )
+    return geo_values, times.to_numpy(), X1, X2
+
+
+def _lag_windows(X, lag):
+    """Rows of X pairing signal 1 at t - lag with signal 2 at t."""
+    n = len(X)
+    if abs(lag) >= n:
+        # Nothing overlaps (the date range can be longer than the data)
+        return X[:0], X[:0]
+    if lag >= 0:
+        return X[: n - lag], X[lag:]
+    return X[-lag:], X[: n + lag]
+
+
+def _pearson_all_pairs(A, B, min_periods):
+    """Pairwise-complete Pearson correlation of every column of A with every column of B."""
+    mask_a = np.isfinite(A).astype(float)
+    mask_b = np.isfinite(B).astype(float)
+    a = np.where(mask_a > 0, A, 0.0)
+    b = np.where(mask_b > 0, B, 0.0)
+
+    n = mask_a.T @ mask_b
+    sum_a = a.T @ mask_b
+    sum_b = mask_a.T @ b
+    sum_ab = a.T @ b
+    sum_aa = (a * a).T @ mask_b
+    sum_bb = mask_a.T @ (b * b)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cov = n * sum_ab - sum_a * sum_b
+        var_a = n * sum_aa - sum_a**2
+        var_b = n * sum_bb - sum_b**2
+        cor = cov / np.sqrt(var_a * var_b)
+    cor[(n < min_periods) | (var_a <= 0) | (var_b <= 0)] = np.nan
+    return np.clip(cor, -1.0, 1.0)
+
+
+def _spearman_all_pairs(A, B, min_periods):
+    """Pairwise-complete Spearman correlation of every column of A with every column of B."""
+    cor = _pearson_all_pairs(
+        rankdata(A, axis=0, nan_policy="omit"),
+        rankdata(B, axis=0, nan_policy="omit"),
+        min_periods,
+    )
+    # The ranks above are only pairwise-complete ranks if neither column has gaps
+    gaps_a = np.flatnonzero(~np.isfinite(A).all(axis=0))
+    gaps_b = np.flatnonzero(~np.isfinite(B).all(axis=0))
+    for i, j in {(i, j) for i in gaps_a for j in range(B.shape[1])} | {
+        (i, j) for i in range(A.shape[1]) for j in gaps_b
+    }:
+        both = np.isfinite(A[:, i]) & np.isfinite(B[:, j])
+        cor[i, j] = _pearson_all_pairs(
+            rankdata(A[both, i])[:, None], rankdata(B[both, j])[:, None], min_periods
+        )[0, 0]
+    return cor
+
+
+def _kendall_all_pairs(A, B, min_periods):
+    """Pairwise-complete Kendall tau-b of every column of A with every column of B."""
+    n_rows, n_a = A.shape
+    n_b = B.shape[1]
+    concordance = np.zeros((n_a, n_b))
+    untied_a = np.zeros((n_a, n_b))
+    untied_b = np.zeros((n_a, n_b))
+    n_pairs = np.zeros((n_a, n_b))
+
+    # Signs are -1/0/1, so float32 products are exact (per block) and twice as fast
+    rows_i, rows_j = np.triu_indices(n_rows, k=1)
+    block = max(1, KENDALL_BLOCK_BYTES // (4 * max(n_a, n_b) * 4))
+    for start in range(0, len(rows_i), block):
+        i = rows_i[start : start + block]
+        j = rows_j[start : start + block]
+        sign_a = np.sign(A[j] - A[i]).astype(np.float32)
+        sign_b = np.sign(B[j] - B[i]).astype(np.float32)
+        valid_a = np.isfinite(sign_a).astype(np.float32)
+        valid_b = np.isfinite(sign_b).astype(np.float32)
+        sign_a = np.nan_to_num(sign_a)
+        sign_b = np.nan_to_num(sign_b)
+
+        concordance += sign_a.T @ sign_b
+        untied_a += (sign_a * sign_a).T @ valid_b
+        untied_b += valid_a.T @ (sign_b * sign_b)
+        n_pairs += valid_a.T @ valid_b
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tau = concordance / np.sqrt(untied_a * untied_b)
+    # n_pairs counts pairs of observations; min_periods counts observations
+    tau[n_pairs < min_periods * (min_periods - 1) / 2] = np.nan
+    return np.clip(tau, -1.0, 1.0)
+
+
+def lag_correlation_matrices(X, lags, method="pearson", min_periods=3):
+    """
+    Correlation of every signal (at t - lag) with every signal (at t) for each lag.
+
+    Args:
+        X: Array of shape (time, signal), as returned by align_signals
+        lags: Iterable of integer lags (in time steps)
+        method: "pearson", "spearman" or "kendall"
+        min_periods: Minimum number of overlapping observations
+
+    Returns:
+        np.ndarray: Shape (lag, signal, signal); entry [k, i, j] correlates signal i
+            lagged by lags[k] with signal j
+    """
+    matrices = []
+    for lag in lags:
+        A, B = _lag_windows(X, lag)
+        if method == "pearson":
+            matrices.append(_pearson_all_pairs(A, B, min_periods))
+        elif method == "spearman":
+            matrices.append(_spearman_all_pairs(A, B, min_periods))
+        elif method == "kendall":
+            matrices.append(_kendall_all_pairs(A, B, min_periods))
+        else:
+            raise ValueError(f"Invalid correlation method: {method}")
+    return np.stack(matrices) if matrices else np.empty((0, X.shape[1], X.shape[1]))
+
+
+@timed()
+def correlation_tensor(frames, max_lag, method="pearson", min_periods=3):
+    """
+    Lag correlations of all pairs of signals.
+
+    Args:
+        frames: Dict mapping a signal name to its DataFrame (single region)
+        max_lag: Lags from -max_lag to max_lag (in time steps) are computed
+        method: "pearson", "spearman" or "kendall"
+        min_periods: Minimum number of overlapping observations
+
+    Returns:
+        CorrelationTensor: names, pairs (list of (name1, name2)), lags and values
+            of shape (pair, lag); negative lags cover the reversed pairs
+    """
+    names, _, X = align_signals(frames)
+    lags = list(range(-max_lag, max_lag + 1))
+    matrices = lag_correlation_matrices(X, lags, method, min_periods)
+    index_pairs = list(combinations(range(len(names)), 2))
+    values = np.array([matrices[:, i, j] for i, j in index_pairs]).reshape(
+        len(index_pairs), len(lags)
+    )
+    pairs = [(names[i], names[j]) for i, j in index_pairs]
+    return CorrelationTensor(names, pairs, lags, values)
+
+
+def best_lags(tensor):
+    """DataFrame with the lag of highest correlation for each pair."""
+    rows = []
+    for (name1, name2), values in zip(tensor.pairs, tensor.values):
+        if np.all(np.isnan(values)):
+            rows.append((name1, name2, None, np.nan))
+            continue
+        k = int(np.nanargmax(values))
+        rows.append((name1, name2, tensor.lags[k], values[k]))
+    return pd.DataFrame(rows, columns=["signal1", "signal2", "best_lag", "correlation"])
+
+
+def _shifted(x, lags):
+    """Array of shape (lag, time) whose row k holds x at t - lags[k] (NaN outside)."""
+    shifted = np.full((len(lags), len(x)), np.nan)
+    for k, lag in enumerate(lags):
+        if lag >= 0:
+            shifted[k, lag:] = x[: len(x) - lag]
+        else:
+            shifted[k, :lag] = x[-lag:]
+    return shifted
+
+
+def _window_sums(values, window):
+    """Sums over every window of `window` consecutive time steps (last axis)."""
+    cumsum = np.cumsum(values, axis=-1)
+    cumsum = np.concatenate([np.zeros(values.shape[:-1] + (1,)), cumsum], axis=-1)
+    return cumsum[..., window:] - cumsum[..., :-window]
+
+
+def _rolling_pearson(X, Y, window, min_periods):
+    # Each window's sums are the difference of two running sums, so sliding the
+    # window by one step costs O(1) per lag regardless of the window length
+    mask = np.isfinite(X) & np.isfinite(Y)
+    # Centering (which does not change correlations) limits the cancellation in
+    # the variances computed from running sums of squares
+    x = np.where(mask, X - np.nanmean(X), 0.0)
+    y = np.where(mask, Y - np.nanmean(Y), 0.0)
+    n = _window_sums(mask.astype(float), window)
+    sum_x = _window_sums(x, window)
+    sum_y = _window_sums(y, window)
+    sum_xy = _window_sums(x * y, window)
+    sum_xx = _window_sums(x * x, window)
+    sum_yy = _window_sums(y * y, window)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        var_x = n * sum_xx - sum_x**2
+        var_y = n * sum_yy - sum_y**2
+        cor = (n * sum_xy - sum_x * sum_y) / np.sqrt(var_x * var_y)
+    # Running sums accumulate rounding errors; treat near-zero variance as zero
+    scale = np.maximum(n * sum_xx, 1e-300), np.maximum(n * sum_yy, 1e-300)
+    degenerate = (var_x <= 1e-12 * scale[0]) | (var_y <= 1e-12 * scale[1])
+    cor[(n < min_periods) | degenerate] = np.nan
+    return np.clip(cor, -1.0, 1.0)
+
+
+def _rolling_windows(X, Y, window):
+    # Pairs with a missing value are dropped from both series, so ranks and
+    # concordances within each window only use complete pairs
+    mask = np.isfinite(X) & np.isfinite(Y)
+    X = np.where(mask, X, np.nan)
+    Y = np.where(mask, Y, np.nan)
+    return (
+        sliding_window_view(X, window, axis=-1),
+        sliding_window_view(Y, window, axis=-1),
+        sliding_window_view(mask, window, axis=-1).sum(axis=-1),
+    )
+
+
+def _center(ranks):
+    valid = np.isfinite(ranks)
+    mean = np.nanmean(np.where(valid, ranks, np.nan), axis=-1, keepdims=True)
+    return np.where(valid, ranks - mean, 0.0)
+
+
+def _rolling_spearman(X, Y, window, min_periods):
+    X_windows, Y_windows, n = _rolling_windows(X, Y, window)
+    rank_x = rankdata(X_windows, axis=-1, nan_policy="omit")
+    rank_y = rankdata(Y_windows, axis=-1, nan_policy="omit")
+    rank_x = _center(rank_x)
+    rank_y = _center(rank_y)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cor = (rank_x * rank_y).sum(-1) / np.sqrt(
+            (rank_x**2).sum(-1) * (rank_y**2).sum(-1)
+        )
+    cor[n < min_periods] = np.nan
+    return np.clip(cor, -1.0, 1.0)
+
+
+def _rolling_kendall(X, Y, window, min_periods):
+    X_windows, Y_windows, n = _rolling_windows(X, Y, window)
+    i, j = np.triu_indices(window, k=1)
+    cor = np.empty(X_windows.shape[:-1])
+    # Blocks of windows of one lag at a time keep the (window, pair) sign arrays small
+    block = max(1, KENDALL_BLOCK_BYTES // (8 * len(i) * 4))
+    for k in range(len(X_windows)):
+        for start in range(0, X_windows.shape[1], block):
+            x = X_windows[k, start : start + block]
+            y = Y_windows[k, start : start + block]
+            sign_x = np.nan_to_num(np.sign(x[:, j] - x[:, i]))
+            sign_y = np.nan_to_num(np.sign(y[:, j] - y[:, i]))
+            with np.errstate(divide="ignore", invalid="ignore"):
+                cor[k, start : start + block] = (sign_x * sign_y).sum(-1) / np.sqrt(
+                    (sign_x**2).sum(-1) * (sign_y**2).sum(-1)
+                )
+    cor[n < min_periods] = np.nan
+    return np.clip(cor, -1.0, 1.0)
+
+
+@timed()
+def rolling_lag_correlation(
+    df1, df2, window, max_lag, method="pearson", min_periods=None
+):
+    """
+    Correlation of two signals in a sliding window, for every window end and lag.
+
+    Args:
+        df1: Signal 1 (single region), as returned by fetch_covidcast_data
+        df2: Signal 2 (single region)
+        window: Window length in time steps
+        max_lag: Lags from -max_lag to max_lag (in time steps) are computed
+        method: "pearson", "spearman" or "kendall"
+        min_periods: Minimum number of complete pairs in a window
+            (default: half the window)
+
+    Returns:
+        RollingCorrelation: window_ends (dates), lags, values of shape (lag, window
+            end) and the window length
+    """
+    _, times, X = align_signals({"signal1": df1, "signal2": df2})
+    if window > len(times):
+        raise ValueError(
+            f"The window ({window}) is longer than the date range ({len(times)})"
+        )
+    min_periods = min_periods or max(3, window // 2)
+    lags = list(range(-max_lag, max_lag + 1))
+    shifted = _shifted(X[:, 0], lags)
+    target = np.broadcast_to(X[:, 1], shifted.shape)
+
+    if method == "pearson":
+        values = _rolling_pearson(shifted, target, window, min_periods)
+    elif method == "spearman":
+        values = _rolling_spearman(shifted, target, window, min_periods)
+    elif method == "kendall":
+        values = _rolling_kendall(shifted, target, window, min_periods)
+    else:
+        raise ValueError(f"Invalid correlation method: {method}")
+    return RollingCorrelation(times[window - 1 :], lags, values, window)
+
+
+@timed()
+def region_lag_correlations(df1, df2, max_lag, method="pearson", min_periods=3):
+    """
+    Lag correlations of two signals within each region, for all regions at once.
+
+    Each lag takes one pass over the (time, region) arrays, which gives the
+    correlation of every region, instead of one sweep per region.
+
+    Args:
+        df1: Signal 1 for many geo_values, as returned by fetch_covidcast_data
+        df2: Signal 2
+        max_lag: Lags from -max_lag to max_lag (in time steps) are computed
+        method: "pearson", "spearman" or "kendall" (much slower)
+        min_periods: Minimum number of complete pairs in a region
+
+    Returns:
+        RegionCorrelation: geo_values, lags and values of shape (region, lag)
+    """
+    geo_values, _, X1, X2 = align_regions(df1, df2)
+    # Centering each region (which does not change correlations) keeps the sums
+    # below accurate for regions far from the overall mean
+    with np.errstate(invalid="ignore"):
+        X1 = X1 - np.nanmean(X1, axis=0)
+        X2 = X2 - np.nanmean(X2, axis=0)
+    lags = list(range(-max_lag, max_lag + 1))
+    values = np.full((len(geo_values), len(lags)), np.nan)
+    for k, lag in enumerate(lags):
+        A, _ = _lag_windows(X1, lag)
+        _, B = _lag_windows(X2, lag)
+        if len(A) < min_periods:
+            continue
+        # The whole overlap as a single window gives one correlation per region
+        if method == "pearson":
+            values[:, k] = _rolling_pearson(A.T, B.T, len(A), min_periods)[:, 0]
+        elif method == "spearman":
+            values[:, k] = _rolling_spearman(A.T, B.T, len(A), min_periods)[:, 0]
+        elif method == "kendall":
+            values[:, k] = _rolling_kendall(A.T, B.T, len(A), min_periods)[:, 0]
+        else:
+            raise ValueError(f"Invalid correlation method: {method}")
+    return RegionCorrelation(geo_values, lags, values)
+
+
+def region_best_lags(regions):
+    """DataFrame with the lag of highest correlation for each region."""
+    rows = []
+    for geo_value, values in zip(regions.geo_values, regions.values):
+        if np.all(np.isnan(values)):
+            rows.append((geo_value, None, np.nan))
+            continue
+        k = int(np.nanargmax(values))
+        rows.append((geo_value, regions.lags[k], values[k]))
+    return pd.DataFrame(rows, columns=["geo_value", "best_lag", "correlation"])
+
+
+def _get_bootstrap_executor():
+    # Kept for the lifetime of the process, as starting the workers takes seconds.
+    # Spawned workers only need numpy/scipy; forking a process with an R session
+    # (and Streamlit's threads) is not safe.
+    global _bootstrap_executor
+    with _bootstrap_executor_lock:
+        if _bootstrap_executor is None:
+            _bootstrap_executor = ProcessPoolExecutor(
+                max_workers=BOOTSTRAP_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _bootstrap_executor
+
+
+def _block_bootstrap_indices(n, block_length, n_replicates, rng):
+    """Moving-block bootstrap: each row holds n time indices made of random blocks."""
+    n_blocks = -(-n // block_length)
+    starts = rng.integers(0, n - block_length + 1, size=(n_replicates, n_blocks))
+    indices = starts[:, :, None] + np.arange(block_length)
+    return indices.reshape(n_replicates, -1)[:, :n]
+
+
+def _bootstrap_replicates(shifted, target, indices, method, min_periods):
+    """
+    Correlation curves of bootstrap replicates, shape (replicate, lag).
+
+    Runs in worker processes, so it only takes arrays.
+    """
+    curves = np.empty((len(indices), len(shifted)))
+    y = target[indices]
+    for k, x_lagged in enumerate(shifted):
+        x = x_lagged[indices]
+        if method == "pearson":
+            curves[:, k] = _rolling_pearson(x, y, x.shape[1], min_periods)[:, 0]
+        elif method == "spearman":
+            curves[:, k] = _rolling_spearman(x, y, x.shape[1], min_periods)[:, 0]
+        else:
+            for b in range(len(indices)):
+                both = np.isfinite(x[b]) & np.isfinite(y[b])
+                curves[b, k] = _kendall_all_pairs(
+                    x[b, both, None], y[b, both, None], min_periods
+                )[0, 0]
+    return curves
+
+
+@timed()
+def bootstrap_lag_correlations(
+    df1,
+    df2,
+    max_lag,
+    method="pearson",
+    n_replicates=200,
+    block_length=None,
+    confidence=0.95,
+    workers=None,
+    seed=None,
+):
+    """
+    Block-bootstrap confidence intervals for the lag correlation curve and its best lag.
+
+    The time points are resampled in blocks so that each replicate keeps the
+    autocorrelation within blocks. A replicate uses the same time points for all
+    lags and gives a full correlation curve and best lag. Replicates are split
+    across `workers` processes (default: BOOTSTRAP_WORKERS).
+
+    Args:
+        df1: Signal 1 (single region), as returned by fetch_covidcast_data
+        df2: Signal 2 (single region)
+        max_lag: Lags from -max_lag to max_lag (in time steps) are computed
+        method: "pearson", "spearman" or "kendall" (much slower)
+        n_replicates: Number of bootstrap replicates
+        block_length: Length of the resampled blocks (default: cube root of the
+            number of time steps)
+        confidence: Confidence level of the percentile intervals
+        workers: Number of processes (1 runs in this process)
+        seed: Seed for reproducible resampling
+
+    Returns:
+        BootstrapResult
+    """
+    _, _, X = align_signals({"signal1": df1, "signal2": df2})
+    n = len(X)
+    block_length = block_length or max(2, round(n ** (1 / 3)))
+    block_length = min(block_length, n)
+    min_periods = 3
+    lags = list(range(-max_lag, max_lag + 1))
+    shifted = _shifted(X[:, 0], lags)
+    target = X[:, 1]
+
+    correlations = _bootstrap_replicates(
+        shifted, target, np.arange(n)[None, :], method, min_periods
+    )[0]
+    indices = _block_bootstrap_indices(
+        n, block_length, n_replicates, np.random.default_rng(seed)
+    )
+
+    work = n_replicates * len(lags) * (n * n if method == "kendall" else n)
+    workers = min(workers or BOOTSTRAP_WORKERS, n_replicates)
+    if workers > 1 and work >= BOOTSTRAP_PARALLEL_MIN_WORK:
+        chunks = np.array_split(indices, workers)
+        executor = _get_bootstrap_executor()
+        curves = np.concatenate(
+            list(
+                executor.map(
+                    _bootstrap_replicates,
+                    [shifted] * workers,
+                    [target] * workers,
+                    chunks,
+                    [method] * workers,
+                    [min_periods] * workers,
+                )
+            )
+        )
+    else:
+        curves = _bootstrap_replicates(shifted, target, indices, method, min_periods)
+
+    alpha = (1 - confidence) / 2
+    with np.errstate(invalid="ignore"):
+        lower, upper = np.nanquantile(curves, [alpha, 1 - alpha], axis=0)
+    valid = ~np.all(np.isnan(curves), axis=1)
+    replicate_best = np.nanargmax(
+        np.where(np.isnan(curves[valid]), -np.inf, curves[valid]), axis=1
+    )
+    replicate_best_lags = np.array(lags)[replicate_best]
+    replicate_best_correlations = np.nanmax(curves[valid], axis=1)
+
+    best = int(np.nanargmax(correlations))
+    return BootstrapResult(
+        lags=lags,
+        correlations=correlations,
+        lower=lower,
+        upper=upper,
+        best_lag=lags[best],
+        best_lag_interval=tuple(
+            int(lag)
+            for lag in np.quantile(
+                replicate_best_lags, [alpha, 1 - alpha], method="nearest"
+            )
+        ),
+        best_correlation=correlations[best],
+        best_correlation_interval=tuple(
+            float(cor)
+            for cor in np.quantile(replicate_best_correlations, [alpha, 1 - alpha])
+        ),
+        replicate_best_lags=replicate_best_lags,
+        block_length=block_length,
+        confidence=confidence,
+    )
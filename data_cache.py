@@ -0,0 +1,193 @@
+"""
+Process-wide cache of fetched signal data, shared by all Streamlit sessions.
+
+Entries are evicted in least-recently-used order once the total size of the cached
+frames exceeds a byte budget (SIGNAL_CACHE_MAX_BYTES). Data fetched without `as_of`
+(i.e. the latest revision) expires after SIGNAL_CACHE_TTL_SECONDS.
+
+Cached frames are shared, not copied: the cache makes the data of every frame it
+is given read-only (see share_frame) and hands out shallow copies of it, so all
+sessions reference the same arrays. A caller can add or replace columns of its
+frame without affecting anyone else, while writing into the shared data in place
+(e.g. with .loc or inplace=True) raises a ValueError instead of silently changing
+the frames of other sessions. This does not rely on pandas' process-wide
+copy-on-write mode.
+"""
+
+import hashlib
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import register_metrics
+
+SignalKey = namedtuple(
+    "SignalKey",
+    [
+        "source",
+        "signal",
+        "geo_type",
+        "geo_value",
+        "time_type",
+        "init_date",
+        "final_date",
+        "as_of",
+    ],
+)
+
+
+def frame_nbytes(df):
+    # memory_usage(deep=True) cannot read object arrays made read-only by share_frame
+    nbytes = df.index.memory_usage(deep=True)
+    for _, column in df.items():
+        if column.dtype == object:
+            values = column.to_numpy()
+            nbytes += values.nbytes + sum(map(sys.getsizeof, values))
+        else:
+            nbytes += column.memory_usage(index=False, deep=True)
+    return int(nbytes)
+
+
+def share_frame(df):
+    """
+    Make the data of `df` read-only so that it can be shared without copies.
+
+    Returns:
+        pd.DataFrame: `df` itself; shallow copies of it (df.copy(deep=False)) share
+            its data and can be handed to any number of callers
+    """
+    # pandas has no public API for this: mark the arrays of its blocks read-only
+    for block in df._mgr.blocks:
+        values = block.values
+        array = values if isinstance(values, np.ndarray) else getattr(values, "_ndarray", None)
+        if array is not None:
+            array.flags.writeable = False
+    return df
+
+
+def frame_fingerprint(df):
+    """Content hash of a DataFrame (column names, dtypes, index and values)."""
+    digest = hashlib.sha1()
+    digest.update(repr([(str(c), str(t)) for c, t in df.dtypes.items()]).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+class SignalCache:
+    """Thread-safe LRU cache of DataFrames with a memory budget and hit/miss/eviction counters."""
+
+    def __init__(self, max_bytes, default_ttl=None):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()  # key -> (df, nbytes, expires_at)
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _remove(self, key):
+        _, nbytes, _ = self._entries.pop(key)
+        self.current_bytes -= nbytes
+
+    def get(self, key):
+        """Return a shallow copy of the cached (read-only) frame, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] < time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0].copy(deep=False)
+
+    def find(self, predicate):
+        """
+        Return (key, frame) for the most recently used entry whose key satisfies
+        `predicate`, or (None, None). Used to answer a request from a wider entry.
+        """
+        now = time.time()
+        with self._lock:
+            for key in reversed(self._entries):
+                df, _, expires_at = self._entries[key]
+                if (expires_at is None or expires_at >= now) and predicate(key):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return key, df.copy(deep=False)
+        return None, None
+
+    def peek(self, key):
+        """Like `get`, but without updating the LRU order or the counters."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[2] is not None and entry[2] < time.time()):
+                return None
+            return entry[0].copy(deep=False)
+
+    def put(self, key, df, ttl=None):
+        """
+        Store `df` under `key`, evicting least recently used entries if needed.
+
+        The data of `df` is made read-only (see share_frame), also if it is larger
+        than the whole budget and therefore not cached.
+        """
+        nbytes = frame_nbytes(df)
+        ttl = self.default_ttl if ttl is None else ttl
+        expires_at = None if not ttl else time.time() + ttl
+
+        share_frame(df)
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if nbytes > self.max_bytes:
+                return
+            while self._entries and self.current_bytes + nbytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+            self._entries[key] = (df, nbytes, expires_at)
+            self.current_bytes += nbytes
+
+    def get_or_load(self, key, load, ttl=None):
+        """Return the cached frame for `key`, calling `load()` and caching its result on a miss."""
+        df = self.get(key)
+        if df is not None:
+            return df
+        df = load()
+        self.put(key, df, ttl=ttl)
+        return df.copy(deep=False)
+
+    def invalidate(self, predicate=None):
+        """Drop all entries, or only those whose key satisfies `predicate`."""
+        with self._lock:
+            for key in list(self._entries):
+                if predicate is None or predicate(key):
+                    self._remove(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+signal_cache = SignalCache(
+    max_bytes=int(os.environ.get("SIGNAL_CACHE_MAX_BYTES", 512 * 1024**2)),
+)
+LATEST_DATA_TTL_S = float(os.environ.get("SIGNAL_CACHE_TTL_SECONDS", 6 * 3600))
+
+register_metrics("signal_cache", signal_cache.stats)
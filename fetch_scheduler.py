@@ -0,0 +1,350 @@
+"""
+Rate-limit-aware scheduler for Epidata API requests.
+
+All fetches go through a process-wide queue served by a small pool of worker
+threads. Requests are started in priority order (interactive, then prefetch,
+then batch) and only when the token bucket sized to our API quota has a token,
+so bursts of background requests cannot use up the quota ahead of users.
+Prefetch and batch requests also leave a small reserve of tokens
+(EPIDATA_INTERACTIVE_RESERVE) to requests made by users, and with more than one
+worker at most all but one worker run them at a time, so a user's request never
+waits for a slow background request to finish.
+Rate-limit (429) and transient network errors are retried with jittered
+exponential backoff.
+
+The quota is configured with EPIDATA_RATE_LIMIT_PER_HOUR (anonymous requests)
+and EPIDATA_RATE_LIMIT_PER_HOUR_WITH_KEY (after an API key has been saved).
+"""
+
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+from instrumentation import record_span, register_metrics
+from profiling import profiled
+
+INTERACTIVE = 0
+PREFETCH = 1
+BATCH = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", PREFETCH: "prefetch", BATCH: "batch"}
+
+ANONYMOUS_REQUESTS_PER_HOUR = float(os.environ.get("EPIDATA_RATE_LIMIT_PER_HOUR", 60))
+API_KEY_REQUESTS_PER_HOUR = float(
+    os.environ.get("EPIDATA_RATE_LIMIT_PER_HOUR_WITH_KEY", 3000)
+)
+BURST = int(os.environ.get("EPIDATA_RATE_LIMIT_BURST", 10))
+
+# Substrings of error messages (from epidatr/httr or requests) worth retrying
+RETRYABLE_ERRORS = (
+    "429",
+    "too many requests",
+    "rate limit",
+    "timed out",
+    "timeout",
+    "connection",
+    "temporarily unavailable",
+    "502",
+    "503",
+    "504",
+)
+
+
+def is_rate_limit_error(error):
+    message = str(error).lower()
+    return "429" in message or "too many requests" in message or "rate limit" in message
+
+
+def is_retryable_error(error):
+    message = str(error).lower()
+    return any(pattern in message for pattern in RETRYABLE_ERRORS)
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate_per_hour`, holding at most `capacity` tokens."""
+
+    def __init__(self, rate_per_hour, capacity):
+        self.capacity = capacity
+        self.rate = rate_per_hour / 3600
+        self.tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def set_rate(self, rate_per_hour):
+        with self._lock:
+            self._refill()
+            self.rate = rate_per_hour / 3600
+
+    def try_acquire(self, reserve=0):
+        """
+        Take a token if more than `reserve` tokens would be left, and return 0.
+        Otherwise return the number of seconds until that will be the case.
+        """
+        reserve = min(reserve, self.capacity - 1)
+        with self._lock:
+            self._refill()
+            if self.tokens >= 1 + reserve:
+                self.tokens -= 1
+                return 0.0
+            return (1 + reserve - self.tokens) / self.rate
+
+    def drain(self):
+        """Empty the bucket, e.g. after the API has told us we are over the limit."""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0.0)
+
+    def available(self):
+        with self._lock:
+            self._refill()
+            return self.tokens
+
+
+class _Job:
+    def __init__(self, func, priority, key):
+        self.func = func
+        self.priority = priority
+        self.key = key
+        self.future = Future()
+        self.attempt = 0
+        self.submitted = time.monotonic()
+        self.entry = None  # current heap entry; older entries are stale after promotion
+        self.background = False  # whether it was started as a prefetch or batch job
+
+
+class FetchScheduler:
+    def __init__(
+        self,
+        bucket,
+        workers=2,
+        interactive_reserve=2,
+        max_retries=4,
+        base_delay=2.0,
+        max_delay=120.0,
+    ):
+        self.bucket = bucket
+        self.workers = workers
+        self.interactive_reserve = interactive_reserve
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._heap = []  # [priority, seq, job]
+        self._delayed = []  # (ready_at, seq, job) waiting for a retry
+        self._queued = {}  # key -> job, for jobs not yet running
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+
+        self.running = 0
+        self.running_background = 0
+        self.completed = 0
+        self.retries = 0
+        self.failures = 0
+
+    def _ensure_workers(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._work, daemon=True, name=f"fetch-scheduler-{i}"
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def _push(self, job):
+        job.entry = [job.priority, next(self._seq), job]
+        heapq.heappush(self._heap, job.entry)
+
+    def submit(self, func, priority=INTERACTIVE, key=None):
+        """
+        Queue `func` and return a Future with its result.
+
+        If a job with the same `key` is still queued, its Future is returned instead,
+        and the job is promoted if the new request has a higher priority.
+        """
+        with self._cond:
+            self._ensure_workers()
+            job = self._queued.get(key) if key is not None else None
+            if job is not None:
+                self._promote(job, priority)
+                return job.future
+
+            job = _Job(func, priority, key)
+            if key is not None:
+                self._queued[key] = job
+            self._push(job)
+            self._cond.notify()
+            return job.future
+
+    def run(self, func, priority=INTERACTIVE, key=None):
+        """Submit `func` and wait for its result."""
+        return self.submit(func, priority=priority, key=key).result()
+
+    def _promote(self, job, priority):
+        if priority >= job.priority:
+            return
+        job.priority = priority
+        if job.entry is not None:
+            self._push(job)
+            self._cond.notify()
+
+    def promote(self, key, priority):
+        """Raise the priority of a queued job, e.g. when a user asks for prefetched data."""
+        with self._cond:
+            job = self._queued.get(key)
+            if job is not None:
+                self._promote(job, priority)
+
+    def _release_due_retries(self):
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, job = heapq.heappop(self._delayed)
+            self._push(job)
+
+    def _drop_stale_entries(self):
+        # Called with the lock held; removes entries superseded by a promotion
+        while self._heap and self._heap[0] is not self._heap[0][2].entry:
+            heapq.heappop(self._heap)
+
+    def _next_job(self):
+        self._drop_stale_entries()
+        if not self._heap:
+            return None
+        job = heapq.heappop(self._heap)[2]
+        job.entry = None
+        return job
+
+    def _work(self):
+        while True:
+            with self._cond:
+                self._release_due_retries()
+                self._drop_stale_entries()
+                if not self._heap:
+                    timeout = (
+                        self._delayed[0][0] - time.monotonic() if self._delayed else None
+                    )
+                    self._cond.wait(timeout=timeout)
+                    continue
+
+                # Prefetch and batch jobs leave a worker and a few tokens to
+                # interactive requests; the heap is ordered by priority, so no
+                # interactive job is waiting behind them
+                background = self._heap[0][0] != INTERACTIVE
+                if background and self.running_background >= max(1, self.workers - 1):
+                    self._cond.wait()
+                    continue
+                reserve = self.interactive_reserve if background else 0
+                wait = self.bucket.try_acquire(reserve=reserve)
+                if wait > 0:
+                    # Re-evaluated early if a (possibly more urgent) job is submitted
+                    self._cond.wait(timeout=min(wait, 1.0))
+                    continue
+
+                job = self._next_job()
+                if job.key is not None:
+                    self._queued.pop(job.key, None)
+                job.background = background
+                self.running += 1
+                self.running_background += background
+
+            record_span(
+                f"fetch_scheduler.queue_wait.{PRIORITY_NAMES[job.priority]}",
+                time.monotonic() - job.submitted,
+            )
+            self._execute(job)
+
+    def _stopped(self, job):
+        # Called with the lock held when a job stops running
+        self.running -= 1
+        self.running_background -= job.background
+        self._cond.notify()
+
+    def _execute(self, job):
+        try:
+            result = profiled(job.func)()
+        except Exception as e:
+            if is_retryable_error(e) and job.attempt < self.max_retries:
+                self._schedule_retry(job, e)
+            else:
+                with self._cond:
+                    self._stopped(job)
+                    self.failures += 1
+                job.future.set_exception(e)
+            return
+        except BaseException as e:
+            # E.g. SystemExit in this worker: whoever waits for the job must not hang
+            with self._cond:
+                self._stopped(job)
+                self.failures += 1
+            job.future.set_exception(e)
+            raise
+
+        with self._cond:
+            self._stopped(job)
+            self.completed += 1
+        job.future.set_result(result)
+
+    def _schedule_retry(self, job, error):
+        if is_rate_limit_error(error):
+            self.bucket.drain()
+        delay = min(self.max_delay, self.base_delay * 2**job.attempt)
+        delay *= random.uniform(0.5, 1.5)
+        job.attempt += 1
+        print(f"Retrying fetch in {delay:.1f}s (attempt {job.attempt}): {str(error)}")
+
+        with self._cond:
+            self._stopped(job)
+            self.retries += 1
+            if job.key is not None:
+                self._queued[job.key] = job
+            heapq.heappush(
+                self._delayed, (time.monotonic() + delay, next(self._seq), job)
+            )
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            queued = {name: 0 for name in PRIORITY_NAMES.values()}
+            for entry in self._heap:
+                if entry is entry[2].entry:
+                    queued[PRIORITY_NAMES[entry[0]]] += 1
+            return {
+                **{f"queued_{name}": count for name, count in queued.items()},
+                "waiting_for_retry": len(self._delayed),
+                "running": self.running,
+                "running_background": self.running_background,
+                "completed": self.completed,
+                "retries": self.retries,
+                "failures": self.failures,
+                "tokens_available": round(self.bucket.available(), 2),
+            }
+
+
+def set_api_key_quota(has_api_key=True):
+    """Switch the request rate to the quota of registered (or anonymous) users."""
+    fetch_scheduler.bucket.set_rate(
+        API_KEY_REQUESTS_PER_HOUR if has_api_key else ANONYMOUS_REQUESTS_PER_HOUR
+    )
+
+
+fetch_scheduler = FetchScheduler(
+    TokenBucket(
+        API_KEY_REQUESTS_PER_HOUR
+        if os.environ.get("DELPHI_EPIDATA_KEY")
+        else ANONYMOUS_REQUESTS_PER_HOUR,
+        BURST,
+    ),
+    workers=int(os.environ.get("EPIDATA_FETCH_WORKERS", 2)),
+    interactive_reserve=int(os.environ.get("EPIDATA_INTERACTIVE_RESERVE", 2)),
+)
+
+register_metrics("fetch_scheduler", fetch_scheduler.stats)
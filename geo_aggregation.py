@@ -0,0 +1,254 @@
+"""
+Aggregation of county-level signals to coarser geographies.
+
+Instead of fetching every geo_type of a signal separately, state, MSA, HHS and
+national series can be computed from the county data of the same signal (a single
+bulk fetch, see signal_store). A sparse region x county weight matrix is built from
+the mappings in geo_codes (fips2county.tsv for states and MSAs, hhs_region_by_state
+for HHS regions), and all regions and dates are computed with one sparse matrix
+product:
+
+- count signals ("_num") are summed over the counties of a region;
+- all other signals (proportions, percentages) are averaged weighted by county
+  population, over the counties that have a value on that date.
+
+Megacounties (fips "XX000", the counties of a state below a source's reporting
+threshold) count towards their state, HHS region and the nation, but have no
+population and so only enter sums. HRRs are not derived: the tree maps ZIP codes,
+not counties, to HRRs.
+
+The results follow the sources' own aggregation only approximately (sources may
+aggregate from finer data or use other populations); compare_aggregates reports
+the differences against the API's aggregates.
+"""
+
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from geo_codes import fips_df, hhs_region_by_state, msa_to_display
+from instrumentation import register_metrics, span
+
+DERIVABLE_GEO_TYPES = ("state", "msa", "hhs", "nation")
+
+# Columns describing the whole series, carried over to the aggregated frame
+_SERIES_COLUMNS = ["source", "signal", "time_type"]
+
+_county_state = dict(zip(fips_df["CountyFIPS"], fips_df["StateAbbr"].str.lower()))
+_state_by_fips = dict(zip(fips_df["StateFIPS"], fips_df["StateAbbr"].str.lower()))
+_county_msa = {
+    county: cbsa
+    for county, cbsa in zip(fips_df["CountyFIPS"], fips_df["CountyCBSA"])
+    if cbsa in msa_to_display
+}
+
+
+class _Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.aggregations = 0
+        self.aggregate_s = 0.0
+        self.comparisons = 0
+        self.last_median_rel_diff = 0.0
+        self.last_p95_rel_diff = 0.0
+
+    def __call__(self):
+        with self._lock:
+            return {
+                "aggregations": self.aggregations,
+                "aggregate_s": round(self.aggregate_s, 3),
+                "comparisons": self.comparisons,
+                "last_median_rel_diff": self.last_median_rel_diff,
+                "last_p95_rel_diff": self.last_p95_rel_diff,
+            }
+
+
+_stats = _Stats()
+register_metrics("geo_aggregation", _stats)
+
+
+def is_count_signal(signal):
+    """Whether a signal counts events (summed) rather than measuring a rate (averaged)."""
+    return "_num" in signal
+
+
+def county_region(geo_type, county):
+    """The geo_value of the region of `geo_type` containing a county, or None."""
+    if county.endswith("000"):
+        # Megacounty: the rest of a state
+        state = _state_by_fips.get(county[:2])
+        if geo_type == "msa":
+            return None
+    else:
+        state = _county_state.get(county)
+    if geo_type == "state":
+        return state
+    if geo_type == "hhs":
+        return hhs_region_by_state.get(state)
+    if geo_type == "nation":
+        return "us" if state is not None else None
+    if geo_type == "msa":
+        return _county_msa.get(county)
+    raise ValueError(f"Cannot aggregate counties to {geo_type}")
+
+
+def weight_matrix(geo_type, counties, weights=None):
+    """
+    Sparse matrix mapping county values to region values.
+
+    Args:
+        geo_type: Target geo_type, one of DERIVABLE_GEO_TYPES
+        counties: County fips codes (the columns)
+        weights: Optional pd.Series of weights by fips (e.g. population);
+            counties without a weight get 0. Default: 1 for every county.
+
+    Returns:
+        tuple: (scipy.sparse.csr_matrix of shape regions x counties, list of the
+            regions' geo_values)
+    """
+    regions = {}
+    rows, cols, values = [], [], []
+    for col, county in enumerate(counties):
+        region = county_region(geo_type, county)
+        if region is None:
+            continue
+        weight = 1.0 if weights is None else float(weights.get(county, 0.0))
+        if not weight > 0:
+            continue
+        rows.append(regions.setdefault(region, len(regions)))
+        cols.append(col)
+        values.append(weight)
+    matrix = sparse.csr_matrix(
+        (values, (rows, cols)), shape=(len(regions), len(counties))
+    )
+    return matrix, list(regions)
+
+
+def aggregate_counties(county_df, geo_type, population=None, geo_values=None):
+    """
+    Compute a signal for coarser regions from its county-level data.
+
+    Args:
+        county_df: County data as returned by fetch_covidcast_data (geo_value,
+            time_value, value, ...)
+        geo_type: Target geo_type, one of DERIVABLE_GEO_TYPES
+        population: pd.Series of population by county fips; required unless the
+            signal is a count signal
+        geo_values: Optional list of the regions to return (default: all)
+
+    Returns:
+        pd.DataFrame: geo_type, geo_value, time_value, value and the source,
+            signal and time_type columns of `county_df`, one row per region and
+            date with data
+    """
+    start = time.perf_counter()
+    signal = county_df["signal"].iloc[0]
+    count = is_count_signal(signal)
+    if not count and population is None:
+        raise ValueError(f"Aggregating {signal} requires county populations")
+
+    with span("geo_aggregation.aggregate"):
+        county_codes, counties = pd.factorize(county_df["geo_value"].astype(str))
+        date_codes, dates = pd.factorize(county_df["time_value"])
+        values = np.full((len(counties), len(dates)), np.nan)
+        values[county_codes, date_codes] = county_df["value"].to_numpy(dtype=float)
+        present = ~np.isnan(values)
+
+        matrix, regions = weight_matrix(
+            geo_type, counties, weights=None if count else population
+        )
+        # Weighted sums of the values and of the weights present, in one product
+        products = matrix @ np.hstack([np.where(present, values, 0.0), present])
+        totals, coverage = np.hsplit(products, 2)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            result = totals if count else totals / coverage
+        result[coverage == 0] = np.nan
+
+    df = pd.DataFrame(result, index=pd.Index(regions, name="geo_value"), columns=dates)
+    if geo_values is not None:
+        df = df.reindex([value for value in geo_values if value in df.index])
+    df = (
+        df.rename_axis(columns="time_value")
+        .stack()
+        .rename("value")
+        .reset_index()
+        .sort_values(["geo_value", "time_value"], ignore_index=True)
+    )
+    df.insert(0, "geo_type", geo_type)
+    for column in _SERIES_COLUMNS:
+        if column in county_df:
+            df[column] = county_df[column].iloc[0]
+
+    with _stats._lock:
+        _stats.aggregations += 1
+        _stats.aggregate_s += time.perf_counter() - start
+    return df
+
+
+def estimate_population(num_df, prop_df):
+    """
+    County populations implied by a count signal and its per-100,000 proportion
+    (e.g. jhu-csse confirmed_cumulative_num and confirmed_cumulative_prop).
+
+    Returns:
+        pd.Series: Population by county fips, for the counties with a nonzero value
+    """
+    merged = pd.merge(
+        num_df[["geo_value", "time_value", "value"]],
+        prop_df[["geo_value", "time_value", "value"]],
+        on=["geo_value", "time_value"],
+        suffixes=("_num", "_prop"),
+    )
+    merged = merged[(merged["value_num"] > 0) & (merged["value_prop"] > 0)]
+    population = merged["value_num"] / merged["value_prop"] * 100000
+    return population.groupby(merged["geo_value"].astype(str)).median().round()
+
+
+def load_population(path):
+    """County populations from a CSV file with "fips" and "population" columns."""
+    df = pd.read_csv(path, dtype={"fips": str})
+    return df.set_index(df["fips"].str.zfill(5))["population"].astype(float)
+
+
+def compare_aggregates(derived_df, api_df):
+    """
+    Differences between locally aggregated values and the API's aggregates.
+
+    Args:
+        derived_df: Result of aggregate_counties
+        api_df: The same signal and geo_type as fetched from the API
+
+    Returns:
+        tuple: (pd.DataFrame with geo_value, time_value, derived, api, abs_diff and
+            rel_diff per region and date, dict summary with the number of rows
+            compared, missing on either side, and the median, 95th percentile and
+            maximum relative difference)
+    """
+    merged = pd.merge(
+        derived_df[["geo_value", "time_value", "value"]].rename(
+            columns={"value": "derived"}
+        ),
+        api_df[["geo_value", "time_value", "value"]].rename(columns={"value": "api"}),
+        on=["geo_value", "time_value"],
+        how="outer",
+    )
+    merged["abs_diff"] = (merged["derived"] - merged["api"]).abs()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        merged["rel_diff"] = merged["abs_diff"] / merged["api"].abs()
+    rel_diff = merged["rel_diff"].replace(np.inf, np.nan).dropna()
+    summary = {
+        "rows": int(merged[["derived", "api"]].notna().all(axis=1).sum()),
+        "only_derived": int(merged["api"].isna().sum()),
+        "only_api": int(merged["derived"].isna().sum()),
+        "median_rel_diff": float(rel_diff.median()) if len(rel_diff) else 0.0,
+        "p95_rel_diff": float(rel_diff.quantile(0.95)) if len(rel_diff) else 0.0,
+        "max_rel_diff": float(rel_diff.max()) if len(rel_diff) else 0.0,
+    }
+    with _stats._lock:
+        _stats.comparisons += 1
+        _stats.last_median_rel_diff = round(summary["median_rel_diff"], 4)
+        _stats.last_p95_rel_diff = round(summary["p95_rel_diff"], 4)
+    return merged.sort_values(["geo_value", "time_value"], ignore_index=True), summary
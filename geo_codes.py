@@ -1,5 +1,8 @@
 # State and county FIPS codes from: https://github.com/ChuckConnell/articles/blob/master/fips2county.tsv
 
+import os
+from functools import lru_cache
+
 import pandas as pd
 
 # The following geography types are supported by the COVIDcast API:
@@ -81,6 +84,23 @@ hss_region_to_display = {
 }
 display_to_hss_region = {v: k for k, v in hss_region_to_display.items()}
 
+hhs_region_by_state = {
+    state: region
+    for region, states in {
+        "1": ["ct", "me", "ma", "nh", "ri", "vt"],
+        "2": ["nj", "ny", "pr", "vi"],
+        "3": ["de", "dc", "md", "pa", "va", "wv"],
+        "4": ["al", "fl", "ga", "ky", "ms", "nc", "sc", "tn"],
+        "5": ["il", "in", "mi", "mn", "oh", "wi"],
+        "6": ["ar", "la", "nm", "ok", "tx"],
+        "7": ["ia", "ks", "mo", "ne"],
+        "8": ["co", "mt", "nd", "sd", "ut", "wy"],
+        "9": ["az", "ca", "hi", "nv", "as", "gu", "mp"],
+        "10": ["ak", "id", "or", "wa"],
+    }.items()
+    for state in states
+}
+
 # Metropolitan Statistical Areas
 msa_to_display = {row["MSA code"]: row["MSA name"] for _, row in msa_df.iterrows()}
 display_to_msa = {v: k for k, v in msa_to_display.items()}
@@ -90,3 +110,71 @@ msa_by_state = msa_df.groupby("State")["MSA name"].apply(list).to_dict()
 # Designated Market Areas
 # Designated Market Areas (DMAs) are proprietary information released by Nielsen. The subscription to this data costs $8000.
 # So we don't include it in the app.
+
+
+def regions_in_state(geo_type, state_display):
+    """geo_values of the counties, HRRs or MSAs of a state (by its display name)."""
+    if geo_type == "county":
+        return list(fips_df.loc[fips_df["StateName"] == state_display, "CountyFIPS"])
+    if geo_type == "hrr":
+        return [display_to_hrr[hrr] for hrr in hrr_by_state.get(state_display, [])]
+    if geo_type == "msa":
+        return [display_to_msa[msa] for msa in msa_by_state.get(state_display, [])]
+    raise ValueError(f"Invalid geo_type for regions in a state: {geo_type}")
+
+
+def region_to_display(geo_type, geo_value):
+    """Display name of a geo_value, or the geo_value itself if it is unknown."""
+    names = {
+        "nation": nation_to_display,
+        "state": state_abbrvs_to_display,
+        "county": county_fips_to_display,
+        "hrr": hrr_to_display,
+        "hhs": hss_region_to_display,
+        "msa": msa_to_display,
+    }.get(geo_type, {})
+    return names.get(geo_value, geo_value)
+
+
+# Boundaries for maps of counties, MSAs and HRRs, as (file or URL, id column).
+# States and HHS regions are drawn with Plotly's built-in state outlines.
+# HRR boundaries are published by the Dartmouth Atlas and have to be downloaded
+# separately.
+BOUNDARY_FILES = {
+    "county": (
+        os.environ.get(
+            "COUNTY_BOUNDARIES",
+            "https://www2.census.gov/geo/tiger/GENZ2019/shp/cb_2019_us_county_20m.zip",
+        ),
+        "GEOID",
+    ),
+    "msa": (
+        os.environ.get(
+            "MSA_BOUNDARIES",
+            "https://www2.census.gov/geo/tiger/GENZ2019/shp/cb_2019_us_cbsa_20m.zip",
+        ),
+        "GEOID",
+    ),
+    "hrr": (os.environ.get("HRR_BOUNDARIES", ""), "HRRNUM"),
+}
+
+
+@lru_cache(maxsize=None)
+def load_boundaries(geo_type):
+    """
+    GeoJSON of the regions of a geo_type, with their geo_value as feature id.
+
+    Returns None if no boundary file is configured for the geo_type.
+    """
+    path, id_column = BOUNDARY_FILES.get(geo_type, ("", None))
+    if not path:
+        return None
+    import geopandas as gpd
+
+    regions = gpd.read_file(path).to_crs(epsg=4326)
+    regions["id"] = regions[id_column].astype(str)
+    if geo_type == "county":
+        regions["id"] = regions["id"].str.zfill(5)
+    # The maps are small; simplified outlines keep the figures light
+    regions["geometry"] = regions.simplify(0.01)
+    return regions[["id", "geometry"]].set_index("id").__geo_interface__
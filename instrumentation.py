@@ -0,0 +1,329 @@
+"""
+Timing spans for the app's hot paths (network fetches, rpy2 conversion, R calls
+and Plotly figure building).
+
+Spans are aggregated per process and, when running inside a Streamlit script,
+per session. The aggregates can be shown in an optional "Performance" expander
+(set SHOW_PERFORMANCE_PANEL=1) and exported periodically as Prometheus
+text-format and JSONL files (set METRICS_EXPORT_DIR, and optionally
+METRICS_EXPORT_INTERVAL in seconds).
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+SESSION_STATE_KEY = "_performance_spans"
+METRIC_PREFIX = "covid_hub"
+
+_lock = threading.Lock()
+_process_spans = {}  # span name -> {"count", "total_s", "max_s", "last_s"}
+_metric_sources = {}  # metric group -> callable returning {name: number}
+_process_start = time.time()
+
+
+def _env_flag(name):
+    return os.environ.get(name, "").strip().lower() in ("1", "true", "yes")
+
+
+def _update_stats(stats, name, elapsed):
+    entry = stats.get(name)
+    if entry is None:
+        entry = stats[name] = {"count": 0, "total_s": 0.0, "max_s": 0.0, "last_s": 0.0}
+    entry["count"] += 1
+    entry["total_s"] += elapsed
+    entry["max_s"] = max(entry["max_s"], elapsed)
+    entry["last_s"] = elapsed
+
+
+def _session_spans():
+    # Background threads and headless callers have no script context,
+    # so only the process-wide aggregate is updated for them.
+    if get_script_run_ctx(suppress_warning=True) is None:
+        return None
+    if SESSION_STATE_KEY not in st.session_state:
+        st.session_state[SESSION_STATE_KEY] = {}
+    return st.session_state[SESSION_STATE_KEY]
+
+
+def record_span(name, elapsed):
+    """Add a single measurement (in seconds) to the process and session aggregates."""
+    with _lock:
+        _update_stats(_process_spans, name, elapsed)
+    session = _session_spans()
+    if session is not None:
+        _update_stats(session, name, elapsed)
+
+
+@contextmanager
+def span(name):
+    """
+    Time the enclosed block and record it under `name`.
+
+    Failed blocks are recorded as well, so slow errors (e.g. timeouts) stay visible.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+
+
+def timed(name=None):
+    """Decorator version of `span`; defaults to the function's name."""
+
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def register_metrics(group, get_values):
+    """
+    Register a callable returning a flat {name: number} dict (e.g. cache counters).
+
+    The values are shown in the Performance panel and exported as
+    `covid_hub_<group>_<name>` metrics.
+    """
+    with _lock:
+        _metric_sources[group] = get_values
+
+
+def get_metrics():
+    with _lock:
+        sources = dict(_metric_sources)
+    return {group: get_values() for group, get_values in sorted(sources.items())}
+
+
+def get_process_spans():
+    with _lock:
+        return {name: dict(entry) for name, entry in _process_spans.items()}
+
+
+def get_session_spans():
+    session = _session_spans()
+    return {} if session is None else {k: dict(v) for k, v in session.items()}
+
+
+def spans_to_dataframe(spans):
+    """Summarise span aggregates as a DataFrame sorted by total time."""
+    rows = [
+        {
+            "span": name,
+            "calls": entry["count"],
+            "total (s)": entry["total_s"],
+            "mean (s)": entry["total_s"] / entry["count"],
+            "max (s)": entry["max_s"],
+            "last (s)": entry["last_s"],
+        }
+        for name, entry in spans.items()
+    ]
+    columns = ["span", "calls", "total (s)", "mean (s)", "max (s)", "last (s)"]
+    df = pd.DataFrame(rows, columns=columns)
+    return df.sort_values("total (s)", ascending=False).reset_index(drop=True)
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def to_prometheus_text(spans=None):
+    """Render the process-wide span aggregates in Prometheus text exposition format."""
+    spans = get_process_spans() if spans is None else spans
+    metric = f"{METRIC_PREFIX}_span_duration_seconds"
+    lines = [
+        f"# HELP {metric} Wall-clock time spent in instrumented spans.",
+        f"# TYPE {metric} summary",
+    ]
+    for name, entry in sorted(spans.items()):
+        label = f'span="{_escape_label(name)}"'
+        lines.append(f"{metric}_sum{{{label}}} {entry['total_s']:.6f}")
+        lines.append(f"{metric}_count{{{label}}} {entry['count']}")
+
+    lines += [
+        f"# HELP {metric}_max Longest single duration observed for each span.",
+        f"# TYPE {metric}_max gauge",
+    ]
+    for name, entry in sorted(spans.items()):
+        label = f'span="{_escape_label(name)}"'
+        lines.append(f"{metric}_max{{{label}}} {entry['max_s']:.6f}")
+
+    for group, values in get_metrics().items():
+        for name, value in values.items():
+            metric_name = f"{METRIC_PREFIX}_{group}_{name}"
+            lines += [f"# TYPE {metric_name} untyped", f"{metric_name} {value}"]
+
+    lines += [
+        f"# HELP {METRIC_PREFIX}_process_start_time_seconds Start time of the process.",
+        f"# TYPE {METRIC_PREFIX}_process_start_time_seconds gauge",
+        f"{METRIC_PREFIX}_process_start_time_seconds {_process_start:.3f}",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def export_prometheus(path):
+    """Atomically write the Prometheus text file (suitable for a textfile collector)."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(to_prometheus_text())
+    os.replace(tmp_path, path)
+
+
+def export_jsonl(path):
+    """Append one JSON line per span and per metric group with the current process-wide values."""
+    timestamp = time.time()
+    with open(path, "a") as f:
+        for name, entry in sorted(get_process_spans().items()):
+            record = {"timestamp": timestamp, "pid": os.getpid(), "span": name, **entry}
+            f.write(json.dumps(record) + "\n")
+        for group, values in get_metrics().items():
+            record = {"timestamp": timestamp, "pid": os.getpid(), "metrics": group, **values}
+            f.write(json.dumps(record) + "\n")
+
+
+def _export_loop(directory, interval):
+    prom_path = os.path.join(directory, f"{METRIC_PREFIX}_{os.getpid()}.prom")
+    jsonl_path = os.path.join(directory, f"{METRIC_PREFIX}_spans.jsonl")
+    while True:
+        time.sleep(interval)
+        try:
+            export_prometheus(prom_path)
+            export_jsonl(jsonl_path)
+        except OSError as e:
+            print(f"Error exporting metrics: {str(e)}")
+
+
+def start_metrics_exporter():
+    """Start the periodic exporter thread if METRICS_EXPORT_DIR is set (once per process)."""
+    directory = os.environ.get("METRICS_EXPORT_DIR")
+    if not directory or getattr(start_metrics_exporter, "_started", False):
+        return
+    os.makedirs(directory, exist_ok=True)
+    interval = float(os.environ.get("METRICS_EXPORT_INTERVAL", "15"))
+    threading.Thread(
+        target=_export_loop, args=(directory, interval), daemon=True, name="metrics-exporter"
+    ).start()
+    start_metrics_exporter._started = True
+
+
+_chart_payloads = {}  # chart name -> {"count", "last_points", "max_points", "total_points"}
+TRACE_DATA_ATTRIBUTES = ("x", "y", "z", "lat", "lon", "locations", "values")
+
+
+def _figure_points(fig):
+    """Data points in the traces of a figure, without serializing it."""
+    points = 0
+    for trace in fig.data:
+        points += max(
+            (
+                np.size(value)
+                for value in (getattr(trace, name, None) for name in TRACE_DATA_ATTRIBUTES)
+                if value is not None
+            ),
+            default=0,
+        )
+    return points
+
+
+def plotly_chart(fig, name, container=None, **kwargs):
+    """
+    st.plotly_chart that records the size of the figure sent to the browser.
+
+    The size is counted in data points of the figure's traces, which the payload
+    (the figure's JSON) grows with, and reported as the `plot_payloads` metrics;
+    the time spent serializing and sending it is the `plot.send.<name>` span. How
+    long the browser takes to draw the figure cannot be observed from here; the
+    payload size is what drives it.
+
+    Args:
+        fig: Plotly figure
+        name: Short name of the chart in the metrics
+        container: Streamlit container to draw into (default: st)
+        **kwargs: Passed to plotly_chart
+    """
+    points = _figure_points(fig)
+    with _lock:
+        entry = _chart_payloads.setdefault(
+            name, {"count": 0, "last_points": 0, "max_points": 0, "total_points": 0}
+        )
+        entry["count"] += 1
+        entry["last_points"] = points
+        entry["max_points"] = max(entry["max_points"], points)
+        entry["total_points"] += points
+    with span(f"plot.send.{name}"):
+        return (container or st).plotly_chart(fig, **kwargs)
+
+
+def _chart_payload_metrics():
+    with _lock:
+        return {
+            f"{name}_{field}": value
+            for name, entry in sorted(_chart_payloads.items())
+            for field, value in entry.items()
+        }
+
+
+register_metrics("plot_payloads", _chart_payload_metrics)
+
+
+def render_performance_panel():
+    """Show the "Performance" expander at the bottom of a page, if enabled."""
+    if not _env_flag("SHOW_PERFORMANCE_PANEL"):
+        return
+
+    with st.expander("⏱️ Performance"):
+        col1, col2 = st.columns(2)
+        with col1:
+            st.markdown("**This session**")
+            st.dataframe(
+                spans_to_dataframe(get_session_spans()),
+                hide_index=True,
+                use_container_width=True,
+            )
+            if st.button("Reset session timings", key="reset_performance_spans"):
+                st.session_state[SESSION_STATE_KEY] = {}
+        with col2:
+            st.markdown("**This server process**")
+            st.dataframe(
+                spans_to_dataframe(get_process_spans()),
+                hide_index=True,
+                use_container_width=True,
+            )
+        metrics = get_metrics()
+        if metrics:
+            st.markdown("**Caches and queues**")
+            st.dataframe(
+                pd.DataFrame(
+                    [
+                        {"group": group, "metric": name, "value": value}
+                        for group, values in metrics.items()
+                        for name, value in values.items()
+                    ]
+                ),
+                hide_index=True,
+                use_container_width=True,
+            )
+        st.download_button(
+            "Download Prometheus metrics",
+            data=to_prometheus_text(),
+            file_name=f"{METRIC_PREFIX}_metrics.prom",
+            mime="text/plain",
+        )
+
+
+start_metrics_exporter()
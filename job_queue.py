@@ -0,0 +1,275 @@
+"""
+Persistent local job queue for heavy correlation and forecasting work.
+
+Jobs are stored in a SQLite database (JOB_QUEUE_DB) and run by a separate worker
+process (see worker.py), so they keep running when the browser tab is closed or
+the Streamlit script that submitted them is interrupted. Pages submit jobs and
+poll their status.
+
+A job is identified by a content key: a hash of its kind, its parameters and the
+content of its input frames. Submitting a job that is already queued, running or
+done returns the existing job, so identical work is only done once and finished
+results are picked up again after a reload. Failed and cancelled jobs are queued
+again when resubmitted.
+
+Enable it with JOB_QUEUE_ENABLED=1 and run `python worker.py` next to the app.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import time
+
+from data_cache import frame_fingerprint
+from instrumentation import register_metrics
+
+JOB_QUEUE_ENABLED = os.environ.get("JOB_QUEUE_ENABLED", "").strip().lower() in (
+    "1",
+    "true",
+    "yes",
+)
+JOB_QUEUE_DB = os.environ.get("JOB_QUEUE_DB", os.path.join("jobs", "jobs.sqlite"))
+# Running jobs without a heartbeat for this long are assumed to have lost their worker
+HEARTBEAT_TIMEOUT_S = float(os.environ.get("JOB_HEARTBEAT_TIMEOUT_SECONDS", 120))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    result BLOB,
+    partial TEXT,
+    progress REAL NOT NULL DEFAULT 0,
+    error TEXT,
+    worker TEXT,
+    submitted_at REAL NOT NULL,
+    started_at REAL,
+    heartbeat_at REAL,
+    finished_at REAL
+)
+"""
+
+
+def _connect():
+    directory = os.path.dirname(JOB_QUEUE_DB)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # Autocommit mode; transactions are started explicitly where needed
+    connection = sqlite3.connect(JOB_QUEUE_DB, timeout=30, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(_SCHEMA)
+    return connection
+
+
+def job_key(kind, frames, params):
+    """Content key of a job: its kind, parameters and the content of its input frames."""
+    digest = hashlib.sha1(kind.encode())
+    for name in sorted(frames):
+        digest.update(f"{name}={frame_fingerprint(frames[name])}".encode())
+    digest.update(repr(sorted(params.items())).encode())
+    return digest.hexdigest()
+
+
+def submit_job(kind, frames, **params):
+    """
+    Queue a job unless an identical one is already queued, running or done.
+
+    Args:
+        kind: Name of the job handler in worker.JOB_HANDLERS
+        frames: Dict of input DataFrames
+        **params: Picklable parameters passed to the handler
+
+    Returns:
+        str: The job's key, to be passed to get_job
+    """
+    key = job_key(kind, frames, params)
+    payload = pickle.dumps({"frames": frames, "params": params})
+    connection = _connect()
+    try:
+        connection.execute(
+            "INSERT OR IGNORE INTO jobs (key, kind, status, payload, submitted_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (key, kind, QUEUED, payload, time.time()),
+        )
+        connection.execute(
+            "UPDATE jobs SET status = ?, error = NULL, submitted_at = ? "
+            "WHERE key = ? AND status IN (?, ?)",
+            (QUEUED, time.time(), key, FAILED, CANCELLED),
+        )
+    finally:
+        connection.close()
+    return key
+
+
+def get_job(key, with_result=True):
+    """
+    Status of a job as a dict (kind, status, progress, partial, error, result), or None.
+
+    `partial` holds intermediate results reported by the worker; `result` is only
+    set once the job is done.
+    """
+    connection = _connect()
+    try:
+        row = connection.execute(
+            "SELECT kind, status, progress, partial, error, "
+            + ("result " if with_result else "NULL AS result ")
+            + "FROM jobs WHERE key = ?",
+            (key,),
+        ).fetchone()
+    finally:
+        connection.close()
+    if row is None:
+        return None
+    return {
+        "key": key,
+        "kind": row["kind"],
+        "status": row["status"],
+        "progress": row["progress"],
+        "partial": None if row["partial"] is None else json.loads(row["partial"]),
+        "error": row["error"],
+        "result": None if row["result"] is None else pickle.loads(row["result"]),
+    }
+
+
+def cancel_job(key):
+    """Cancel a queued or running job; a running job stops at its next heartbeat."""
+    connection = _connect()
+    try:
+        connection.execute(
+            "UPDATE jobs SET status = ?, finished_at = ? WHERE key = ? AND status IN (?, ?)",
+            (CANCELLED, time.time(), key, QUEUED, RUNNING),
+        )
+    finally:
+        connection.close()
+
+
+def claim_job(worker):
+    """
+    Mark the oldest queued job as running for `worker` and return it, or None.
+
+    Running jobs whose worker stopped sending heartbeats are queued again first.
+    """
+    connection = _connect()
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        now = time.time()
+        connection.execute(
+            "UPDATE jobs SET status = ? WHERE status = ? AND heartbeat_at < ?",
+            (QUEUED, RUNNING, now - HEARTBEAT_TIMEOUT_S),
+        )
+        row = connection.execute(
+            "SELECT key, kind, payload, partial FROM jobs WHERE status = ? "
+            "ORDER BY submitted_at LIMIT 1",
+            (QUEUED,),
+        ).fetchone()
+        if row is not None:
+            connection.execute(
+                "UPDATE jobs SET status = ?, worker = ?, started_at = ?, heartbeat_at = ? "
+                "WHERE key = ?",
+                (RUNNING, worker, now, now, row["key"]),
+            )
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+    finally:
+        connection.close()
+    if row is None:
+        return None
+    payload = pickle.loads(row["payload"])
+    return {
+        "key": row["key"],
+        "kind": row["kind"],
+        "worker": worker,
+        "frames": payload["frames"],
+        "params": payload["params"],
+        "partial": None if row["partial"] is None else json.loads(row["partial"]),
+    }
+
+
+def heartbeat(key, worker, progress=None, partial=None):
+    """
+    Record that `worker` is still running a job (and optionally its progress and
+    partial results, which must be JSON-serializable).
+
+    Returns:
+        bool: Whether the job is still running for `worker`. False if it has been
+            cancelled, or was queued again after missing heartbeats and may now be
+            run by another worker; the worker should then stop working on it.
+    """
+    connection = _connect()
+    try:
+        updated = connection.execute(
+            "UPDATE jobs SET heartbeat_at = ?, progress = COALESCE(?, progress), "
+            "partial = COALESCE(?, partial) WHERE key = ? AND status = ? AND worker = ?",
+            (
+                time.time(),
+                progress,
+                None if partial is None else json.dumps(partial),
+                key,
+                RUNNING,
+                worker,
+            ),
+        ).rowcount
+    finally:
+        connection.close()
+    return updated > 0
+
+
+def complete_job(key, worker, result):
+    """Store the result of a job; returns False if it no longer runs for `worker`."""
+    return _finish(key, worker, DONE, result=pickle.dumps(result))
+
+
+def fail_job(key, worker, error):
+    """Mark a job as failed; returns False if it no longer runs for `worker`."""
+    return _finish(key, worker, FAILED, error=str(error))
+
+
+def _finish(key, worker, status, result=None, error=None):
+    connection = _connect()
+    try:
+        updated = connection.execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, progress = COALESCE(?, progress), "
+            "finished_at = ? WHERE key = ? AND status = ? AND worker = ?",
+            (
+                status,
+                result,
+                error,
+                1.0 if status == DONE else None,
+                time.time(),
+                key,
+                RUNNING,
+                worker,
+            ),
+        ).rowcount
+    finally:
+        connection.close()
+    return updated > 0
+
+
+def stats():
+    connection = _connect()
+    try:
+        rows = connection.execute(
+            "SELECT status, COUNT(*) AS count FROM jobs GROUP BY status"
+        ).fetchall()
+    finally:
+        connection.close()
+    counts = {status: 0 for status in (QUEUED, RUNNING, DONE, FAILED, CANCELLED)}
+    counts.update({row["status"]: row["count"] for row in rows})
+    return counts
+
+
+if JOB_QUEUE_ENABLED:
+    register_metrics("job_queue", stats)
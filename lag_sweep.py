@@ -0,0 +1,255 @@
+"""
+Background lag sweeps for the "Calculate best time lag" button.
+
+A sweep computes the correlation between two signals for every lag in
+[-max_lag, max_lag] in a background thread, starting with the lags nearest to 0,
+so the page stays responsive and can show partial results while it runs.
+
+Sweeps are kept in a process-wide registry keyed by the content of the signals and
+the sweep parameters, which doubles as a result cache: a rerun of the page (or
+another session asking for the same sweep) picks up the running or finished sweep
+instead of starting over. A cancelled sweep keeps the lags computed so far and
+resumes from there when it is started again.
+
+With JOB_QUEUE_ENABLED=1, sweeps are run by the worker process instead (see
+job_queue), so they survive reloads and restarts of the app; QueuedLagSweep reads
+them back from the queue with the same interface as LagSweep.
+
+Lags answered by the correlation atlas are passed in as known results and are not
+computed again.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+from analysis_tools import iter_lag_correlations
+from data_cache import frame_fingerprint
+from instrumentation import register_metrics, span
+from profiling import profiled
+from job_queue import (
+    JOB_QUEUE_ENABLED,
+    CANCELLED,
+    DONE,
+    FAILED,
+    QUEUED,
+    RUNNING,
+    cancel_job,
+    get_job,
+    job_key,
+    submit_job,
+)
+
+MAX_SWEEPS = int(os.environ.get("LAG_SWEEP_CACHE_SIZE", 32))
+
+
+def lag_order(max_lag):
+    """Lags in [-max_lag, max_lag], nearest to 0 first (negative before positive)."""
+    return sorted(range(-max_lag, max_lag + 1), key=lambda lag: (abs(lag), lag))
+
+
+class LagSweep:
+    def __init__(self, df1, df2, cor_by, max_lag, method):
+        self.df1 = df1
+        self.df2 = df2
+        self.cor_by = cor_by
+        self.max_lag = max_lag
+        self.method = method
+        self.results = {}  # lag -> correlation
+        self.error = None
+        self._cancel = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def total(self):
+        return 2 * self.max_lag + 1
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def done(self):
+        return len(self.results) == self.total
+
+    def cancelled(self):
+        return self._cancel.is_set() and not self.running()
+
+    def start(self):
+        """Start (or resume) computing the missing lags; no-op if running or done."""
+        with self._lock:
+            if self.running() or self.done():
+                return
+            self._cancel.clear()
+            self.error = None
+            self._thread = threading.Thread(
+                target=profiled(self._run), daemon=True, name="lag-sweep"
+            )
+            self._thread.start()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def _run(self):
+        lags = [lag for lag in lag_order(self.max_lag) if lag not in self.results]
+        try:
+            with span("lag_sweep.run"):
+                for lag, cor in iter_lag_correlations(
+                    self.df1, self.df2, self.cor_by, lags, self.method
+                ):
+                    self.results[lag] = cor
+                    if self._cancel.is_set():
+                        break
+        except Exception as e:
+            self.error = e
+            print(f"Error: {str(e)}")
+
+    def snapshot(self):
+        """The correlations computed so far, sorted by lag."""
+        results = dict(self.results)
+        return {lag: results[lag] for lag in sorted(results)}
+
+    def best(self):
+        """(lag, correlation) with the highest correlation so far, or (None, None)."""
+        results = dict(self.results)
+        if not results:
+            return None, None
+        lag = max(results, key=results.get)
+        return lag, results[lag]
+
+
+class QueuedLagSweep:
+    """A lag sweep run by the job queue worker, read back on every access."""
+
+    def __init__(self, key, max_lag):
+        self.key = key
+        self.max_lag = max_lag
+
+    @property
+    def total(self):
+        return 2 * self.max_lag + 1
+
+    def _job(self):
+        return get_job(self.key, with_result=False) or {
+            "status": CANCELLED,
+            "partial": None,
+            "error": None,
+        }
+
+    @property
+    def results(self):
+        partial = self._job()["partial"] or {}
+        return {int(lag): cor for lag, cor in partial.items()}
+
+    @property
+    def error(self):
+        job = self._job()
+        return job["error"] if job["status"] == FAILED else None
+
+    def running(self):
+        return self._job()["status"] in (QUEUED, RUNNING)
+
+    def done(self):
+        return self._job()["status"] == DONE
+
+    def cancelled(self):
+        return self._job()["status"] == CANCELLED
+
+    def cancel(self):
+        cancel_job(self.key)
+
+    def snapshot(self):
+        results = self.results
+        return {lag: results[lag] for lag in sorted(results)}
+
+    def best(self):
+        results = self.results
+        if not results:
+            return None, None
+        lag = max(results, key=results.get)
+        return lag, results[lag]
+
+
+def _job_params(cor_by, max_lag, method):
+    return {"cor_by": cor_by, "max_lag": max_lag, "method": method}
+
+
+_sweeps = OrderedDict()  # key -> LagSweep
+_sweeps_lock = threading.Lock()
+
+
+def sweep_key(df1, df2, cor_by, max_lag, method):
+    return (frame_fingerprint(df1), frame_fingerprint(df2), cor_by, max_lag, method)
+
+
+def get_lag_sweep(df1, df2, cor_by="geo_value", max_lag=14, method="pearson"):
+    """Return the registered sweep for these signals and parameters, or None."""
+    key = sweep_key(df1, df2, cor_by, max_lag, method)
+    with _sweeps_lock:
+        sweep = _sweeps.get(key)
+        if sweep is not None:
+            _sweeps.move_to_end(key)
+            return sweep
+
+    if JOB_QUEUE_ENABLED:
+        key = job_key(
+            "lag_sweep", {"df1": df1, "df2": df2}, _job_params(cor_by, max_lag, method)
+        )
+        if get_job(key, with_result=False) is None:
+            return None
+        return QueuedLagSweep(key, max_lag)
+    return None
+
+
+def start_lag_sweep(
+    df1, df2, cor_by="geo_value", max_lag=14, method="pearson", known=None
+):
+    """
+    Start a sweep in the background (or resume a cancelled one) and return it.
+
+    Finished sweeps are returned as they are. The least recently used sweeps that
+    are not running are dropped once there are more than LAG_SWEEP_CACHE_SIZE.
+
+    `known` maps lags to correlations that are already known (e.g. from the
+    correlation atlas); only the other lags are computed. A sweep made entirely of
+    known lags is finished at once and never goes through the job queue.
+    """
+    # Undefined correlations are left to the sweep, which reports them its own way
+    known = {
+        lag: cor
+        for lag, cor in (known or {}).items()
+        if -max_lag <= lag <= max_lag and cor == cor
+    }
+    if JOB_QUEUE_ENABLED and len(known) < 2 * max_lag + 1:
+        key = submit_job(
+            "lag_sweep", {"df1": df1, "df2": df2}, **_job_params(cor_by, max_lag, method)
+        )
+        return QueuedLagSweep(key, max_lag)
+
+    key = sweep_key(df1, df2, cor_by, max_lag, method)
+    with _sweeps_lock:
+        sweep = _sweeps.get(key)
+        if sweep is None:
+            sweep = _sweeps[key] = LagSweep(df1, df2, cor_by, max_lag, method)
+        for lag, cor in known.items():
+            sweep.results.setdefault(lag, cor)
+        _sweeps.move_to_end(key)
+        for old_key in list(_sweeps):
+            if len(_sweeps) <= MAX_SWEEPS:
+                break
+            if old_key != key and not _sweeps[old_key].running():
+                del _sweeps[old_key]
+    sweep.start()
+    return sweep
+
+
+def _stats():
+    with _sweeps_lock:
+        sweeps = list(_sweeps.values())
+    return {
+        "sweeps": len(sweeps),
+        "running": sum(sweep.running() for sweep in sweeps),
+        "done": sum(sweep.done() for sweep in sweeps),
+    }
+
+
+register_metrics("lag_sweeps", _stats)
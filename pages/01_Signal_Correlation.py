@@ -1,5 +1,6 @@
 import streamlit as st
 import pandas as pd
+from functools import partial
 from available_signals import names_to_sources, sources_to_names
 from geo_codes import (
     geotypes_to_display,
@@ -16,25 +17,52 @@ from geo_codes import (
     display_to_hss_region,
     msa_by_state,
     display_to_msa,
+    region_to_display,
+    regions_in_state,
 )
 from utils import (
+    covidcast_metadata,
+    get_signal_geotypes,
     get_shared_geotypes,
-    get_shared_dates,
     to_epidate_range,
     to_epiweek_range,
 )
 
 from analysis_tools import (
+    NoCovidcastDataError,
     fetch_covidcast_data,
-    get_lags_and_correlations,
+    iter_covidcast_data_chunks,
 )
+from lag_sweep import get_lag_sweep, start_lag_sweep
+from correlation_atlas import (
+    lookup_lag_correlations,
+    start_atlas_refresher,
+    track_pair,
+)
+
+from prefetch import prefetch_when_settled, start_cache_warmer
+from session_memory import session_memory
+from pipeline import lag_correlations, lag_slider_plot, shared_dates
 
+from correlation_engine import (
+    best_lags,
+    bootstrap_lag_correlations,
+    region_best_lags,
+    region_lag_correlations,
+    rolling_lag_correlation,
+)
 from plotting_utils import (
-    update_plot_with_lag,
+    create_plotly_dual_axis,
+    plot_correlation_heatmap,
+    plot_region_map,
+    plot_rolling_correlation_heatmap,
     plot_correlation_vs_lag,
     plot_correlation_distribution,
 )
 
+from instrumentation import plotly_chart, render_performance_panel, timed
+from profiling import start_rerun_profile, finish_rerun_profile, profiled_fragment
+
 from helper_texts import (
     correlation_method_info,
     correlation_page_helpers,
@@ -44,8 +72,9 @@ from helper_texts import (
 st.set_page_config(
     page_title="Signal Correlation Analysis", page_icon="🦠", layout="wide"
 )
-
-covidcast_metadata = pd.read_csv("csv_data/covidcast_metadata.csv")
+start_rerun_profile(__file__)
+start_cache_warmer()
+start_atlas_refresher()
 
 # Create header with better spacing and right-aligned help button
 col1, _, col3 = st.columns([1, 7, 3])
@@ -76,157 +105,288 @@ if st.session_state.show_help_corr_1:
 
 all_sources_and_signals = list(names_to_sources.values())
 
-st.markdown("📊 **Select two signals:**")
-col1, col2 = st.columns(2)
-with col1:
-    source_and_signal1 = st.selectbox(
-        "Choose signal 1:",
-        all_sources_and_signals,
-        label_visibility="collapsed",
-        format_func=lambda x: sources_to_names[x],
-        index=0,
-    )
-    # label_visibility="collapsed" might be disallowed in the future
-    # https://docs.streamlit.io/develop/api-reference/widgets/st.selectbox
-with col2:
-    source_and_signal2 = st.selectbox(
-        "Choose signal 2:",
-        [signal for signal in all_sources_and_signals if signal != source_and_signal1],
-        label_visibility="collapsed",
-        format_func=lambda x: sources_to_names[x],
-        index=0,
-    )
+# The two-signal comparison is split into fragments that rerun on their own: the
+# selection (with the fetch button), the lag exploration, and inside it the best
+# lag and the sliding window. A widget change only reruns its own fragment; the
+# sections below the selection work on what was fetched (st.session_state.fetched),
+# not on the current selection, so they are unaffected by changing it.
 
-shared_geo_types = get_shared_geotypes(
-    covidcast_metadata, source_and_signal1, source_and_signal2
-)
-shared_geo_types_display = [
-    geotypes_to_display[geo_type] for geo_type in shared_geo_types
-]
 
-st.markdown("🌍 **Select a region of interest:**")
-col1, col2 = st.columns(2)
-with col1:
-    geo_type_display = st.selectbox("Browse by:", shared_geo_types_display)
-    geo_type = display_to_geotypes[geo_type_display]
-with col2:
-    if geo_type == "nation":
-        region_display = st.selectbox("Choose a nation:", nation_to_display.values())
-        region = display_to_nation[region_display]
-    elif geo_type == "state":
-        region_display = st.selectbox(
-            "Choose a state:", state_abbrvs_to_display.values()
-        )
-        region = display_to_state_abbrvs[region_display]
-    elif geo_type == "county":
-        state_display = st.selectbox(
-            "Choose a state:", state_abbrvs_to_display.values()
-        )
-        region_display = st.selectbox(
-            "Choose a county:", county_by_state[state_display]
-        )
-        region = display_to_county_fips[region_display]
-    elif geo_type == "hrr":
-        state_display = st.selectbox(
-            "Choose a state:", state_abbrvs_to_display.values()
-        )
-        region_display = st.selectbox(
-            "Choose an Hospital Referral Region:", hrr_by_state[state_display]
-        )
-        region = display_to_hrr[region_display]
-    elif geo_type == "hhs":
-        region_display = st.selectbox(
-            "Choose an HHS Region:", hss_region_to_display.values()
-        )
-        region = display_to_hss_region[region_display]
-    elif geo_type == "msa":
-        state_display = st.selectbox(
-            "Choose a state:", state_abbrvs_to_display.values()
-        )
-        region_display = st.selectbox(
-            "Choose a Metropolitan Statistical Area:", msa_by_state[state_display]
+def select_signals():
+    """
+    Selectboxes for the two signals to compare.
+
+    Returns:
+        tuple: (source_and_signal1, source_and_signal2)
+    """
+    st.markdown("📊 **Select two signals:**")
+    col1, col2 = st.columns(2)
+    with col1:
+        source_and_signal1 = st.selectbox(
+            "Choose signal 1:",
+            all_sources_and_signals,
+            label_visibility="collapsed",
+            format_func=lambda x: sources_to_names[x],
+            index=0,
         )
-        region = display_to_msa[region_display]
-    elif geo_type == "dma":
-        st.error(
-            "Designated Market Areas (DMAs) are proprietary information released by Nielsen. The subscription to this data costs $8000. Sorry.",
-            icon="🚨",
+        # label_visibility="collapsed" might be disallowed in the future
+        # https://docs.streamlit.io/develop/api-reference/widgets/st.selectbox
+    with col2:
+        source_and_signal2 = st.selectbox(
+            "Choose signal 2:",
+            [
+                signal
+                for signal in all_sources_and_signals
+                if signal != source_and_signal1
+            ],
+            label_visibility="collapsed",
+            format_func=lambda x: sources_to_names[x],
+            index=0,
         )
+    return source_and_signal1, source_and_signal2
+
+
+def select_region(geo_types_display):
+    """
+    Selectboxes for the geo_type and the region of interest.
+
+    Args:
+        geo_types_display: Display names of the geo_types to choose from.
+
+    Returns:
+        tuple: (geo_type, region, region_display); region and region_display are
+            None if no region can be selected for the geo_type
+    """
+    st.markdown("🌍 **Select a region of interest:**")
+    region = region_display = None
+    col1, col2 = st.columns(2)
+    with col1:
+        geo_type_display = st.selectbox("Browse by:", geo_types_display)
+        geo_type = display_to_geotypes[geo_type_display]
+    with col2:
+        if geo_type == "nation":
+            region_display = st.selectbox(
+                "Choose a nation:", nation_to_display.values()
+            )
+            region = display_to_nation[region_display]
+        elif geo_type == "state":
+            region_display = st.selectbox(
+                "Choose a state:", state_abbrvs_to_display.values()
+            )
+            region = display_to_state_abbrvs[region_display]
+        elif geo_type == "county":
+            state_display = st.selectbox(
+                "Choose a state:", state_abbrvs_to_display.values()
+            )
+            region_display = st.selectbox(
+                "Choose a county:", county_by_state[state_display]
+            )
+            region = display_to_county_fips[region_display]
+        elif geo_type == "hrr":
+            state_display = st.selectbox(
+                "Choose a state:", state_abbrvs_to_display.values()
+            )
+            region_display = st.selectbox(
+                "Choose an Hospital Referral Region:", hrr_by_state[state_display]
+            )
+            region = display_to_hrr[region_display]
+        elif geo_type == "hhs":
+            region_display = st.selectbox(
+                "Choose an HHS Region:", hss_region_to_display.values()
+            )
+            region = display_to_hss_region[region_display]
+        elif geo_type == "msa":
+            state_display = st.selectbox(
+                "Choose a state:", state_abbrvs_to_display.values()
+            )
+            region_display = st.selectbox(
+                "Choose a Metropolitan Statistical Area:", msa_by_state[state_display]
+            )
+            region = display_to_msa[region_display]
+        elif geo_type == "dma":
+            st.error(
+                "Designated Market Areas (DMAs) are proprietary information released by Nielsen. The subscription to this data costs $8000. Sorry.",
+                icon="🚨",
+            )
+        else:
+            st.error(f"Invalid geo_type: {geo_type}", icon="🚨")
+            st.stop()
+    return geo_type, region, region_display
+
+
+def refetch_signal(fetched, source_and_signal):
+    """
+    Fetch a signal again as the "Fetch data" button did, once it was evicted from
+    memory (see session_memory).
+
+    Args:
+        fetched: st.session_state.fetched at the time of the fetch
+        source_and_signal: (source, signal) tuple of the signal
+
+    Returns:
+        pd.DataFrame: The signal, sorted by time_value
+    """
+    if fetched["time_type"] == "day":
+        date_range = to_epidate_range(fetched["init_date"], fetched["final_date"])
     else:
-        st.error(f"Invalid geo_type: {geo_type}", icon="🚨")
-        st.stop()
+        date_range = to_epiweek_range(fetched["init_date"], fetched["final_date"])
+    df = fetch_covidcast_data(
+        fetched["geo_type"],
+        fetched["region"],
+        source_and_signal,
+        date_range[0],
+        date_range[-1],
+        fetched["time_type"],
+    )
+    return df.sort_values("time_value").reset_index(drop=True)
+
 
-try:
-    shared_init_date, shared_final_date, time_type = get_shared_dates(
-        covidcast_metadata, geo_type, source_and_signal1, source_and_signal2
+@st.fragment
+@profiled_fragment(__file__)
+@timed("fragment.correlation_selection")
+def selection_section():
+    source_and_signal1, source_and_signal2 = select_signals()
+    shared_geo_types = get_shared_geotypes(
+        covidcast_metadata, source_and_signal1, source_and_signal2
     )
-except ValueError:
-    st.error(
-        "Signals must have the same reporting frequency ('time_type') to be compared. Try changing the signal or at least one of the regions.",
-        icon="🚨",
+    geo_type, region, region_display = select_region(
+        [geotypes_to_display[geo_type] for geo_type in shared_geo_types]
     )
-    st.stop()
 
-init_date, final_date = st.slider(
-    "📅 **Select the date range:**",
-    min_value=shared_init_date,
-    max_value=shared_final_date,
-    value=(shared_init_date, shared_final_date),
-)
-
-if time_type == "day":
-    date_range = to_epidate_range(init_date, final_date)
-    max_lag = (final_date - init_date).days // 2
-elif time_type == "week":
-    date_range = to_epiweek_range(init_date, final_date)
-    max_lag = ((final_date - init_date).days // 7) // 2
-else:
-    st.error(f"Invalid time_type: {time_type}", icon="🚨")
-    st.stop()
+    try:
+        shared_init_date, shared_final_date, time_type = shared_dates(
+            covidcast_metadata, geo_type, source_and_signal1, source_and_signal2
+        )
+    except ValueError:
+        st.error(
+            "Signals must have the same reporting frequency ('time_type') to be compared. Try changing the signal or at least one of the regions.",
+            icon="🚨",
+        )
+        return
 
-button_enabled = (
-    source_and_signal1 != source_and_signal2
-    and geo_type != "dma"
-    and "region" in locals()
-)
+    init_date, final_date = st.slider(
+        "📅 **Select the date range:**",
+        min_value=shared_init_date,
+        max_value=shared_final_date,
+        value=(shared_init_date, shared_final_date),
+    )
 
-if st.button(
-    "Fetch data and calculate correlation",
-    type="primary",
-    disabled=not button_enabled,
-    help="Click to fetch and analyze the selected signals",
-):
-    with st.spinner("Fetching data..."):
-        # Store the fetched data in session state
-        st.session_state.df1 = fetch_covidcast_data(
+    if time_type == "day":
+        date_range = to_epidate_range(init_date, final_date)
+        max_lag = (final_date - init_date).days // 2
+    elif time_type == "week":
+        date_range = to_epiweek_range(init_date, final_date)
+        max_lag = ((final_date - init_date).days // 7) // 2
+    else:
+        st.error(f"Invalid time_type: {time_type}", icon="🚨")
+        return
+
+    # Speculatively fetch the second signal over the full shared range once the
+    # user stops changing the selection; any date range chosen above is sliced
+    # from it
+    if region is not None and source_and_signal1 != source_and_signal2:
+        if time_type == "day":
+            full_date_range = to_epidate_range(shared_init_date, shared_final_date)
+        else:
+            full_date_range = to_epiweek_range(shared_init_date, shared_final_date)
+        prefetch_when_settled(
             geo_type,
             region,
-            source_and_signal1,
-            date_range[0],
-            date_range[-1],
+            source_and_signal2,
+            full_date_range[0],
+            full_date_range[-1],
             time_type,
         )
-        st.session_state.df2 = fetch_covidcast_data(
+
+    button_enabled = source_and_signal1 != source_and_signal2 and region is not None
+
+    if not st.button(
+        "Fetch data and calculate correlation",
+        type="primary",
+        disabled=not button_enabled,
+        help="Click to fetch and analyze the selected signals",
+    ):
+        return
+
+    # Long ranges arrive in chunks; draw the signals as they come in
+    progress_container = st.empty()
+    preview_container = st.empty()
+    chunks = {source_and_signal1: [], source_and_signal2: []}
+    with st.spinner("Fetching data..."):
+        for source_and_signal, chunk in iter_covidcast_data_chunks(
             geo_type,
             region,
-            source_and_signal2,
+            [source_and_signal1, source_and_signal2],
             date_range[0],
             date_range[-1],
             time_type,
-        )
+        ):
+            chunks[source_and_signal].append(chunk)
+            if not (chunks[source_and_signal1] and chunks[source_and_signal2]):
+                continue
+            df1 = pd.concat(chunks[source_and_signal1]).sort_values("time_value")
+            df2 = pd.concat(chunks[source_and_signal2]).sort_values("time_value")
+            progress_container.caption(
+                f"Received data up to {max(df1['time_value'].max(), df2['time_value'].max())}..."
+            )
+            plotly_chart(
+                create_plotly_dual_axis(
+                    df1,
+                    df2,
+                    sources_to_names[source_and_signal1],
+                    sources_to_names[source_and_signal2],
+                    f"Comparison of {sources_to_names[source_and_signal1]} vs {sources_to_names[source_and_signal2]} in {geo_type.capitalize()} {region_display}",
+                    "Loading...",
+                ),
+                "dual_axis_preview",
+                container=preview_container,
+                use_container_width=True,
+            )
 
-    st.divider()
+    # What was fetched; the sections below work on this rather than on the widgets
+    fetched = st.session_state.fetched = {
+        "source_and_signal1": source_and_signal1,
+        "source_and_signal2": source_and_signal2,
+        "geo_type": geo_type,
+        "region": region,
+        "region_display": region_display,
+        "time_type": time_type,
+        "init_date": init_date,
+        "final_date": final_date,
+        "max_lag": max_lag,
+    }
+    # Store the fetched data in session state; it is refetched if it was evicted
+    for name, source_and_signal in [
+        ("df1", source_and_signal1),
+        ("df2", source_and_signal2),
+    ]:
+        session_memory.put(
+            name,
+            pd.concat(chunks[source_and_signal])
+            .sort_values("time_value")
+            .reset_index(drop=True),
+            reload=partial(refetch_signal, fetched, source_and_signal),
+        )
+    session_memory.pop("rolling_correlation")
+    session_memory.pop("bootstrap")
+    st.session_state.pop("bootstrap_key", None)
+    # Only the fragment reran; draw the sections below for the new data
+    st.rerun()
+
+
+@st.fragment
+@profiled_fragment(__file__)
+@timed("fragment.correlation_lag_exploration")
+def lag_exploration_section():
+    fetched = st.session_state.fetched
+    df1 = session_memory.get("df1")
+    df2 = session_memory.get("df2")
+    name1 = sources_to_names[fetched["source_and_signal1"]]
+    name2 = sources_to_names[fetched["source_and_signal2"]]
 
-# Only show the lag slider and plot if we have data
-if "df1" in st.session_state and "df2" in st.session_state:
     plot_container = st.empty()
-
-    selected_lag = st.slider(
-        f"📅 **Time lag ({time_type}s):**",
-        min_value=-max_lag,
-        max_value=max_lag,
-        value=0,
-        help=f"Shift signal 1 ({sources_to_names[source_and_signal1]}) forwards or backwards in time",
+    st.caption(
+        f"Move the time lag slider below the chart to shift signal 1 ({name1}) forwards or backwards in time."
     )
 
     col1, _, col3 = st.columns([5, 4, 1.4])
@@ -254,53 +414,523 @@ if "df1" in st.session_state and "df2" in st.session_state:
             unsafe_allow_html=True,
         )
 
-    # Update plot based on current lag and selected correlation method
-    new_fig, new_correlation = update_plot_with_lag(
-        st.session_state.df1,
-        st.session_state.df2,
-        sources_to_names[source_and_signal1],
-        sources_to_names[source_and_signal2],
-        geo_type,
-        region_display,
-        selected_lag,
-        time_type,
-        correlation_method,  # Pass the selected method
+    # The figure holds every lag and its correlation, so moving the slider runs in
+    # the browser; the correlations and the figure are pipeline nodes, rebuilt only
+    # for new data or another method
+    max_lag = fetched["max_lag"]
+    lag_sweep = get_lag_sweep(
+        df1,
+        df2,
+        cor_by="geo_value",
+        max_lag=max_lag,
+        method=correlation_method,
+    )
+    if lag_sweep is not None and lag_sweep.done():
+        lags_and_correlations = lag_sweep.snapshot()
+    else:
+        with st.spinner("Calculating correlations at all time lags..."):
+            tensor = lag_correlations(
+                {"signal1": df1, "signal2": df2},
+                max_lag=max_lag,
+                method=correlation_method,
+            )
+        lags_and_correlations = dict(zip(tensor.lags, tensor.values[0]))
+    lag_plot = lag_slider_plot(
+        df1,
+        df2,
+        name1,
+        name2,
+        f"Comparison of {name1} vs {name2} in {fetched['geo_type'].capitalize()} {fetched['region_display']}",
+        lags_and_correlations,
+        fetched["time_type"],
     )
 
     with plot_container:
-        st.plotly_chart(new_fig, use_container_width=True)
-
-    st.write(
-        f"Signal correlation at lag of {selected_lag} {time_type}s: **{new_correlation}**"
-    )
+        plotly_chart(lag_plot, "lag_slider", use_container_width=True)
 
+    # Nested so that they follow the correlation method
+    st.divider()
+    best_lag_section(correlation_method)
     st.divider()
+    sliding_window_section(correlation_method)
+
+
+@st.fragment
+@profiled_fragment(__file__)
+@timed("fragment.correlation_best_lag")
+def best_lag_section(correlation_method):
+    fetched = st.session_state.fetched
+    df1 = session_memory.get("df1")
+    df2 = session_memory.get("df2")
+    max_lag = fetched["max_lag"]
+
+    bootstrap_replicates = st.number_input(
+        "Bootstrap replicates for confidence intervals (0 to skip):",
+        min_value=0,
+        max_value=2000,
+        value=0,
+        step=100,
+        help="Resample the data in blocks of consecutive days to estimate how certain the best time lag and its correlation are. Kendall is much slower than Pearson and Spearman.",
+    )
 
     if st.button(
         "Calculate best time lag",
         type="primary",
         help="Calculate the time lag that maximises the correlation between the two signals",
     ):
-        with st.spinner(
-            "This might take a while (up to ~5mins for the full data range)..."
-        ):
-            lags_and_correlations = get_lags_and_correlations(
-                st.session_state.df1,
-                st.session_state.df2,
-                cor_by="geo_value",
-                max_lag=max_lag,
-                method=correlation_method,  # Pass the selected method
-            )
-        best_lag = max(lags_and_correlations, key=lags_and_correlations.get)
-        best_correlation = lags_and_correlations[best_lag]
-        st.write(f"Best time lag: **{best_lag} {time_type}s**")
-        st.write(f"Best correlation: **{best_correlation:.3f}**")
+        # Frequently compared signals are answered from the correlation atlas
+        pair_and_region = (
+            fetched["source_and_signal1"],
+            fetched["source_and_signal2"],
+            fetched["geo_type"],
+            fetched["region"],
+            fetched["time_type"],
+        )
+        known = lookup_lag_correlations(
+            *pair_and_region,
+            fetched["init_date"],
+            fetched["final_date"],
+            max_lag,
+            correlation_method,
+        )
+        track_pair(*pair_and_region)
+        start_lag_sweep(
+            df1,
+            df2,
+            cor_by="geo_value",
+            max_lag=max_lag,
+            method=correlation_method,  # Pass the selected method
+            known=known,
+        )
+
+    # The sweep runs in the background; show it (or its cached result) if there is one
+    lag_sweep = get_lag_sweep(
+        df1,
+        df2,
+        cor_by="geo_value",
+        max_lag=max_lag,
+        method=correlation_method,
+    )
+    if lag_sweep is not None:
+        # Poll for new results only while the sweep is running
+        st.session_state.lag_sweep_polling = lag_sweep.running()
+        st.fragment(run_every=1.0 if lag_sweep.running() else None)(
+            render_lag_sweep
+        )(lag_sweep, correlation_method, bootstrap_replicates)
+
+
+@profiled_fragment(__file__)
+def render_lag_sweep(lag_sweep, correlation_method, bootstrap_replicates):
+    max_lag = st.session_state.fetched["max_lag"]
+    time_type = st.session_state.fetched["time_type"]
+    df1 = session_memory.get("df1")
+    df2 = session_memory.get("df2")
+
+    if lag_sweep.error is not None:
+        st.error(f"Error: {str(lag_sweep.error)}", icon="🚨")
+    elif lag_sweep.running():
+        st.progress(
+            len(lag_sweep.results) / lag_sweep.total,
+            text=f"Calculating correlations... ({len(lag_sweep.results)}/{lag_sweep.total} lags, nearest to 0 first)",
+        )
+        if st.button("Cancel", key="cancel_lag_sweep"):
+            lag_sweep.cancel()
+            st.rerun()
+    elif not lag_sweep.done():
+        st.info(
+            f"Calculation stopped after {len(lag_sweep.results)}/{lag_sweep.total} lags. Click 'Calculate best time lag' to resume."
+        )
+
+    lags_and_correlations = lag_sweep.snapshot()
+    best_lag, best_correlation = lag_sweep.best()
+    if best_lag is None:
+        return
+    so_far = "" if lag_sweep.done() else " (so far)"
+
+    bootstrap = None
+    if lag_sweep.done() and bootstrap_replicates:
+        # Reset along with the data, see the "Fetch data" button
+        bootstrap_key = (max_lag, correlation_method, bootstrap_replicates)
+        if st.session_state.get("bootstrap_key") != bootstrap_key:
+            with st.spinner("Resampling..."):
+                # Spilled rather than recomputed when evicted: resampling is slow
+                session_memory.put(
+                    "bootstrap",
+                    bootstrap_lag_correlations(
+                        df1,
+                        df2,
+                        max_lag=max_lag,
+                        method=correlation_method,
+                        n_replicates=bootstrap_replicates,
+                    ),
+                )
+            st.session_state.bootstrap_key = bootstrap_key
+        bootstrap = session_memory.get("bootstrap")
+
+    if bootstrap is None:
+        st.write(f"Best time lag{so_far}: **{best_lag} {time_type}s**")
+        st.write(f"Best correlation{so_far}: **{best_correlation:.3f}**")
+    else:
+        confidence = f"{bootstrap.confidence:.0%} CI"
+        lower_lag, upper_lag = bootstrap.best_lag_interval
+        lower_cor, upper_cor = bootstrap.best_correlation_interval
+        st.write(
+            f"Best time lag: **{best_lag} {time_type}s** ({confidence}: {lower_lag} to {upper_lag} {time_type}s)"
+        )
+        st.write(
+            f"Best correlation: **{best_correlation:.3f}** ({confidence}: {lower_cor:.3f} to {upper_cor:.3f})"
+        )
 
-        col1, col2 = st.columns(2, gap="large")
-        with col1:
-            fig1 = plot_correlation_vs_lag(lags_and_correlations, time_type)
-            st.plotly_chart(fig1, use_container_width=True)
+    col1, col2 = st.columns(2, gap="large")
+    with col1:
+        fig1 = plot_correlation_vs_lag(
+            lags_and_correlations, time_type, bootstrap=bootstrap
+        )
+        plotly_chart(fig1, "correlation_vs_lag", use_container_width=True)
 
-        with col2:
+    with col2:
+        # The KDE needs a few distinct values, i.e. more than the first lags
+        if len(set(lags_and_correlations.values())) > 2:
             fig2 = plot_correlation_distribution(lags_and_correlations)
-            st.plotly_chart(fig2, use_container_width=True)
+            plotly_chart(fig2, "correlation_distribution", use_container_width=True)
+
+    if not lag_sweep.running() and st.session_state.get("lag_sweep_polling"):
+        # Stop polling once the sweep has ended
+        st.session_state.lag_sweep_polling = False
+        st.rerun()
+
+
+@st.fragment
+@profiled_fragment(__file__)
+@timed("fragment.correlation_sliding_window")
+def sliding_window_section(correlation_method):
+    fetched = st.session_state.fetched
+    df1 = session_memory.get("df1")
+    df2 = session_memory.get("df2")
+    time_type = fetched["time_type"]
+
+    # How the correlation and the best lag change over time
+    n_steps = df1["time_value"].nunique()
+    window = st.slider(
+        f"🪟 **Sliding window ({time_type}s):**",
+        min_value=min(n_steps, 7 if time_type == "day" else 4),
+        max_value=n_steps,
+        value=min(n_steps, 90 if time_type == "day" else 13),
+        help="Length of the window in which the correlation is calculated at each point in time",
+    )
+    if st.button(
+        "Calculate time-varying correlation",
+        type="primary",
+        help="Calculate the correlation at every time lag in a window sliding over the date range",
+    ):
+        with st.spinner("Calculating correlations..."):
+            session_memory.put(
+                "rolling_correlation",
+                rolling_lag_correlation(
+                    df1,
+                    df2,
+                    window=window,
+                    max_lag=min(fetched["max_lag"], window // 2),
+                    method=correlation_method,
+                ),
+            )
+
+    if "rolling_correlation" in st.session_state:
+        plotly_chart(
+            plot_rolling_correlation_heatmap(
+                session_memory.get("rolling_correlation"), time_type
+            ),
+            "rolling_correlation",
+            use_container_width=True,
+        )
+
+
+compare_mode = st.radio(
+    "🔀 **Compare:**",
+    ["Two signals", "Two signals in every region", "All pairs of signals"],
+    horizontal=True,
+    help="'Two signals in every region' finds the best time lag in every state (or every county, HRR or MSA of a state) and maps it. 'All pairs of signals' computes the correlation of every pair of signals available for the selected region at every time lag in one go.",
+)
+
+if compare_mode == "Two signals":
+    selection_section()
+    if "fetched" in st.session_state:
+        st.divider()
+        lag_exploration_section()
+
+    render_performance_panel()
+    finish_rerun_profile()
+    st.stop()
+
+all_pairs_mode = compare_mode == "All pairs of signals"
+region_map_mode = compare_mode == "Two signals in every region"
+
+if all_pairs_mode:
+    # Any geo_type offered by at least two signals
+    geo_type_counts = {}
+    for source_and_signal in all_sources_and_signals:
+        for geo_type in set(get_signal_geotypes(covidcast_metadata, source_and_signal)):
+            geo_type_counts[geo_type] = geo_type_counts.get(geo_type, 0) + 1
+    shared_geo_types = [
+        geo_type for geo_type, count in geo_type_counts.items() if count >= 2
+    ]
+else:
+    source_and_signal1, source_and_signal2 = select_signals()
+    shared_geo_types = get_shared_geotypes(
+        covidcast_metadata, source_and_signal1, source_and_signal2
+    )
+shared_geo_types_display = [
+    geotypes_to_display[geo_type] for geo_type in shared_geo_types
+]
+
+if region_map_mode:
+    map_geo_types_display = [
+        geotypes_to_display[geo_type]
+        for geo_type in shared_geo_types
+        if geo_type not in ("nation", "dma")
+    ]
+    if not map_geo_types_display:
+        st.error("These signals are only available for the whole nation.", icon="🚨")
+        st.stop()
+
+    st.markdown("🌍 **Select the regions to compare:**")
+    col1, col2 = st.columns(2)
+    with col1:
+        geo_type_display = st.selectbox("Browse by:", map_geo_types_display)
+        geo_type = display_to_geotypes[geo_type_display]
+    with col2:
+        if geo_type in ("county", "hrr", "msa"):
+            state_display = st.selectbox(
+                "Choose a state:", state_abbrvs_to_display.values()
+            )
+            map_regions = regions_in_state(geo_type, state_display)
+            map_area = f"{geotypes_to_display[geo_type]}s in {state_display}"
+        else:
+            map_regions = None  # All of them
+            map_area = f"{geotypes_to_display[geo_type]}s"
+
+    try:
+        shared_init_date, shared_final_date, time_type = shared_dates(
+            covidcast_metadata, geo_type, source_and_signal1, source_and_signal2
+        )
+    except ValueError:
+        st.error(
+            "Signals must have the same reporting frequency ('time_type') to be compared. Try changing the signal or the geo_type.",
+            icon="🚨",
+        )
+        st.stop()
+
+    init_date, final_date = st.slider(
+        "📅 **Select the date range:**",
+        min_value=shared_init_date,
+        max_value=shared_final_date,
+        value=(shared_init_date, shared_final_date),
+    )
+    if time_type == "day":
+        date_range = to_epidate_range(init_date, final_date)
+        max_lag = (final_date - init_date).days // 2
+    else:
+        date_range = to_epiweek_range(init_date, final_date)
+        max_lag = ((final_date - init_date).days // 7) // 2
+
+    map_method = st.radio(
+        "📈 **Select correlation method:**",
+        ["Pearson", "Kendall", "Spearman"],
+        horizontal=True,
+        key="region_map_correlation_method",
+        help="Kendall is much slower than Pearson and Spearman for long date ranges.",
+    ).lower()
+    st.info(correlation_method_info[map_method])
+
+    if st.button("Fetch data and map best time lags", type="primary"):
+        try:
+            with st.spinner(f"Fetching data for all {map_area}..."):
+                # One request per signal for all regions of the geo_type
+                df1, df2 = (
+                    fetch_covidcast_data(
+                        geo_type,
+                        "*",
+                        source_and_signal,
+                        date_range[0],
+                        date_range[-1],
+                        time_type,
+                    )
+                    for source_and_signal in (source_and_signal1, source_and_signal2)
+                )
+        except NoCovidcastDataError as e:
+            st.error(str(e), icon="🚨")
+            st.stop()
+        if map_regions is not None:
+            df1 = df1[df1["geo_value"].isin(map_regions)]
+            df2 = df2[df2["geo_value"].isin(map_regions)]
+        with st.spinner("Calculating correlations..."):
+            session_memory.put(
+                "region_correlations",
+                region_lag_correlations(df1, df2, max_lag=max_lag, method=map_method),
+            )
+            st.session_state.region_map = (
+                geo_type,
+                time_type,
+                map_area,
+                sources_to_names[source_and_signal1],
+            )
+
+    if "region_correlations" in st.session_state:
+        map_geo_type, map_time_type, map_area, map_signal1 = (
+            st.session_state.region_map
+        )
+        best = region_best_lags(session_memory.get("region_correlations"))
+        if best.empty:
+            st.warning("No region has data for both signals.", icon="⚠️")
+        else:
+            lag_title = f"Best time lag of {map_signal1} ({map_time_type}s)"
+            figures = [
+                plot_region_map(best, map_geo_type, "best_lag", lag_title),
+                plot_region_map(best, map_geo_type, "correlation", "Peak correlation"),
+            ]
+            if figures[0] is None:
+                st.info(
+                    f"No map boundaries are configured for {map_area}; see the README.",
+                    icon="ℹ️",
+                )
+            else:
+                col1, col2 = st.columns(2, gap="large")
+                for column, fig in zip((col1, col2), figures):
+                    with column:
+                        plotly_chart(fig, "region_map", use_container_width=True)
+            best.insert(
+                1,
+                "region",
+                [
+                    region_to_display(map_geo_type, geo_value)
+                    for geo_value in best["geo_value"]
+                ],
+            )
+            st.dataframe(
+                best.rename(
+                    columns={
+                        "region": "Region",
+                        "best_lag": lag_title,
+                        "correlation": "Peak correlation",
+                    }
+                ),
+                hide_index=True,
+                use_container_width=True,
+            )
+
+    render_performance_panel()
+    finish_rerun_profile()
+    st.stop()
+
+# All pairs of signals
+geo_type, region, region_display = select_region(shared_geo_types_display)
+if region is None:
+    st.stop()
+
+# Signals at this geo_type, restricted to the most common reporting frequency
+signal_time_types = {
+    source_and_signal: shared_dates(
+        covidcast_metadata, geo_type, source_and_signal
+    )
+    for source_and_signal in all_sources_and_signals
+    if geo_type in get_signal_geotypes(covidcast_metadata, source_and_signal)
+}
+time_types = [dates[2] for dates in signal_time_types.values()]
+time_type = max(set(time_types), key=time_types.count)
+pair_signals = [
+    source_and_signal
+    for source_and_signal, dates in signal_time_types.items()
+    if dates[2] == time_type
+]
+shared_init_date, shared_final_date, _ = shared_dates(
+    covidcast_metadata, geo_type, *pair_signals
+)
+if shared_init_date >= shared_final_date:
+    st.error(
+        "The signals available for this region do not overlap in time. Try another geo_type.",
+        icon="🚨",
+    )
+    st.stop()
+st.caption(
+    f"{len(pair_signals)} signals, {len(pair_signals) * (len(pair_signals) - 1) // 2} pairs: "
+    + ", ".join(sources_to_names[source_and_signal] for source_and_signal in pair_signals)
+)
+
+init_date, final_date = st.slider(
+    "📅 **Select the date range:**",
+    min_value=shared_init_date,
+    max_value=shared_final_date,
+    value=(shared_init_date, shared_final_date),
+)
+if time_type == "day":
+    date_range = to_epidate_range(init_date, final_date)
+    max_lag = (final_date - init_date).days // 2
+else:
+    date_range = to_epiweek_range(init_date, final_date)
+    max_lag = ((final_date - init_date).days // 7) // 2
+
+pairs_method = st.radio(
+    "📈 **Select correlation method:**",
+    ["Pearson", "Kendall", "Spearman"],
+    horizontal=True,
+    key="all_pairs_correlation_method",
+).lower()
+st.info(correlation_method_info[pairs_method])
+
+if st.button(
+    "Fetch data and calculate all correlations",
+    type="primary",
+    disabled=len(pair_signals) < 2,
+):
+    frames = {source_and_signal: [] for source_and_signal in pair_signals}
+    with st.spinner("Fetching data..."):
+        try:
+            for source_and_signal, chunk in iter_covidcast_data_chunks(
+                geo_type,
+                region,
+                pair_signals,
+                date_range[0],
+                date_range[-1],
+                time_type,
+            ):
+                frames[source_and_signal].append(chunk)
+        except NoCovidcastDataError:
+            # Raised once all chunks are in; signals without data are left out
+            pass
+    frames = {
+        sources_to_names[source_and_signal]: pd.concat(chunks)
+        for source_and_signal, chunks in frames.items()
+        if chunks
+    }
+    if len(frames) < 2:
+        st.error("Fewer than two signals have data for this region.", icon="🚨")
+        st.stop()
+    with st.spinner("Calculating correlations..."):
+        session_memory.put(
+            "all_pairs_tensor",
+            lag_correlations(frames, max_lag=max_lag, method=pairs_method),
+        )
+        st.session_state.all_pairs_time_type = time_type
+
+if "all_pairs_tensor" in st.session_state:
+    tensor = session_memory.get("all_pairs_tensor")
+    plotly_chart(
+        plot_correlation_heatmap(tensor, st.session_state.all_pairs_time_type),
+        "correlation_heatmap",
+        use_container_width=True,
+    )
+    st.dataframe(
+        best_lags(tensor).rename(
+            columns={
+                "signal1": "Signal 1",
+                "signal2": "Signal 2",
+                "best_lag": f"Best time lag of signal 1 ({st.session_state.all_pairs_time_type}s)",
+                "correlation": "Correlation",
+            }
+        ),
+        hide_index=True,
+        use_container_width=True,
+    )
+
+render_performance_panel()
+finish_rerun_profile()
@@ -1,5 +1,6 @@
-import streamlit as st
 import pandas as pd
+import streamlit as st
+from functools import partial
 from available_signals import names_to_sources, sources_to_names
 from helper_texts import (
     helper_content,
@@ -7,14 +8,27 @@ from helper_texts import (
     forecasters_info,
     forecasters_to_display,
 )
-from utils import get_shared_dates, to_epidate_range
+from utils import covidcast_metadata, to_epidate_range
 from datetime import timedelta, date
-from analysis_tools import fetch_covidcast_data, epi_predict, fetch_covidcast_data_multi
-from plotting_utils import create_forecast_plot
-
-covidcast_metadata = pd.read_csv("csv_data/covidcast_metadata.csv")
+from analysis_tools import score_forecast
+from pipeline import (
+    fetch_signal,
+    fetch_signals,
+    forecast,
+    forecast_comparison_plot,
+    forecast_plot,
+    forecaster_comparison,
+    shared_dates,
+)
+from job_queue import JOB_QUEUE_ENABLED, DONE, FAILED, CANCELLED, submit_job, get_job
+from instrumentation import plotly_chart, render_performance_panel, timed
+from profiling import start_rerun_profile, finish_rerun_profile, profiled_fragment
+from prefetch import start_cache_warmer
+from session_memory import session_memory
 
 st.set_page_config(page_title="Forecasting", page_icon="🔮", layout="wide")
+start_rerun_profile(__file__)
+start_cache_warmer()
 
 col1, _, col3 = st.columns([1, 8.5, 3])
 with col1:
@@ -46,186 +60,318 @@ if st.session_state.show_help_forecast_1:
         unsafe_allow_html=True,
     )
 
-all_sources_and_signals = list(names_to_sources.values())
-predictors = st.multiselect(
-    "**Select the predictors:**",
-    all_sources_and_signals,
-    default=[
-        names_to_sources[x]
-        for x in ["Cases (7-day avg., per 100k)", "Deaths (7-day avg., per 100k)"]
-    ],
-    help="All the predictors you want to use to train the forecasting model.",
-    format_func=lambda x: sources_to_names[x],
-)
+if "show_help_forecast_2" not in st.session_state:
+    st.session_state.show_help_forecast_2 = False
 
-if len(predictors) == 0:
-    st.error(
-        "Please select at least one predictor to proceed with the forecasting.",
-        icon="⚠️",
-    )
-    st.stop()
-
-predicted = st.selectbox(
-    "**Select the predicted quantity:**",
-    all_sources_and_signals,
-    index=1,
-    help="The quantity you want to predict (recommended: # of deaths).",
-    format_func=lambda x: sources_to_names[x],
-)
 
-# if the user doesn't select the predicted quantity as a predictor, add it manually
-# this is so that the forecasting model can learn the relationship between the predictors and the predicted quantity
-if predicted not in predictors:
-    predictors_and_predicted = predictors + [predicted]
-else:
-    predictors_and_predicted = predictors
+def forecast_scores(forecasts, df_actual):
+    """Table of the accuracy of each forecaster and data version against df_actual."""
+    rows = []
+    for forecaster_type, (df_forecast, df_forecast_as_of) in forecasts.items():
+        for data_version, df in [
+            ("latest", df_forecast),
+            ("as of prediction", df_forecast_as_of),
+        ]:
+            rows.append(
+                {
+                    "Forecaster": forecasters_to_display[forecaster_type],
+                    "Data": data_version,
+                    **score_forecast(df, df_actual),
+                }
+            )
+    return pd.DataFrame(rows).rename(
+        columns={
+            "n": "Days scored",
+            "mae": "MAE",
+            "rmse": "RMSE",
+            "coverage_90": "90% interval coverage",
+        }
+    )
 
-### HARDCODED TO THE UNITED STATES ONLY FOR NOW
-geo_type = "nation"
-region = "us"
 
-try:
-    shared_init_date, shared_final_date, time_type = get_shared_dates(
-        covidcast_metadata, geo_type, *predictors
-    )
-except ValueError:
-    st.error(
-        "Signals must have the same reporting frequency ('time_type') to be compared. Try changing the signal or at least one of the regions.",
-        icon="🚨",
+def fetch_forecast_data(
+    geo_type,
+    region,
+    predictors_and_predicted,
+    predicted,
+    date_range_train,
+    date_range_predict,
+    time_type,
+    final_date,
+):
+    # Fetch data for all predictors - use latest available version
+    df_merged = fetch_signals(
+        geo_type,
+        region,
+        predictors_and_predicted,
+        date_range_train[0],
+        date_range_train[-1],
+        time_type,
+        as_of=None,
     )
-    st.stop()
-
-delta = (shared_final_date - shared_init_date).days // 10
-col_date, col_horizon = st.columns([3, 2])  # 3:2 ratio for the columns
-
-with col_date:
-    init_date = st.slider(
-        "📅 **When is the prediction made?**",
-        min_value=shared_init_date,
-        max_value=shared_final_date,
-        value=date(2021, 2, 20),
-        help="The prediction will be made on the day selected here, using all data available up until this day.",
+
+    # Fetch data for all predictors - use version available *at the time of making the prediction*
+    df_merged_as_of = fetch_signals(
+        geo_type,
+        region,
+        predictors_and_predicted,
+        date_range_train[0],
+        date_range_train[-1],
+        time_type,
+        as_of=final_date.strftime("%Y-%m-%d"),
     )
 
-with col_horizon:
-    prediction_length = st.slider(
-        "📈 **For how many days?**",
-        min_value=1,
-        max_value=45,
-        value=7,
-        help="Number of days ahead to forecast. Longer horizons may result in less accurate predictions.",
+    # Now get data for the predicted quantity - use latest available version again
+    df_actual = fetch_signal(
+        geo_type,
+        region,
+        predicted,
+        date_range_predict[0],
+        date_range_predict[-1],
+        time_type,
+        as_of=None,
     )
+    return df_merged, df_merged_as_of, df_actual
 
-# Add this CSS before the columns
-st.markdown(
-    """
-    <style>
-    div[data-testid="stRadio"] > div {
-        gap: 0.75rem;
-    }
-    </style>
-""",
-    unsafe_allow_html=True,
-)
 
-col1, col2 = st.columns([3.9, 11])
-with col1:
-    forecaster_type = st.radio(
-        "**Forecaster type:**",
-        forecasters_info.keys(),
-        index=0,
-        help="Recommended: ARX forecaster",
-        key="forecaster_type",
-        format_func=lambda x: forecasters_to_display[x],
+# The settings rerun on their own as a fragment, so changing a signal or a slider
+# does not redraw the forecast plot below; a new forecast reruns the whole page
+@st.fragment
+@profiled_fragment(__file__)
+@timed("fragment.forecast_settings")
+def settings_section():
+    all_sources_and_signals = list(names_to_sources.values())
+    predictors = st.multiselect(
+        "**Select the predictors:**",
+        all_sources_and_signals,
+        default=[
+            names_to_sources[x]
+            for x in ["Cases (7-day avg., per 100k)", "Deaths (7-day avg., per 100k)"]
+        ],
+        help="All the predictors you want to use to train the forecasting model.",
+        format_func=lambda x: sources_to_names[x],
     )
-with col2:
-    st.info(forecasters_info[forecaster_type])
 
-# Calculate final_date based on init_date and prediction_length
-final_date = init_date + timedelta(days=prediction_length)
+    if len(predictors) == 0:
+        st.error(
+            "Please select at least one predictor to proceed with the forecasting.",
+            icon="⚠️",
+        )
+        return
 
-date_range_train = to_epidate_range(shared_init_date, init_date)
-date_range_predict = to_epidate_range(init_date, final_date)
+    predicted = st.selectbox(
+        "**Select the predicted quantity:**",
+        all_sources_and_signals,
+        index=1,
+        help="The quantity you want to predict (recommended: # of deaths).",
+        format_func=lambda x: sources_to_names[x],
+    )
 
-if "show_help_forecast_2" not in st.session_state:
-    st.session_state.show_help_forecast_2 = False
+    # if the user doesn't select the predicted quantity as a predictor, add it manually
+    # this is so that the forecasting model can learn the relationship between the predictors and the predicted quantity
+    if predicted not in predictors:
+        predictors_and_predicted = predictors + [predicted]
+    else:
+        predictors_and_predicted = predictors
 
-st.markdown("<br>", unsafe_allow_html=True)
+    ### HARDCODED TO THE UNITED STATES ONLY FOR NOW
+    geo_type = "nation"
+    region = "us"
 
-# Initialize the session state for storing the plot
-if "forecast_plot" not in st.session_state:
-    st.session_state.forecast_plot = None
+    try:
+        shared_init_date, shared_final_date, time_type = shared_dates(
+            covidcast_metadata, geo_type, *predictors
+        )
+    except ValueError:
+        st.error(
+            "Signals must have the same reporting frequency ('time_type') to be compared. Try changing the signal or at least one of the regions.",
+            icon="🚨",
+        )
+        return
 
-# First create a row for the buttons
-col1, _, col3 = st.columns([5, 4.5, 4])
-with col1:
-    predict_button = st.button(
-        "Fetch data and get predictions",
-        type="primary",
-        help="Might take up to a minute or two to get all the predictions.",
-    )
-with col3:
-    if st.button(
-        "🛈\nHow do I interpret the plot?", type="secondary", key="help_button_2"
-    ):
-        st.session_state.show_help_forecast_2 = (
-            not st.session_state.show_help_forecast_2
+    delta = (shared_final_date - shared_init_date).days // 10
+    col_date, col_horizon = st.columns([3, 2])  # 3:2 ratio for the columns
+
+    with col_date:
+        init_date = st.slider(
+            "📅 **When is the prediction made?**",
+            min_value=shared_init_date,
+            max_value=shared_final_date,
+            value=date(2021, 2, 20),
+            help="The prediction will be made on the day selected here, using all data available up until this day.",
         )
 
-# Then handle the prediction logic outside the columns
-if predict_button:
-    with st.spinner("Fetching data..."):
-        # Fetch data for all predictors - use latest available version
-        df_merged = fetch_covidcast_data_multi(
-            geo_type,
-            region,
-            predictors_and_predicted,
-            date_range_train[0],
-            date_range_train[-1],
-            time_type,
-            as_of=None,
+    with col_horizon:
+        prediction_length = st.slider(
+            "📈 **For how many days?**",
+            min_value=1,
+            max_value=45,
+            value=7,
+            help="Number of days ahead to forecast. Longer horizons may result in less accurate predictions.",
         )
 
-        # Fetch data for all predictors - use version available *at the time of making the prediction*
-        df_merged_as_of = fetch_covidcast_data_multi(
-            geo_type,
-            region,
-            predictors_and_predicted,
-            date_range_train[0],
-            date_range_train[-1],
-            time_type,
-            as_of=final_date.strftime("%Y-%m-%d"),
+    # Add this CSS before the columns
+    st.markdown(
+        """
+        <style>
+        div[data-testid="stRadio"] > div {
+            gap: 0.75rem;
+        }
+        </style>
+    """,
+        unsafe_allow_html=True,
+    )
+
+    compare = st.toggle(
+        "Compare forecasters",
+        key="compare_forecasters",
+        help="Fit several forecasters on the same data at once and compare their accuracy.",
+    )
+    if compare:
+        forecaster_types = st.multiselect(
+            "**Forecasters to compare:**",
+            list(forecasters_info.keys()),
+            default=list(forecasters_info.keys()),
+            key="forecaster_types",
+            format_func=lambda x: forecasters_to_display[x],
         )
+        if len(forecaster_types) == 0:
+            st.error("Please select at least one forecaster to compare.", icon="⚠️")
+            return
+    else:
+        col1, col2 = st.columns([3.9, 11])
+        with col1:
+            forecaster_type = st.radio(
+                "**Forecaster type:**",
+                forecasters_info.keys(),
+                index=0,
+                help="Recommended: ARX forecaster",
+                key="forecaster_type",
+                format_func=lambda x: forecasters_to_display[x],
+            )
+        with col2:
+            st.info(forecasters_info[forecaster_type])
+        forecaster_types = [forecaster_type]
 
-        # Now get data for the predicted quantity - use latest available version again
-        df_actual = fetch_covidcast_data(
-            geo_type,
-            region,
-            predicted,
-            date_range_predict[0],
-            date_range_predict[-1],
-            time_type,
-            as_of=None,
+    # Calculate final_date based on init_date and prediction_length
+    final_date = init_date + timedelta(days=prediction_length)
+
+    date_range_train = to_epidate_range(shared_init_date, init_date)
+    date_range_predict = to_epidate_range(init_date, final_date)
+
+    st.markdown("<br>", unsafe_allow_html=True)
+
+    # First create a row for the buttons
+    col1, _, col3 = st.columns([5, 4.5, 4])
+    with col1:
+        predict_button = st.button(
+            "Fetch data and get predictions",
+            type="primary",
+            help="Might take up to a minute or two to get all the predictions.",
         )
+    with col3:
+        if st.button(
+            "🛈\nHow do I interpret the plot?", type="secondary", key="help_button_2"
+        ):
+            st.session_state.show_help_forecast_2 = (
+                not st.session_state.show_help_forecast_2
+            )
+            # The help text is shown below the plot, outside this fragment
+            st.rerun()
 
-        df_forecast = epi_predict(
-            df_merged,
-            predictors,
-            predicted,
-            forecaster_type,
-            prediction_length,
-            is_as_of=False,
+    # Then handle the prediction logic outside the columns
+    if not predict_button:
+        return
+    st.session_state.pop("forecast_error", None)
+
+    load_forecast_data = partial(
+        fetch_forecast_data,
+        geo_type,
+        region,
+        predictors_and_predicted,
+        predicted,
+        date_range_train,
+        date_range_predict,
+        time_type,
+        final_date,
+    )
+    with st.spinner("Fetching data..."):
+        df_merged, df_merged_as_of, df_actual = load_forecast_data()
+
+    if JOB_QUEUE_ENABLED:
+        # The forecasts run in the worker processes and are picked up below; an
+        # identical forecast submitted before (e.g. before a reload) is reused.
+        # The data for the plot is kept (or refetched) through session_memory
+        session_memory.put(
+            "forecast_data",
+            (df_merged, df_merged_as_of, df_actual),
+            reload=load_forecast_data,
         )
-        df_forecast_as_of = epi_predict(
+        st.session_state.forecast_jobs = {
+            "keys": [
+                submit_job(
+                    "epi_predict",
+                    {"df": df},
+                    predictors=predictors,
+                    predicted=predicted,
+                    forecaster_type=forecaster_type,
+                    prediction_length=prediction_length,
+                )
+                for forecaster_type in forecaster_types
+                for df in (df_merged, df_merged_as_of)
+            ],
+            "forecaster_types": forecaster_types if compare else None,
+            "init_date": init_date,
+            "predicted": predicted,
+        }
+        session_memory.pop("forecast_plot")
+        session_memory.pop("forecast_scores")
+    elif compare:
+        # Every forecaster is fitted on both data versions at the same time
+        progress_bar = st.progress(0.0, text="Calculating forecasts...")
+        forecasts = forecaster_comparison(
+            df_merged,
             df_merged_as_of,
             predictors,
             predicted,
-            forecaster_type,
+            forecaster_types,
             prediction_length,
-            is_as_of=True,
+            on_progress=lambda progress: progress_bar.progress(
+                progress, text="Calculating forecasts..."
+            ),
         )
+        progress_bar.empty()
+        fig = forecast_comparison_plot(
+            df_merged, df_merged_as_of, forecasts, df_actual, init_date, predicted
+        )
+        session_memory.put("forecast_plot", fig)
+        session_memory.put("forecast_scores", forecast_scores(forecasts, df_actual))
+    else:
+        progress_bar = st.progress(0.0)
+        forecasts = []
+        for df, step in (
+            (df_merged, "Step 1: Generating forecast using latest available data..."),
+            (
+                df_merged_as_of,
+                "Step 2: Generating forecast using data available at the time of prediction...",
+            ),
+        ):
+            forecasts.append(
+                forecast(
+                    df,
+                    predictors,
+                    predicted,
+                    forecaster_type,
+                    prediction_length,
+                    on_progress=lambda progress, label, step=step: progress_bar.progress(
+                        progress, text=f"{step} {label}".rstrip()
+                    ),
+                )
+            )
+        progress_bar.empty()
+        df_forecast, df_forecast_as_of = forecasts
 
-        fig = create_forecast_plot(
+        fig = forecast_plot(
             df_merged,
             df_merged_as_of,
             df_forecast,
@@ -235,11 +381,89 @@ if predict_button:
             predicted,
         )
         # Store the plot in session state
-        st.session_state.forecast_plot = fig
+        session_memory.put("forecast_plot", fig)
+        session_memory.pop("forecast_scores")
+
+    # Only the fragment reran; show the new plot (or the job progress) below it
+    st.rerun()
+
+
+settings_section()
+
+
+@st.fragment(run_every=1.0)
+@profiled_fragment(__file__)
+def poll_forecast_jobs():
+    forecast_jobs = st.session_state.forecast_jobs
+    jobs = [get_job(key) for key in forecast_jobs["keys"]]
+    failed = [job for job in jobs if job is None or job["status"] in (FAILED, CANCELLED)]
+    if failed:
+        # Shown below until the next forecast, as this fragment stops polling
+        error = failed[0]["error"] if failed[0] is not None else None
+        st.session_state.forecast_error = (
+            f"Error: {error or 'the forecast was cancelled'}"
+        )
+        session_memory.pop("forecast_data")
+        del st.session_state.forecast_jobs
+        st.rerun()
+    if any(job["status"] != DONE for job in jobs):
+        progress = sum(job["progress"] for job in jobs) / len(jobs)
+        st.progress(progress, text="Calculating forecasts in the background...")
+        return
+
+    df_merged, df_merged_as_of, df_actual = session_memory.get("forecast_data")
+    init_date_ = forecast_jobs["init_date"]
+    predicted_ = forecast_jobs["predicted"]
+    forecaster_types = forecast_jobs["forecaster_types"]
+    if forecaster_types is None:
+        fig = forecast_plot(
+            df_merged,
+            df_merged_as_of,
+            jobs[0]["result"],
+            jobs[1]["result"],
+            df_actual,
+            init_date_,
+            predicted_,
+        )
+    else:
+        # The jobs were submitted as (latest, as of) pairs, one per forecaster
+        forecasts = {
+            forecaster_type: (jobs[2 * i]["result"], jobs[2 * i + 1]["result"])
+            for i, forecaster_type in enumerate(forecaster_types)
+        }
+        fig = forecast_comparison_plot(
+            df_merged, df_merged_as_of, forecasts, df_actual, init_date_, predicted_
+        )
+        session_memory.put("forecast_scores", forecast_scores(forecasts, df_actual))
+    session_memory.put("forecast_plot", fig)
+    session_memory.pop("forecast_data")
+    del st.session_state.forecast_jobs
+    st.rerun()
+
+
+if st.session_state.get("forecast_jobs") is not None:
+    poll_forecast_jobs()
+
+if "forecast_error" in st.session_state:
+    st.error(st.session_state.forecast_error, icon="🚨")
 
 # Display the plot if it exists in session state
-if st.session_state.forecast_plot is not None:
-    st.plotly_chart(st.session_state.forecast_plot, use_container_width=True)
+if "forecast_plot" in st.session_state:
+    plotly_chart(
+        session_memory.get("forecast_plot"), "forecast", use_container_width=True
+    )
+
+if "forecast_scores" in st.session_state:
+    st.markdown("**Accuracy against the actual values:**")
+    st.dataframe(
+        session_memory.get("forecast_scores"),
+        hide_index=True,
+        column_config={
+            "MAE": st.column_config.NumberColumn(format="%.3f"),
+            "RMSE": st.column_config.NumberColumn(format="%.3f"),
+            "90% interval coverage": st.column_config.NumberColumn(format="%.2f"),
+        },
+    )
 
 # Show help text below the plot
 if st.session_state.show_help_forecast_2:
@@ -247,3 +471,6 @@ if st.session_state.show_help_forecast_2:
         helper_content.format(text=forecasting_page_helpers["help_2"]),
         unsafe_allow_html=True,
     )
+
+render_performance_panel()
+finish_rerun_profile()
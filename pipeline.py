@@ -0,0 +1,416 @@
+"""
+Memoized computation graph for the page pipelines.
+
+The pages chain metadata lookups, fetches, merges, correlations or forecasts and
+plots. Each of these steps is a Node that is memoized on a fingerprint of its
+inputs, so a rerun in which one input changed only recomputes the nodes downstream
+of it: changing the correlation method recomputes the correlation and the plot, not
+the fetch or the merge.
+
+Fingerprints form a Merkle tree. A node's key combines its name with the
+fingerprints of its arguments: DataFrames and arrays are hashed by content,
+other values by their repr. The result of a node is identified by that key, so
+handing it to the next node costs nothing to fingerprint. Nodes whose result can
+change for the same arguments (fetches of the latest data) only keep it for `ttl`
+seconds and fingerprint it by content instead, so downstream nodes are recomputed
+only if the data did change. Nodes declare the types of their main inputs and of
+their result (see Node's `types` and `returns`), which are checked on every call.
+
+Results are kept in a process-wide LRU of PIPELINE_CACHE_SIZE entries shared by
+all sessions and are returned as they are, not copied: callers must not modify them.
+For the same reason node functions must not call Streamlit: a node is computed by
+whichever session asks first, on behalf of all of them. Progress is passed to the
+callers as plain values instead (see Node's `progress`).
+Merged signals are also shared with other server processes through the Arrow plane.
+Per-node hits, misses and compute times are shown in the Performance panel (the
+"pipeline" metrics and the pipeline.<node> spans).
+"""
+
+import hashlib
+import inspect
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+from analysis_tools import (
+    compare_forecasters,
+    fetch_covidcast_data,
+    merge_dataframes,
+    run_epi_predict,
+)
+from arrow_plane import arrow_plane
+from correlation_engine import CorrelationTensor, correlation_tensor
+from data_cache import LATEST_DATA_TTL_S, frame_fingerprint
+from fetch_scheduler import INTERACTIVE
+from instrumentation import register_metrics, span
+from plotting_utils import (
+    create_forecast_comparison_plot,
+    create_forecast_plot,
+    create_lag_slider_plot,
+)
+from single_flight import SingleFlight
+from utils import covidcast_metadata, get_shared_dates
+
+MAX_ENTRIES = int(os.environ.get("PIPELINE_CACHE_SIZE", 256))
+
+_SCALARS = (str, int, float, bool, type(None), date, datetime, np.generic)
+
+_results = OrderedDict()  # key -> (value, fingerprint, expires_at)
+_key_by_id = {}  # id of a cached value -> its key
+_pinned = {}  # id -> (value, fingerprint) of long-lived inputs, see pin()
+_nodes = {}  # name -> Node
+_lock = threading.Lock()
+_flight = SingleFlight("pipeline")
+
+
+def _digest(*parts):
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def _known_fingerprint(value):
+    with _lock:
+        pinned = _pinned.get(id(value))
+        if pinned is not None and pinned[0] is value:
+            return pinned[1]
+        key = _key_by_id.get(id(value))
+        if key is not None and _results[key][0] is value:
+            return _results[key][1]
+    return None
+
+
+def fingerprint(value):
+    """
+    Content fingerprint of a node argument.
+
+    Args:
+        value: A node result, a DataFrame, Series or array, a scalar (including
+            dates), or a list, tuple or dict of these
+
+    Returns:
+        str: Hex digest; equal values have equal fingerprints
+    """
+    known = _known_fingerprint(value)
+    if known is not None:
+        return known
+    if isinstance(value, pd.DataFrame):
+        return frame_fingerprint(value)
+    if isinstance(value, pd.Series):
+        return frame_fingerprint(value.to_frame())
+    if isinstance(value, np.ndarray):
+        digest = hashlib.sha1(repr((value.dtype.str, value.shape)).encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+        return digest.hexdigest()
+    if isinstance(value, _SCALARS):
+        return _digest(type(value).__name__, repr(value))
+    if isinstance(value, (list, tuple)):
+        return _digest(type(value).__name__, [fingerprint(item) for item in value])
+    if isinstance(value, dict):
+        return _digest(
+            "dict",
+            sorted((fingerprint(k), fingerprint(v)) for k, v in value.items()),
+        )
+    raise TypeError(f"Cannot fingerprint a {type(value).__name__}")
+
+
+def is_result(value):
+    """Whether `value` is a result currently held in the pipeline's cache."""
+    with _lock:
+        key = _key_by_id.get(id(value))
+        return key is not None and _results[key][0] is value
+
+
+def pin(value):
+    """
+    Fingerprint a long-lived, never modified input once (e.g. the bundled metadata)
+    instead of on every call.
+    """
+    with _lock:
+        if id(value) in _pinned:
+            return
+    fp = fingerprint(value)
+    with _lock:
+        _pinned[id(value)] = (value, fp)
+
+
+def _lookup(key):
+    with _lock:
+        entry = _results.get(key)
+        if entry is None:
+            return None
+        if entry[2] is not None and entry[2] < time.time():
+            _remove(key)
+            return None
+        _results.move_to_end(key)
+        return entry
+
+
+def _remove(key):
+    value, _, _ = _results.pop(key)
+    _key_by_id.pop(id(value), None)
+
+
+def _store(key, value, fp, ttl):
+    with _lock:
+        if key in _results:
+            _remove(key)
+        _results[key] = (value, fp, None if ttl is None else time.time() + ttl)
+        _key_by_id[id(value)] = key
+        while len(_results) > MAX_ENTRIES:
+            _remove(next(iter(_results)))
+
+
+class Node:
+    """
+    A memoized step of a page pipeline; call it like the wrapped function.
+
+    Args:
+        func: The function computing the step
+        name: Name in the metrics (default: the function's name)
+        ttl: Seconds a result is kept, or a callable returning them for the bound
+            arguments (a dict); None keeps results until evicted. Results with a
+            ttl are fingerprinted by content.
+        ignore: Names of arguments that do not affect the result (e.g. progress
+            labels); they are left out of the key
+        progress: Name of the argument of `func` taking a progress callable, if
+            any; it is left out of the key, and every caller waiting for the same
+            result receives the progress through its own callable
+        shared: Whether results (DataFrames) are shared with the other server
+            processes through the Arrow plane (see arrow_plane)
+        types: Dict mapping argument names to the type (or tuple of types) their
+            values must have; for *args, every value. Checked on every call, so a
+            wrongly wired pipeline fails at the node instead of in a later step.
+        returns: Type (or tuple of types) the result must have; a result of
+            another type raises a TypeError and is not cached
+    """
+
+    def __init__(
+        self,
+        func,
+        name=None,
+        ttl=None,
+        ignore=(),
+        progress=None,
+        shared=False,
+        types=None,
+        returns=None,
+    ):
+        self.func = func
+        self.name = name or func.__name__
+        self.ttl = ttl
+        self.ignore = set(ignore) | ({progress} if progress else set())
+        self.progress = progress
+        self.shared = shared
+        self.types = types or {}
+        self.returns = returns
+        self.signature = inspect.signature(func)
+        self.hits = 0
+        self.misses = 0
+        self.compute_s = 0.0
+        with _lock:
+            _nodes[self.name] = self
+
+    def _arguments(self, args, kwargs):
+        bound = self.signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        return bound.arguments
+
+    def _check(self, what, value, expected):
+        if not isinstance(value, expected):
+            names = (
+                " or ".join(t.__name__ for t in expected)
+                if isinstance(expected, tuple)
+                else expected.__name__
+            )
+            raise TypeError(
+                f"Node {self.name}: {what} must be a {names}, not a {type(value).__name__}"
+            )
+
+    def _check_arguments(self, arguments):
+        for name, expected in self.types.items():
+            if name not in arguments:
+                continue
+            if self.signature.parameters[name].kind == inspect.Parameter.VAR_POSITIONAL:
+                for value in arguments[name]:
+                    self._check(name, value, expected)
+            else:
+                self._check(name, arguments[name], expected)
+
+    def key(self, *args, **kwargs):
+        """The memo key (and Merkle fingerprint) of a call with these arguments."""
+        return self._key(self._arguments(args, kwargs))
+
+    def _key(self, arguments):
+        return _digest(
+            self.name,
+            [
+                (name, fingerprint(value))
+                for name, value in arguments.items()
+                if name not in self.ignore
+            ],
+        )
+
+    def _ttl(self, args, kwargs):
+        if callable(self.ttl):
+            return self.ttl(self._arguments(args, kwargs))
+        return self.ttl
+
+    def __call__(self, *args, **kwargs):
+        arguments = self._arguments(args, kwargs)
+        self._check_arguments(arguments)
+        key = self._key(arguments)
+        entry = _lookup(key)
+        if entry is not None:
+            with _lock:
+                self.hits += 1
+            return entry[0]
+
+        elapsed = []
+        bound = self.signature.bind(*args, **kwargs)
+        on_progress = bound.arguments.get(self.progress) if self.progress else None
+
+        def compute(report):
+            # The shared computation reports to every caller, never to the UI of
+            # the session that happens to run it
+            if self.progress:
+                bound.arguments[self.progress] = report
+            start = time.perf_counter()
+            ttl = self._ttl(args, kwargs)
+            with span(f"pipeline.{self.name}"):
+                if self.shared:
+                    value = arrow_plane.get_or_load(
+                        ("pipeline", key),
+                        lambda: self.func(*bound.args, **bound.kwargs),
+                        ttl=ttl,
+                    )
+                else:
+                    value = self.func(*bound.args, **bound.kwargs)
+            if self.returns is not None:
+                self._check("the result", value, self.returns)
+            fp = key if ttl is None else fingerprint(value)
+            _store(key, value, fp, ttl)
+            elapsed.append(time.perf_counter() - start)
+            return value
+
+        # Sessions asking for the same result at the same time share one computation
+        value = _flight.do_with_progress(key, compute, on_progress)
+        with _lock:
+            if elapsed:
+                self.misses += 1
+                self.compute_s += elapsed[0]
+            else:
+                self.hits += 1
+        return value
+
+
+def stats():
+    with _lock:
+        nodes = sorted(_nodes.items())
+        values = {"entries": len(_results)}
+    for name, node in nodes:
+        calls = node.hits + node.misses
+        values[f"{name}_hits"] = node.hits
+        values[f"{name}_misses"] = node.misses
+        values[f"{name}_hit_rate"] = round(node.hits / calls, 3) if calls else 0.0
+        values[f"{name}_compute_s"] = round(node.compute_s, 3)
+    return values
+
+
+register_metrics("pipeline", stats)
+
+
+def _fetch_ttl(arguments):
+    # Data as of a date does not change; the latest data is refetched like the cache
+    return None if arguments["as_of"] else LATEST_DATA_TTL_S
+
+
+# The nodes of the pages' pipelines
+pin(covidcast_metadata)
+# The streamed dual-axis preview on the correlation page is drawn from partial
+# chunks that are never asked for twice, so it is not a node
+shared_dates = Node(get_shared_dates, types={"metadata": pd.DataFrame}, returns=tuple)
+fetch_signal = Node(
+    fetch_covidcast_data,
+    ttl=_fetch_ttl,
+    ignore=("priority", "bulk"),
+    returns=pd.DataFrame,
+)
+merge_signals = Node(
+    merge_dataframes, shared=True, types={"dfs": pd.DataFrame}, returns=pd.DataFrame
+)
+lag_correlations = Node(
+    correlation_tensor, types={"frames": dict}, returns=CorrelationTensor
+)
+forecast = Node(
+    run_epi_predict,
+    name="epi_predict",
+    progress="on_progress",
+    types={"df": pd.DataFrame},
+    returns=pd.DataFrame,
+)
+forecaster_comparison = Node(
+    compare_forecasters,
+    progress="on_progress",
+    types={"df": pd.DataFrame, "df_as_of": pd.DataFrame},
+    returns=dict,
+)
+lag_slider_plot = Node(
+    create_lag_slider_plot,
+    types={"df1": pd.DataFrame, "df2": pd.DataFrame, "lags_and_correlations": dict},
+    returns=go.Figure,
+)
+_FORECAST_FRAMES = {"df_merged": pd.DataFrame, "df_merged_as_of": pd.DataFrame}
+forecast_plot = Node(create_forecast_plot, types=_FORECAST_FRAMES, returns=go.Figure)
+forecast_comparison_plot = Node(
+    create_forecast_comparison_plot,
+    types={**_FORECAST_FRAMES, "forecasts": dict},
+    returns=go.Figure,
+)
+
+
+def fetch_signals(
+    geo_type,
+    geo_value,
+    sources_and_signals,
+    init_date,
+    final_date,
+    time_type,
+    as_of=None,
+    priority=INTERACTIVE,
+):
+    """
+    fetch_covidcast_data_multi as a pipeline: one fetch node per signal and a merge node.
+
+    Args:
+        geo_type: Geographic level, e.g. "nation"
+        geo_value: Region code
+        sources_and_signals: List of (source, signal) tuples
+        init_date: First epidate or epiweek
+        final_date: Last epidate or epiweek
+        time_type: "day" or "week"
+        as_of: Optional "YYYY-MM-DD" revision date
+        priority: Priority of the fetches in the fetch scheduler
+
+    Returns:
+        pd.DataFrame: The merged signals, as returned by merge_dataframes
+    """
+    return merge_signals(
+        *(
+            fetch_signal(
+                geo_type,
+                geo_value,
+                source_and_signal,
+                init_date,
+                final_date,
+                time_type,
+                as_of=as_of,
+                priority=priority,
+            )
+            for source_and_signal in sources_and_signals
+        )
+    )
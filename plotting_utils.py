@@ -1,21 +1,139 @@
+import os
+import threading
+import warnings
+
 import numpy as np
 from scipy.stats import gaussian_kde
 import plotly.graph_objects as go
 import plotly.subplots as make_subplots
 from datetime import datetime, timedelta, date
-from analysis_tools import calculate_epi_correlation
 from available_signals import sources_to_names
+from helper_texts import forecasters_to_display
+from geo_codes import hhs_region_by_state, load_boundaries, region_to_display
+from instrumentation import register_metrics, timed
 import pandas as pd
 
+# Time series longer than PLOT_MAX_POINTS are downsampled with LTTB, and traces
+# with more than PLOT_WEBGL_THRESHOLD points are drawn with WebGL instead of SVG
+PLOT_MAX_POINTS = int(os.environ.get("PLOT_MAX_POINTS", 2000))
+PLOT_WEBGL_THRESHOLD = int(os.environ.get("PLOT_WEBGL_THRESHOLD", 1000))
+
+
+class _TraceStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.traces = 0
+        self.downsampled = 0
+        self.webgl = 0
+        self.points_in = 0
+        self.points_out = 0
+
+    def add(self, points_in, points_out, downsampled, webgl):
+        with self._lock:
+            self.traces += 1
+            self.downsampled += downsampled
+            self.webgl += webgl
+            self.points_in += points_in
+            self.points_out += points_out
+
+    def __call__(self):
+        with self._lock:
+            return {
+                "traces": self.traces,
+                "downsampled": self.downsampled,
+                "webgl": self.webgl,
+                "points_in": self.points_in,
+                "points_out": self.points_out,
+            }
+
+
+_trace_stats = _TraceStats()
+
+
+def lttb_indices(x, y, n_out):
+    """
+    Indices of the points kept by Largest-Triangle-Three-Buckets downsampling.
+
+    The first and last points are kept; every bucket in between keeps the point
+    forming the largest triangle with the point kept in the previous bucket and the
+    mean of the next bucket, which preserves peaks and troughs.
+
+    Args:
+        x: Increasing numeric x values
+        y: y values (finite)
+        n_out: Number of points to keep
+
+    Returns:
+        np.ndarray: Sorted indices into x and y
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    selected = np.empty(n_out, dtype=int)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, stop = edges[i], edges[i + 1]
+        next_stop = edges[i + 2] if i + 2 < len(edges) else n
+        mean_x = x[stop:next_stop].mean()
+        mean_y = y[stop:next_stop].mean()
+        area = np.abs(
+            (x[a] - mean_x) * (y[start:stop] - y[a])
+            - (x[a] - x[start:stop]) * (mean_y - y[a])
+        )
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def time_series_trace(x, y, **kwargs):
+    """
+    A line trace for a time series, downsampled and drawn with WebGL if it is long.
+
+    The points are chosen once, over the whole series, when the figure is built:
+    zooming into a downsampled trace in the browser shows the same points, not the
+    full resolution of the visible range (Streamlit does not send the zoom back to
+    the server, so the trace cannot be resampled as plotly-resampler does).
+
+    Args:
+        x: Dates (or numbers) in increasing order
+        y: Values; missing values are dropped
+        **kwargs: Passed to go.Scatter / go.Scattergl
+
+    Returns:
+        go.Scatter or go.Scattergl
+    """
+    x = np.asarray(x)
+    y = np.asarray(y, dtype=float)
+    finite = np.isfinite(y)
+    x, y = x[finite], y[finite]
+    points_in = len(x)
+    if points_in > PLOT_MAX_POINTS:
+        numeric_x = x if np.issubdtype(x.dtype, np.number) else pd.to_datetime(x).asi8
+        keep = lttb_indices(numeric_x, y, PLOT_MAX_POINTS)
+        x, y = x[keep], y[keep]
+    webgl = len(x) > PLOT_WEBGL_THRESHOLD
+
+    _trace_stats.add(points_in, len(x), points_in > len(x), webgl)
+    return (go.Scattergl if webgl else go.Scatter)(x=x, y=y, **kwargs)
+
+
+register_metrics("plot_traces", _trace_stats)
+
 
+@timed("plot.create_plotly_dual_axis")
 def create_plotly_dual_axis(df1, df2, name1, name2, title, annotation_text):
     fig = make_subplots.make_subplots(specs=[[{"secondary_y": True}]])
 
     # Add traces with specific colors
     fig.add_trace(
-        go.Scatter(
-            x=df1["time_value"],
-            y=df1["value"],
+        time_series_trace(
+            df1["time_value"],
+            df1["value"],
             name=name1,
             line=dict(color="#1f77b4"),  # Default matplotlib blue
         ),
@@ -23,9 +141,9 @@ def create_plotly_dual_axis(df1, df2, name1, name2, title, annotation_text):
     )
 
     fig.add_trace(
-        go.Scatter(
-            x=df2["time_value"],
-            y=df2["value"],
+        time_series_trace(
+            df2["time_value"],
+            df2["value"],
             name=name2,
             line=dict(color="#ff7f0e"),  # Default matplotlib orange
         ),
@@ -75,50 +193,131 @@ def create_plotly_dual_axis(df1, df2, name1, name2, title, annotation_text):
     return fig
 
 
-def update_plot_with_lag(
-    df1,
-    df2,
-    signal_display1,
-    signal_display2,
-    geo_type,
-    region_display,
-    lag,
-    time_type,
-    correlation_method,
-):
-    lag_days = lag if time_type == "day" else lag * 7
-    # the shift in the displayed signal1 is opposite to lag_days
-    # this is because a lag of dt1=-10 means that signal1 is correlated with the values of signal2 10 days into the future
-    # e.g. Covid-19 cases on 1st of June are correlated with deaths on 11th of June
-    # to visualise this correlation, we therefore need to shift signal1 in the opposite direction to sign(lag)
-    df1_shifted = df1.copy()
-    df1_shifted["time_value"] = df1_shifted["time_value"] + timedelta(days=-lag_days)
+@timed("plot.create_lag_slider_plot")
+def create_lag_slider_plot(
+    df1, df2, name1, name2, title, lags_and_correlations: dict, time_type: str
+) -> go.Figure:
+    """
+    Creates the dual-axis plot of two signals with a slider that shifts signal 1.
 
-    title = f"Comparison of {signal_display1} vs {signal_display2} in {geo_type.capitalize()} {region_display}"
-    annotation_text = f"Time lag of {signal_display1}: {lag} {time_type}s"
+    Signal 1 is drawn on a regular time grid (x0 + i * dx), so each slider step
+    only changes its x0 and the annotation with the correlation at that lag. All
+    lags are encoded in the figure and scrubbing through them runs in the browser.
+
+    Args:
+        df1: Signal 1 (single region)
+        df2: Signal 2 (single region)
+        name1, name2: Display names of the signals
+        title: Title of the figure
+        lags_and_correlations: Dictionary mapping lags to correlation values
+        time_type: String indicating the time unit ('day' or 'week')
 
-    fig = create_plotly_dual_axis(
-        df1_shifted, df2, signal_display1, signal_display2, title, annotation_text
+    Returns:
+        Plotly figure object
+    """
+    lags = sorted(lags_and_correlations)
+    step = timedelta(days=7 if time_type == "week" else 1)
+
+    # Signal 1 on a regular grid; long series are averaged over `stride` steps
+    series = df1.groupby("time_value")["value"].mean()
+    start = series.index.min()
+    n_steps = (series.index.max() - start) // step + 1
+    values = np.full(n_steps, np.nan)
+    values[[(t - start) // step for t in series.index]] = series.to_numpy()
+    stride = -(-n_steps // PLOT_MAX_POINTS)
+    if stride > 1:
+        padded = np.full(-(-n_steps // stride) * stride, np.nan)
+        padded[:n_steps] = values
+        with np.errstate(invalid="ignore"), warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            values = np.nanmean(padded.reshape(-1, stride), axis=1)
+    # Each point sits in the middle of the steps it averages
+    first = start + step * (stride - 1) / 2
+
+    def annotation(lag):
+        cor = lags_and_correlations[lag]
+        cor_text = "n/a" if cor is None or np.isnan(cor) else f"{cor:.3f}"
+        return f"Time lag of {name1}: {lag} {time_type}s, correlation: {cor_text}"
+
+    def x0(lag):
+        # A lag of -10 means that signal 1 is correlated with the values of signal 2
+        # 10 days into the future (e.g. cases on 1st of June with deaths on 11th of
+        # June); to visualise this, signal 1 is shifted opposite to sign(lag)
+        return (first - step * lag).isoformat()
+
+    fig = create_plotly_dual_axis(df1, df2, name1, name2, title, annotation(0))
+    fig.data[0].update(
+        x=None,
+        y=values,
+        x0=x0(0),
+        dx=(step * stride).total_seconds() * 1000,
+        connectgaps=True,
     )
 
-    cor_df = calculate_epi_correlation(
-        df1, df2, cor_by="geo_value", lag=lag_days, method=correlation_method
+    fig.update_layout(
+        sliders=[
+            dict(
+                active=lags.index(0),
+                currentvalue=dict(prefix=f"Time lag ({time_type}s): "),
+                pad=dict(t=50),
+                steps=[
+                    dict(
+                        label=str(lag),
+                        method="update",
+                        args=[
+                            {"x0": [x0(lag)]},
+                            {"annotations[0].text": annotation(lag)},
+                            [0],
+                        ],
+                    )
+                    for lag in lags
+                ],
+            )
+        ],
+        height=700,
     )
-    return fig, cor_df.iloc[0]["cor"].round(3)
+    return fig
 
 
-def plot_correlation_vs_lag(lags_and_correlations: dict, time_type: str) -> go.Figure:
+@timed("plot.plot_correlation_vs_lag")
+def plot_correlation_vs_lag(
+    lags_and_correlations: dict, time_type: str, bootstrap=None
+) -> go.Figure:
     """
     Creates a plotly figure showing correlation vs time lag.
 
     Args:
         lags_and_correlations: Dictionary mapping lags to correlation values
         time_type: String indicating the time unit ('day' or 'week')
+        bootstrap: Optional BootstrapResult from
+            correlation_engine.bootstrap_lag_correlations, drawn as a confidence band
+            and an interval for the best lag
 
     Returns:
         Plotly figure object
     """
     fig = go.Figure()
+    if bootstrap is not None:
+        fig.add_trace(
+            go.Scatter(
+                x=list(bootstrap.lags) + list(bootstrap.lags)[::-1],
+                y=list(bootstrap.upper) + list(bootstrap.lower)[::-1],
+                fill="toself",
+                fillcolor="rgba(31, 119, 180, 0.2)",
+                line=dict(width=0),
+                hoverinfo="skip",
+                name=f"{bootstrap.confidence:.0%} confidence band",
+            )
+        )
+        lower_lag, upper_lag = bootstrap.best_lag_interval
+        fig.add_vrect(
+            x0=lower_lag - 0.5,
+            x1=upper_lag + 0.5,
+            fillcolor="rgba(255, 127, 14, 0.15)",
+            line_width=0,
+            annotation_text="Best lag CI",
+            annotation_position="top left",
+        )
     fig.add_trace(
         go.Scatter(
             x=list(lags_and_correlations.keys()),
@@ -135,6 +334,7 @@ def plot_correlation_vs_lag(lags_and_correlations: dict, time_type: str) -> go.F
     return fig
 
 
+@timed("plot.plot_correlation_distribution")
 def plot_correlation_distribution(lags_and_correlations: dict) -> go.Figure:
     """
     Creates a plotly figure showing the distribution of correlations using KDE.
@@ -161,6 +361,52 @@ def plot_correlation_distribution(lags_and_correlations: dict) -> go.Figure:
     return fig
 
 
+def _with_start_point(df_forecast, df_merged, predicted_col_name, prediction_date):
+    """Prepend the last historical value at prediction_date, so the forecast line starts there."""
+    last_historical_value = df_merged[df_merged["time_value"] <= prediction_date][
+        predicted_col_name
+    ].iloc[-1]
+    forecast_start = pd.DataFrame(
+        {
+            "target_date": [prediction_date],
+            ".pred": [last_historical_value],
+            ".pred_upper": [last_historical_value],
+            ".pred_lower": [last_historical_value],
+        }
+    )
+    return pd.concat([forecast_start, df_forecast], ignore_index=True)
+
+
+def _add_prediction_date(fig, prediction_date):
+    # Convert prediction_date to datetime if it's a date object
+    if isinstance(prediction_date, date):
+        prediction_date = datetime.combine(prediction_date, datetime.min.time())
+
+    # Add vertical line at prediction date
+    fig.add_shape(
+        type="line",
+        x0=prediction_date,
+        x1=prediction_date,
+        y0=0,
+        y1=1,
+        yref="paper",
+        line=dict(
+            color="gray",
+        ),
+    )
+
+    # Add annotation for the prediction date
+    fig.add_annotation(
+        x=prediction_date,
+        y=1,
+        yref="paper",
+        text="Prediction date",
+        showarrow=False,
+        yshift=25,
+    )
+
+
+@timed("plot.create_forecast_plot")
 def create_forecast_plot(
     df_merged,
     df_merged_as_of,
@@ -212,45 +458,20 @@ def create_forecast_plot(
         df_merged_as_of["time_value"] >= historical_start
     ]
 
-    # Get the last historical values at prediction_date
-    last_historical_value = df_merged[df_merged["time_value"] <= prediction_date][
-        predicted_col_name
-    ].iloc[-1]
-    last_historical_value_as_of = df_merged_as_of[
-        df_merged_as_of["time_value"] <= prediction_date
-    ][predicted_col_name].iloc[-1]
-
-    # Add the prediction_date point to the forecast DataFrames
-    forecast_start = pd.DataFrame(
-        {
-            "target_date": [prediction_date],
-            ".pred": [last_historical_value],
-            ".pred_upper": [last_historical_value],
-            ".pred_lower": [last_historical_value],
-        }
+    df_forecast = _with_start_point(
+        df_forecast, df_merged, predicted_col_name, prediction_date
     )
-    forecast_as_of_start = pd.DataFrame(
-        {
-            "target_date": [prediction_date],
-            ".pred": [last_historical_value_as_of],
-            ".pred_upper": [last_historical_value_as_of],
-            ".pred_lower": [last_historical_value_as_of],
-        }
-    )
-
-    # Concatenate with the original forecast DataFrames
-    df_forecast = pd.concat([forecast_start, df_forecast], ignore_index=True)
-    df_forecast_as_of = pd.concat(
-        [forecast_as_of_start, df_forecast_as_of], ignore_index=True
+    df_forecast_as_of = _with_start_point(
+        df_forecast_as_of, df_merged_as_of, predicted_col_name, prediction_date
     )
 
     fig = go.Figure()
 
     # Historical data (Latest)
     fig.add_trace(
-        go.Scatter(
-            x=df_merged_filtered["time_value"],
-            y=df_merged_filtered[predicted_col_name],
+        time_series_trace(
+            df_merged_filtered["time_value"],
+            df_merged_filtered[predicted_col_name],
             name="Historical (latest)",
             line=dict(color="blue"),
             mode="lines",
@@ -261,9 +482,9 @@ def create_forecast_plot(
 
     # Historical data (As of prediction)
     fig.add_trace(
-        go.Scatter(
-            x=df_merged_as_of_filtered["time_value"],
-            y=df_merged_as_of_filtered[predicted_col_name],
+        time_series_trace(
+            df_merged_as_of_filtered["time_value"],
+            df_merged_as_of_filtered[predicted_col_name],
             name="Historical (as of prediction)",
             line=dict(color="lightblue"),
             mode="lines",
@@ -337,9 +558,9 @@ def create_forecast_plot(
 
     # Actual values
     fig.add_trace(
-        go.Scatter(
-            x=df_actual["time_value"],
-            y=df_actual["value"],
+        time_series_trace(
+            df_actual["time_value"],
+            df_actual["value"],
             name="Actual values",
             line=dict(color="green"),
             mode="lines",
@@ -347,36 +568,130 @@ def create_forecast_plot(
         )
     )
 
-    # Convert prediction_date to datetime if it's a date object
-    if isinstance(prediction_date, date):
-        prediction_date = datetime.combine(prediction_date, datetime.min.time())
+    _add_prediction_date(fig, prediction_date)
 
-    # Add vertical line at prediction date
-    fig.add_shape(
-        type="line",
-        x0=prediction_date,
-        x1=prediction_date,
-        y0=0,
-        y1=1,
-        yref="paper",
-        line=dict(
-            color="gray",
-        ),
+    # Update layout
+    fig.update_layout(
+        title=f"Forecast for {predicted_name}",
+        xaxis_title="Date",
+        yaxis_title="Value",
+        hovermode="x unified",
+        showlegend=True,
+        legend=dict(yanchor="top", y=0.99, xanchor="left", x=0.01),
     )
 
-    # Add annotation for the prediction date
-    fig.add_annotation(
-        x=prediction_date,
-        y=1,
-        yref="paper",
-        text="Prediction date",
-        showarrow=False,
-        yshift=25,
+    return fig
+
+
+# One color per forecaster in create_forecast_comparison_plot
+FORECASTER_COLORS = ["#d62728", "#9467bd", "#ff7f0e", "#8c564b", "#e377c2"]
+
+
+@timed("plot.create_forecast_comparison_plot")
+def create_forecast_comparison_plot(
+    df_merged,
+    df_merged_as_of,
+    forecasts,
+    df_actual,
+    prediction_date,
+    predicted_source_signal,
+):
+    """
+    Overlay the forecasts of several forecasters, as returned by compare_forecasters.
+
+    Args:
+        df_merged: Historical data using latest available estimates
+        df_merged_as_of: Historical data as available at prediction time
+        forecasts: dict forecaster_type -> (forecast on the latest data, forecast
+            on the data available at prediction time)
+        df_actual: Actual observed values during the forecast period
+        prediction_date: The date when the prediction was made
+        predicted_source_signal: Source and signal of the predicted quantity
+
+    Returns:
+        plotly.graph_objects.Figure: Forecasts on the latest data are dashed, those
+            on the data available at prediction time dotted; the 90% intervals
+            can be shown from the legend
+    """
+    predicted_name = sources_to_names[predicted_source_signal]
+    predicted_col_name = "value_" + "_".join(predicted_source_signal)
+
+    target_dates = pd.concat(
+        [df_forecast["target_date"] for df_forecast, _ in forecasts.values()]
     )
+    historical_length = max((target_dates.max() - target_dates.min()).days * 3, 7)
+    historical_start = prediction_date - timedelta(days=historical_length)
+
+    fig = go.Figure()
+    for df, name, color in [
+        (df_merged, "Historical (latest)", "blue"),
+        (df_merged_as_of, "Historical (as of prediction)", "lightblue"),
+    ]:
+        df = df[df["time_value"] >= historical_start]
+        fig.add_trace(
+            time_series_trace(
+                df["time_value"],
+                df[predicted_col_name],
+                name=name,
+                line=dict(color=color),
+                mode="lines",
+                hovertemplate="%{y:.2f}<br>%{x|%Y-%m-%d}<extra></extra>",
+            )
+        )
+
+    for i, (forecaster_type, (df_forecast, df_forecast_as_of)) in enumerate(
+        forecasts.items()
+    ):
+        color = FORECASTER_COLORS[i % len(FORECASTER_COLORS)]
+        forecaster_name = forecasters_to_display.get(forecaster_type, forecaster_type)
+        for df, df_history, version, dash in [
+            (df_forecast, df_merged, "latest", "dash"),
+            (df_forecast_as_of, df_merged_as_of, "as of prediction", "dot"),
+        ]:
+            df = _with_start_point(df, df_history, predicted_col_name, prediction_date)
+            fig.add_trace(
+                go.Scatter(
+                    x=df["target_date"],
+                    y=df[".pred"],
+                    name=f"{forecaster_name} ({version})",
+                    line=dict(color=color, dash=dash),
+                    mode="lines",
+                    legendgroup=forecaster_type,
+                    hovertemplate="%{y:.2f}<br>%{x|%Y-%m-%d}<extra></extra>",
+                )
+            )
+        fig.add_trace(
+            go.Scatter(
+                x=df_forecast["target_date"].tolist()
+                + df_forecast["target_date"].tolist()[::-1],
+                y=df_forecast[".pred_upper"].tolist()
+                + df_forecast[".pred_lower"].tolist()[::-1],
+                fill="toself",
+                fillcolor=color,
+                opacity=0.2,
+                line=dict(color="rgba(0,0,0,0)"),
+                name=f"90% CI {forecaster_name} (latest)",
+                legendgroup=forecaster_type,
+                visible="legendonly",
+                hoverinfo="skip",
+            )
+        )
+
+    fig.add_trace(
+        time_series_trace(
+            df_actual["time_value"],
+            df_actual["value"],
+            name="Actual values",
+            line=dict(color="green"),
+            mode="lines",
+            hovertemplate="%{y:.2f}<br>%{x|%Y-%m-%d}<extra></extra>",
+        )
+    )
+
+    _add_prediction_date(fig, prediction_date)
 
-    # Update layout
     fig.update_layout(
-        title=f"Forecast for {predicted_name}",
+        title=f"Forecasts for {predicted_name}",
         xaxis_title="Date",
         yaxis_title="Value",
         hovermode="x unified",
@@ -385,3 +700,186 @@ def create_forecast_plot(
     )
 
     return fig
+
+
+@timed("plot.plot_correlation_heatmap")
+def plot_correlation_heatmap(tensor, time_type: str) -> go.Figure:
+    """
+    Creates a heatmap of the correlation of every pair of signals at every time lag.
+
+    Args:
+        tensor: CorrelationTensor from correlation_engine.correlation_tensor
+        time_type: String indicating the time unit ('day' or 'week')
+
+    Returns:
+        Plotly figure object
+    """
+    pair_labels = [f"{name1} vs {name2}" for name1, name2 in tensor.pairs]
+
+    fig = go.Figure()
+    fig.add_trace(
+        go.Heatmap(
+            z=tensor.values,
+            x=tensor.lags,
+            y=pair_labels,
+            colorscale="RdBu",
+            zmin=-1,
+            zmax=1,
+            zmid=0,
+            colorbar=dict(title="Correlation"),
+            hovertemplate="%{y}<br>Lag: %{x}<br>Correlation: %{z:.3f}<extra></extra>",
+        )
+    )
+
+    # Mark the best lag of each pair
+    best_x, best_y = [], []
+    for label, values in zip(pair_labels, tensor.values):
+        if not np.all(np.isnan(values)):
+            best_x.append(tensor.lags[int(np.nanargmax(values))])
+            best_y.append(label)
+    fig.add_trace(
+        go.Scatter(
+            x=best_x,
+            y=best_y,
+            mode="markers",
+            marker=dict(symbol="x", color="black", size=8),
+            name="Best lag",
+            hoverinfo="skip",
+        )
+    )
+
+    fig.update_layout(
+        title=dict(text="Correlation vs Time Lag for All Pairs of Signals"),
+        xaxis_title=f"Time Lag of the first signal ({time_type}s)",
+        height=max(400, 30 * len(pair_labels) + 150),
+        showlegend=False,
+        yaxis=dict(autorange="reversed"),
+    )
+    return fig
+
+
+@timed("plot.plot_rolling_correlation_heatmap")
+def plot_rolling_correlation_heatmap(rolling, time_type: str) -> go.Figure:
+    """
+    Creates a lag x time heatmap of the correlation in a sliding window.
+
+    Args:
+        rolling: RollingCorrelation from correlation_engine.rolling_lag_correlation
+        time_type: String indicating the time unit ('day' or 'week')
+
+    Returns:
+        Plotly figure object
+    """
+    fig = go.Figure()
+    fig.add_trace(
+        go.Heatmap(
+            z=rolling.values,
+            x=rolling.window_ends,
+            y=rolling.lags,
+            colorscale="RdBu",
+            zmin=-1,
+            zmax=1,
+            zmid=0,
+            colorbar=dict(title="Correlation"),
+            hovertemplate="Window ending %{x}<br>Lag: %{y}<br>Correlation: %{z:.3f}<extra></extra>",
+        )
+    )
+
+    # Trace the best lag of each window
+    values = np.where(np.isnan(rolling.values), -np.inf, rolling.values)
+    has_values = ~np.all(np.isnan(rolling.values), axis=0)
+    best_lags = np.array(rolling.lags)[np.argmax(values, axis=0)]
+    fig.add_trace(
+        go.Scatter(
+            x=np.asarray(rolling.window_ends)[has_values],
+            y=best_lags[has_values],
+            mode="lines",
+            line=dict(color="black", width=1.5),
+            name="Best lag",
+        )
+    )
+
+    fig.update_layout(
+        title=dict(
+            text=f"Correlation in a {rolling.window}-{time_type} Sliding Window",
+            x=0.5,
+            xanchor="center",
+        ),
+        xaxis_title="End of window",
+        yaxis_title=f"Time Lag ({time_type}s)",
+        height=500,
+        showlegend=False,
+    )
+    return fig
+
+
+@timed("plot.plot_region_map")
+def plot_region_map(best, geo_type: str, column: str, title: str) -> go.Figure:
+    """
+    Creates a choropleth of the best time lag or peak correlation of each region.
+
+    Args:
+        best: DataFrame from correlation_engine.region_best_lags
+        geo_type: geo_type of the regions
+        column: "best_lag" or "correlation"
+        title: Title of the figure (also used for the color bar)
+
+    Returns:
+        Plotly figure object, or None if there are no boundaries for the geo_type
+            (see geo_codes.BOUNDARY_FILES)
+    """
+    best = best.dropna(subset=[column])
+    names = [region_to_display(geo_type, geo_value) for geo_value in best["geo_value"]]
+    if column == "correlation":
+        colors = dict(colorscale="RdBu", zmin=-1, zmax=1, zmid=0)
+    else:
+        colors = dict(colorscale="Viridis")
+
+    if geo_type in ("state", "hhs"):
+        # Plotly draws the states itself; HHS regions are drawn as their states
+        if geo_type == "hhs":
+            states = [
+                (state, name, value)
+                for geo_value, name, value in zip(
+                    best["geo_value"], names, best[column]
+                )
+                for state, region in hhs_region_by_state.items()
+                if region == geo_value
+            ]
+        else:
+            states = list(zip(best["geo_value"], names, best[column]))
+        trace = go.Choropleth(
+            locations=[state.upper() for state, _, _ in states],
+            locationmode="USA-states",
+            z=[value for _, _, value in states],
+            text=[name for _, name, _ in states],
+            **colors,
+        )
+    else:
+        boundaries = load_boundaries(geo_type)
+        if boundaries is None:
+            return None
+        trace = go.Choropleth(
+            geojson=boundaries,
+            locations=best["geo_value"],
+            z=best[column],
+            text=names,
+            **colors,
+        )
+    trace.update(
+        colorbar=dict(title=title),
+        hovertemplate="%{text}<br>" + title + ": %{z:.3~f}<extra></extra>",
+        marker_line_width=0.5,
+    )
+
+    fig = go.Figure(trace)
+    # Counties, HRRs and MSAs of a single state are zoomed in on
+    fig.update_geos(
+        scope="usa", fitbounds=False if geo_type in ("state", "hhs") else "locations"
+    )
+    fig.update_layout(
+        title=dict(text=title, x=0.5, xanchor="center"),
+        height=450,
+        margin=dict(l=0, r=0, t=50, b=0),
+    )
+    return fig
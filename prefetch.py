@@ -0,0 +1,269 @@
+"""
+Background cache warming and speculative prefetching of signal data.
+
+The cache warmer keeps the full date range of every signal in
+available_signals.names_to_sources fresh for the geo_types in CACHE_WARMER_GEO_TYPES
+(default: nation and state; states are fetched in bulk into the signal store). Every CACHE_WARMER_INTERVAL_SECONDS
+it fetches the current COVIDcast metadata and only refetches a series when its
+max_time/last_update has changed (or it was evicted from the cache). Requests made
+by users for any date range within a warmed series are answered from the cache.
+
+All requests are sent with PREFETCH priority, so they never delay requests made
+by users (see fetch_scheduler). The warmer spends API quota, so it is off unless
+CACHE_WARMER_ENABLED is set, and only the app starts it (start_cache_warmer), not
+every process importing this module.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from available_signals import names_to_sources
+from analysis_tools import (
+    fetch_covidcast_data,
+    fetch_covidcast_metadata,
+    fetch_flight,
+    is_data_cached,
+)
+from data_cache import SignalKey, signal_cache
+from signal_store import signal_store, partition_key
+from fetch_scheduler import PREFETCH
+from geo_codes import nation_to_display
+from instrumentation import register_metrics, span
+from utils import covidcast_metadata, to_epidate_range, to_epiweek_range
+
+CACHE_WARMER_ENABLED = os.environ.get(
+    "CACHE_WARMER_ENABLED", ""
+).strip().lower() in ("1", "true", "yes")
+
+# All states are warmed with a single bulk request per signal (see signal_store)
+WARM_GEO_VALUES = {
+    "nation": list(nation_to_display),
+    "state": ["*"],
+}
+
+# A selection must stay unchanged this long before its data is prefetched
+PREFETCH_SETTLE_SECONDS = float(os.environ.get("PREFETCH_SETTLE_SECONDS", 1.5))
+
+_prefetch_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="prefetch")
+_pending = set()
+_pending_lock = threading.Lock()
+_settling = {}  # session id -> threading.Timer of its latest selection
+
+
+def _to_epirange(init_date, final_date, time_type):
+    if time_type == "week":
+        return to_epiweek_range(init_date, final_date)
+    return to_epidate_range(init_date, final_date)
+
+
+def _metadata_row(metadata, source_and_signal, geo_type):
+    source, signal = source_and_signal
+    rows = metadata[
+        (metadata["data_source"] == source)
+        & (metadata["signal"] == signal)
+        & (metadata["geo_type"] == geo_type)
+    ]
+    return None if rows.empty else rows.iloc[0]
+
+
+class CacheWarmer:
+    def __init__(self, geo_values, interval):
+        self.geo_values = geo_values
+        self.interval = interval
+        self._versions = {}  # SignalKey -> (max_time, last_update) of the cached data
+        self._stop = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.refreshed = 0
+        self.up_to_date = 0
+        self.errors = 0
+
+    def start(self):
+        # Called by every session; only the first one starts the thread
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, daemon=True, name="cache-warmer"
+                )
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with span("prefetch.warm_cache"):
+                    self.warm_once()
+            except Exception as e:
+                self.errors += 1
+                print(f"Cache warming failed: {str(e)}")
+            self._stop.wait(self.interval)
+
+    def warm_once(self):
+        try:
+            metadata = fetch_covidcast_metadata()
+        except Exception as e:
+            # Fall back to the bundled metadata; data will still be kept warm,
+            # but may be refetched less promptly when new data arrives
+            print(f"Using bundled metadata for cache warming: {str(e)}")
+            metadata = covidcast_metadata
+
+        for source_and_signal in names_to_sources.values():
+            for geo_type, geo_values in self.geo_values.items():
+                row = _metadata_row(metadata, source_and_signal, geo_type)
+                if row is None:
+                    continue
+                for geo_value in geo_values:
+                    if self._stop.is_set():
+                        return
+                    self._warm(source_and_signal, geo_type, geo_value, row)
+
+    def _warm(self, source_and_signal, geo_type, geo_value, row):
+        init_date, final_date = _to_epirange(
+            _as_date(row["min_time"]), _as_date(row["max_time"]), row["time_type"]
+        )
+        key = SignalKey(
+            *source_and_signal,
+            geo_type,
+            geo_value,
+            row["time_type"],
+            init_date,
+            final_date,
+            None,
+        )
+        version = (str(row["max_time"]), str(row["last_update"]))
+        if self._versions.get(key) == version and is_data_cached(key):
+            self.up_to_date += 1
+            return
+
+        # New data has arrived: drop outdated copies of this series first
+        if geo_value == "*":
+            signal_store.invalidate(partition_key(key))
+        else:
+            signal_cache.invalidate(
+                lambda other: other.as_of is None
+                and other._replace(init_date=None, final_date=None)
+                == key._replace(init_date=None, final_date=None)
+            )
+        try:
+            fetch_covidcast_data(
+                geo_type,
+                geo_value,
+                source_and_signal,
+                init_date,
+                final_date,
+                row["time_type"],
+                priority=PREFETCH,
+            )
+        except Exception as e:
+            self.errors += 1
+            print(f"Could not warm {key}: {str(e)}")
+            return
+        self._versions[key] = version
+        self.refreshed += 1
+
+    def stats(self):
+        return {
+            "series": len(self._versions),
+            "refreshed": self.refreshed,
+            "up_to_date": self.up_to_date,
+            "errors": self.errors,
+        }
+
+
+def _as_date(value):
+    # Metadata from the API has dates; the bundled CSV has ISO strings
+    return value if isinstance(value, date) else date.fromisoformat(str(value))
+
+
+def prefetch_in_background(
+    geo_type, geo_value, source_and_signal, init_date, final_date, time_type
+):
+    """
+    Speculatively fetch a signal the user is likely to request next.
+
+    Returns immediately; the data lands in the signal cache, where a later request
+    (or one made while the prefetch is still running) picks it up.
+    """
+    key = SignalKey(
+        *source_and_signal, geo_type, geo_value, time_type, init_date, final_date, None
+    )
+    with _pending_lock:
+        if key in _pending or fetch_flight.in_flight(key) or is_data_cached(key):
+            return
+        _pending.add(key)
+
+    def prefetch():
+        try:
+            fetch_covidcast_data(
+                geo_type,
+                geo_value,
+                source_and_signal,
+                init_date,
+                final_date,
+                time_type,
+                priority=PREFETCH,
+            )
+        except Exception as e:
+            # The user's own request will report the error if it happens again
+            print(f"Speculative prefetch of {key} failed: {str(e)}")
+        finally:
+            with _pending_lock:
+                _pending.discard(key)
+
+    _prefetch_executor.submit(prefetch)
+
+
+def prefetch_when_settled(*args, **kwargs):
+    """
+    prefetch_in_background, once the session has not changed its selection for
+    PREFETCH_SETTLE_SECONDS.
+
+    Each call replaces the session's previous one, so a user moving through
+    several signals or regions only prefetches the one they stop at.
+    """
+    ctx = get_script_run_ctx(suppress_warning=True)
+    session_id = ctx.session_id if ctx is not None else None
+
+    def settled():
+        with _pending_lock:
+            if _settling.get(session_id) is not timer:
+                return
+            del _settling[session_id]
+        prefetch_in_background(*args, **kwargs)
+
+    timer = threading.Timer(PREFETCH_SETTLE_SECONDS, settled)
+    timer.daemon = True
+    with _pending_lock:
+        previous = _settling.get(session_id)
+        if previous is not None:
+            previous.cancel()
+        _settling[session_id] = timer
+    timer.start()
+
+
+def _warm_geo_values():
+    geo_types = os.environ.get("CACHE_WARMER_GEO_TYPES", "nation,state").split(",")
+    return {
+        geo_type.strip(): WARM_GEO_VALUES[geo_type.strip()]
+        for geo_type in geo_types
+        if geo_type.strip() in WARM_GEO_VALUES
+    }
+
+
+cache_warmer = CacheWarmer(
+    _warm_geo_values(),
+    interval=float(os.environ.get("CACHE_WARMER_INTERVAL_SECONDS", 3600)),
+)
+register_metrics("cache_warmer", cache_warmer.stats)
+
+
+def start_cache_warmer():
+    """Start the cache warmer in this process if CACHE_WARMER_ENABLED is set."""
+    if CACHE_WARMER_ENABLED:
+        cache_warmer.start()
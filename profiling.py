@@ -0,0 +1,442 @@
+"""
+Per-rerun profiling of Streamlit pages.
+
+Profiling is enabled for every session with the PROFILE_RERUNS environment
+variable, or, if PROFILE_RERUNS_ALLOW_QUERY is set, for a session with the
+`?profile=...` URL query parameter (off by default, as any visitor could otherwise
+load the server and fill its disk). Supported values are "cprofile" (or "1") for
+deterministic profiling and "sample" for a low-overhead sampling profiler. Each
+rerun is written to PROFILE_DIR (default: "profiles") as a raw profile plus a text
+report with an inline flame summary and the share of time spent inside rpy2 calls
+(i.e. in R). Only the newest PROFILE_MAX_FILES files are kept.
+
+Fragment reruns (see profiled_fragment) are profiled on their own. Work handed to
+worker threads wrapped with `profiled` (fetch chunks, the fetch scheduler, lag
+sweeps) is included while a profile is active: the sampler samples those threads
+alongside the page's, and cProfile profiles each call and merges it into the
+profiles still active when it returns. Worker threads are shared by all sessions,
+so their samples can include work for other sessions.
+
+Usage in a page script:
+
+    start_rerun_profile(__file__)
+
+    @st.fragment
+    @profiled_fragment(__file__)
+    def section():
+        ...
+
+    ...  # page body
+    finish_rerun_profile()
+"""
+
+import cProfile
+import functools
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+PROFILE_QUERY_PARAM = "profile"
+SESSION_STATE_KEY = "_active_rerun_profile"
+SAMPLE_INTERVAL_S = 0.005
+FLAME_MIN_FRACTION = 0.01
+FLAME_MAX_DEPTH = 25
+BAR_WIDTH = 30
+# Profiles of reruns that never finished (e.g. the session was closed) stop
+# covering worker threads after this long
+STALE_PROFILE_S = 600
+
+
+_prune_lock = threading.Lock()
+
+# Profiles running in this process (as stored in session state), and the worker
+# threads currently running a `profiled` call: thread id -> thread name
+_lock = threading.Lock()
+_active = []
+_busy_threads = {}
+
+
+def profiled(func):
+    """
+    Wrap `func`, run on a worker thread, so that active profiles include its time.
+
+    Without an active profile the call costs a single check.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _active:
+            return func(*args, **kwargs)
+        thread_id = threading.get_ident()
+        with _lock:
+            _active[:] = [
+                active
+                for active in _active
+                if time.perf_counter() - active["start"] < STALE_PROFILE_S
+            ]
+            _busy_threads[thread_id] = threading.current_thread().name
+            cprofile = any(active["mode"] == "cprofile" for active in _active)
+        profiler = cProfile.Profile() if cprofile else None
+        try:
+            if profiler is None:
+                return func(*args, **kwargs)
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            with _lock:
+                _busy_threads.pop(thread_id, None)
+                if profiler is not None:
+                    for active in _active:
+                        if active["mode"] == "cprofile":
+                            active["thread_profiles"].append(profiler)
+
+    return wrapper
+
+
+def _profile_dir():
+    return os.environ.get("PROFILE_DIR", "profiles")
+
+
+def _query_allowed():
+    return os.environ.get("PROFILE_RERUNS_ALLOW_QUERY", "").strip().lower() in (
+        "1",
+        "true",
+        "yes",
+    )
+
+
+def requested_profile_mode():
+    """Return "cprofile", "sample" or None depending on the query parameter/environment."""
+    mode = os.environ.get("PROFILE_RERUNS", "")
+    if _query_allowed():
+        mode = st.query_params.get(PROFILE_QUERY_PARAM) or mode
+    mode = mode.strip().lower()
+    if mode in ("", "0", "false", "off"):
+        return None
+    return "sample" if mode == "sample" else "cprofile"
+
+
+def _is_rpy2_file(filename):
+    return f"{os.sep}rpy2{os.sep}" in filename
+
+
+def _bar(fraction):
+    return "█" * max(1, round(fraction * BAR_WIDTH))
+
+
+class _SamplingProfiler:
+    """
+    Samples the Python stack of one thread, and of the worker threads running
+    `profiled` calls, at a fixed interval.
+
+    Samples are stored as collapsed stacks ("outer;...;inner" -> count), the format
+    used by flamegraph.pl and speedscope; worker thread stacks start with the
+    thread's name. Sampling stops by itself once the page script is no longer on
+    the stack, so reruns ended by st.stop() are still captured.
+    """
+
+    def __init__(self, thread_id, script_path, interval=SAMPLE_INTERVAL_S):
+        self.thread_id = thread_id
+        self.script_path = os.path.abspath(script_path)
+        self.interval = interval
+        self.stacks = Counter()
+        self.rpy2_samples = 0
+        self.worker_samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, daemon=True, name="rerun-sampler"
+        )
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _sample(self, frame):
+        stack = []
+        in_script = in_rpy2 = False
+        while frame is not None:
+            code = frame.f_code
+            filename = os.path.abspath(code.co_filename)
+            in_script = in_script or filename == self.script_path
+            in_rpy2 = in_rpy2 or _is_rpy2_file(filename)
+            stack.append(
+                f"{code.co_name} ({os.path.basename(filename)}:{code.co_firstlineno})"
+            )
+            frame = frame.f_back
+        return stack[::-1], in_script, in_rpy2
+
+    def _run(self):
+        seen_script = False
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            stack, in_script, in_rpy2 = self._sample(frames.get(self.thread_id))
+            if in_script:
+                seen_script = True
+                self.stacks[";".join(stack)] += 1
+                self.rpy2_samples += in_rpy2
+            elif seen_script:
+                break
+            with _lock:
+                busy = list(_busy_threads.items())
+            for thread_id, name in busy:
+                stack, _, in_rpy2 = self._sample(frames.get(thread_id))
+                if stack:
+                    self.stacks[";".join([f"[{name}]"] + stack)] += 1
+                    self.worker_samples += 1
+                    self.rpy2_samples += in_rpy2
+
+    def write(self, base_path):
+        with open(f"{base_path}.collapsed", "w") as f:
+            for stack, count in self.stacks.items():
+                f.write(f"{stack} {count}\n")
+
+        total = sum(self.stacks.values())
+        lines = [
+            f"Samples: {total} (every {self.interval * 1000:.0f} ms, "
+            f"~{total * self.interval:.2f} s), "
+            f"{self.worker_samples} of them on worker threads",
+            _rpy2_line(self.rpy2_samples * self.interval, total * self.interval),
+            "",
+            "Flame summary (share of samples):",
+        ]
+        lines += _flame_from_stacks(self.stacks, total)
+        _write_report(f"{base_path}.txt", lines)
+
+
+def _rpy2_line(rpy2_time, total_time):
+    share = rpy2_time / total_time if total_time else 0.0
+    return f"Time inside rpy2 calls (R): {rpy2_time:.3f} s ({share:.0%})"
+
+
+def _flame_from_stacks(stacks, total):
+    tree = {}
+    for stack, count in stacks.items():
+        node = tree
+        for frame in stack.split(";"):
+            entry = node.setdefault(frame, [0, {}])
+            entry[0] += count
+            node = entry[1]
+
+    lines = []
+
+    def walk(node, depth):
+        for frame, (count, children) in sorted(
+            node.items(), key=lambda item: -item[1][0]
+        ):
+            fraction = count / total
+            if fraction < FLAME_MIN_FRACTION or depth > FLAME_MAX_DEPTH:
+                continue
+            lines.append(f"{'  ' * depth}{_bar(fraction)} {fraction:5.1%} {frame}")
+            walk(children, depth + 1)
+
+    walk(tree, 0)
+    return lines
+
+
+def _flame_from_pstats(stats):
+    """Approximate a call tree from cProfile's caller -> callee cumulative times."""
+    entries = stats.stats
+    children = {}
+    for func, (_, _, _, _, callers) in entries.items():
+        for caller, caller_stats in callers.items():
+            children.setdefault(caller, []).append((func, caller_stats[3]))
+
+    # The profiler is enabled part-way through the page script, so top-level calls
+    # have no recorded caller: their share is the time not attributed to any caller.
+    roots = []
+    for func, (_, _, _, cumtime, callers) in entries.items():
+        residual = cumtime - sum(caller_stats[3] for caller_stats in callers.values())
+        if residual > 1e-6:
+            roots.append((func, residual))
+    total = sum(residual for _, residual in roots)
+    lines = []
+
+    def walk(func, cumtime, depth, path):
+        fraction = cumtime / total if total else 0.0
+        if fraction < FLAME_MIN_FRACTION or depth > FLAME_MAX_DEPTH or func in path:
+            return
+        label = pstats.func_std_string(func)
+        lines.append(f"{'  ' * depth}{_bar(fraction)} {cumtime:8.3f}s {label}")
+        # cProfile only keeps per-caller totals, so a function reached along several
+        # paths has its callees' times split in proportion to this path's share
+        func_cumtime = entries[func][3]
+        scale = cumtime / func_cumtime if func_cumtime else 0.0
+        for child, child_time in sorted(children.get(func, []), key=lambda c: -c[1]):
+            walk(child, child_time * scale, depth + 1, path | {func})
+
+    for root, residual in sorted(roots, key=lambda r: -r[1]):
+        walk(root, residual, 0, frozenset())
+    return lines
+
+
+def _rpy2_time_from_pstats(stats):
+    # Cumulative time of rpy2 entry points, i.e. rpy2 functions called from outside rpy2
+    total = 0.0
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        if not _is_rpy2_file(func[0]):
+            continue
+        total += sum(
+            caller_stats[3]
+            for caller, caller_stats in callers.items()
+            if not _is_rpy2_file(caller[0])
+        )
+    return total
+
+
+def _write_report(path, lines):
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def _write_cprofile(profiler, thread_profiles, base_path, elapsed):
+    top = io.StringIO()
+    stats = pstats.Stats(profiler, stream=top)
+    for thread_profile in thread_profiles:
+        stats.add(thread_profile)
+    stats.dump_stats(f"{base_path}.prof")
+    stats.sort_stats("cumulative").print_stats(30)
+
+    lines = [
+        f"Wall time: {elapsed:.3f} s",
+        f"Worker thread calls included: {len(thread_profiles)}",
+        _rpy2_line(_rpy2_time_from_pstats(stats), elapsed),
+        "",
+        "Flame summary (cumulative time along the call tree):",
+    ]
+    lines += _flame_from_pstats(stats)
+    lines += ["", "Top functions by cumulative time:", top.getvalue()]
+    _write_report(f"{base_path}.txt", lines)
+
+
+def _prune_profiles():
+    """Remove the oldest files in PROFILE_DIR beyond PROFILE_MAX_FILES."""
+    max_files = int(os.environ.get("PROFILE_MAX_FILES", 200))
+    with _prune_lock:
+        files = []
+        with os.scandir(_profile_dir()) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    try:
+                        files.append((entry.stat().st_mtime, entry.path))
+                    except OSError:
+                        pass
+        for _, path in sorted(files)[: max(0, len(files) - max_files)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _deactivate(active):
+    with _lock:
+        if active in _active:
+            _active.remove(active)
+
+
+def start_rerun_profile(script_path, name=None):
+    """
+    Start profiling the current rerun of the page at `script_path`, if requested.
+
+    Args:
+        script_path: The page script (__file__)
+        name: Added to the page name in the file name, e.g. for a fragment
+    """
+    # A rerun that ended with st.stop() never reached finish_rerun_profile().
+    # The sampler stopped by itself and can still be written, but a cProfile
+    # profile now also covers the idle time since then, so it is discarded.
+    stale = st.session_state.get(SESSION_STATE_KEY)
+    if stale is not None and stale["mode"] == "cprofile":
+        stale["profiler"].disable()
+        _deactivate(stale)
+        del st.session_state[SESSION_STATE_KEY]
+    finish_rerun_profile(notify=False)
+
+    mode = requested_profile_mode()
+    if mode is None:
+        return
+
+    if mode == "sample":
+        profiler = _SamplingProfiler(threading.get_ident(), script_path)
+        profiler.start()
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    page = os.path.splitext(os.path.basename(script_path))[0]
+    active = st.session_state[SESSION_STATE_KEY] = {
+        "mode": mode,
+        "profiler": profiler,
+        "thread_profiles": [],
+        "page": f"{page}.{name}" if name else page,
+        "start": time.perf_counter(),
+    }
+    with _lock:
+        _active.append(active)
+
+
+def finish_rerun_profile(notify=True):
+    """Stop the profile started for this rerun and write it to PROFILE_DIR."""
+    active = st.session_state.pop(SESSION_STATE_KEY, None)
+    if active is None:
+        return None
+
+    profiler = active["profiler"]
+    elapsed = time.perf_counter() - active["start"]
+    if active["mode"] == "sample":
+        profiler.stop()
+    else:
+        profiler.disable()
+    _deactivate(active)
+
+    os.makedirs(_profile_dir(), exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    base_path = os.path.join(
+        _profile_dir(), f"{active['page']}_{timestamp}_{active['mode']}"
+    )
+    if active["mode"] == "sample":
+        profiler.write(base_path)
+    else:
+        _write_cprofile(profiler, active["thread_profiles"], base_path, elapsed)
+    _prune_profiles()
+
+    if notify:
+        st.toast(f"Profile of this rerun ({elapsed:.2f} s) written to {base_path}.txt")
+    return base_path
+
+
+def profiled_fragment(script_path):
+    """
+    Decorator profiling the reruns of a fragment on their own (place it below
+    @st.fragment). When the fragment runs as part of a full rerun, that rerun's
+    profile covers it.
+    """
+
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # Only a fragment rerun on its own, not one nested in another fragment
+            ctx = get_script_run_ctx(suppress_warning=True)
+            if ctx is None or ctx.current_fragment_id not in (
+                ctx.fragment_ids_this_run or ()
+            ):
+                return func(*args, **kwargs)
+            start_rerun_profile(script_path, name=func.__name__)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                finish_rerun_profile()
+
+        return wrapper
+
+    return decorate
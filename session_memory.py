@@ -0,0 +1,239 @@
+"""
+Per-session memory accounting and eviction of large session_state objects.
+
+Fetched frames, figures and results that a page keeps in st.session_state are
+stored through `session_memory.put` and read back with `session_memory.get`. Every
+object is accounted to its session. Once the objects of all sessions take more than
+SESSION_MEMORY_MAX_BYTES, or a session has not used them for SESSION_IDLE_SECONDS,
+the objects of the sessions that were active least recently are evicted (never
+those of the session making the request):
+
+- objects stored with a `reload` callable (e.g. fetched signals) are dropped and
+  reloaded, e.g. refetched from the signal cache or the API, on their next `get`;
+- other objects are pickled to SESSION_SPILL_DIR and read back on their next `get`.
+
+Results of the page pipelines (see pipeline) are held by its cache anyway, so
+they are neither counted nor evicted. Figures are sized from their trace data
+rather than by serializing them.
+
+Evictions happen as sessions use their objects, so there is no background thread.
+Objects and spill files go away with their session (or with `pop`). Usage is shown
+in the Performance panel as the "session_memory" metrics.
+"""
+
+import os
+import pickle
+import tempfile
+import threading
+import time
+import weakref
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from data_cache import frame_nbytes
+from instrumentation import TRACE_DATA_ATTRIBUTES, register_metrics, span
+from pipeline import is_result
+
+
+def _figure_nbytes(fig):
+    # About 8 bytes per value of the trace data, which dominates a figure
+    return 8 * sum(
+        np.size(value)
+        for trace in fig.data
+        for value in (getattr(trace, name, None) for name in TRACE_DATA_ATTRIBUTES)
+        if value is not None
+    )
+
+
+def _nbytes(value):
+    if is_result(value):
+        return 0
+    if isinstance(value, pd.DataFrame):
+        return frame_nbytes(value)
+    if isinstance(value, tuple):
+        return sum(_nbytes(item) for item in value)
+    if isinstance(value, go.Figure):
+        return _figure_nbytes(value)
+    return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def _session_id():
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else None
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class _Entry:
+    """What st.session_state holds for an object stored through SessionMemory."""
+
+    def __init__(self, value, nbytes, reload):
+        self.value = value
+        self.nbytes = nbytes
+        self.reload = reload
+        self.spill_path = None
+        self.resident = True
+
+
+class _Session:
+    def __init__(self):
+        self.last_active = time.time()
+        self.entries = weakref.WeakValueDictionary()  # name -> _Entry
+
+
+class SessionMemory:
+    def __init__(self, max_bytes, idle_seconds, spill_dir):
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self.spill_dir = spill_dir
+        self._sessions = {}  # session id -> _Session
+        self._lock = threading.RLock()
+        self.evictions = 0
+        self.spills = 0
+        self.spill_reads = 0
+        self.reloads = 0
+
+    def _touch(self, session_id):
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = self._sessions[session_id] = _Session()
+        session.last_active = time.time()
+        return session
+
+    def put(self, name, value, reload=None):
+        """
+        Store `value` in st.session_state under `name` and account for it.
+
+        Args:
+            name: Key in st.session_state
+            value: The object (a DataFrame, a figure or anything picklable)
+            reload: Optional callable (without arguments) recreating `value`, used
+                instead of spilling it to disk once it is evicted
+
+        Returns:
+            The value, for chaining
+        """
+        entry = _Entry(value, _nbytes(value), reload)
+        st.session_state[name] = entry
+        session_id = _session_id()
+        with self._lock:
+            self._touch(session_id).entries[name] = entry
+        self._enforce(session_id)
+        return value
+
+    def get(self, name, default=None):
+        """Return the object stored under `name`, reloading it if it was evicted."""
+        entry = st.session_state.get(name)
+        if entry is None:
+            return default
+        if not isinstance(entry, _Entry):
+            return entry
+        session_id = _session_id()
+        with self._lock:
+            self._touch(session_id).entries[name] = entry
+            value = entry.value if entry.resident else None
+            spill_path = entry.spill_path
+        if value is None:
+            # Reloads can go to the API, so they do not hold up other sessions
+            if spill_path is not None:
+                with span("session_memory.spill_read"):
+                    with open(spill_path, "rb") as f:
+                        value = pickle.load(f)
+            else:
+                with span("session_memory.reload"):
+                    value = entry.reload()
+            with self._lock:
+                if spill_path is not None:
+                    self.spill_reads += 1
+                else:
+                    self.reloads += 1
+                entry.value = value
+                entry.resident = True
+        self._enforce(session_id)
+        return value
+
+    def pop(self, name):
+        """Remove the object stored under `name` (its spill file goes with it)."""
+        st.session_state.pop(name, None)
+
+    def _evict(self, entry):
+        if entry.reload is None and entry.spill_path is None:
+            # Spilled once; the value is never modified, so the file stays valid
+            os.makedirs(self.spill_dir, exist_ok=True)
+            fd, path = tempfile.mkstemp(suffix=".pkl", dir=self.spill_dir)
+            with span("session_memory.spill"):
+                with os.fdopen(fd, "wb") as f:
+                    pickle.dump(entry.value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            entry.spill_path = path
+            weakref.finalize(entry, _remove_file, path)
+            self.spills += 1
+        entry.value = None
+        entry.resident = False
+        self.evictions += 1
+
+    def _enforce(self, current_session_id):
+        now = time.time()
+        with self._lock:
+            candidates = []
+            total = 0
+            for session_id, session in list(self._sessions.items()):
+                entries = list(session.entries.values())
+                if not entries:
+                    # The session (and its session_state) is gone
+                    del self._sessions[session_id]
+                    continue
+                for entry in entries:
+                    # Entries of no size (pipeline results) would free nothing
+                    if entry.resident and entry.nbytes:
+                        total += entry.nbytes
+                        if session_id != current_session_id:
+                            candidates.append((session.last_active, entry))
+            # Least recently active sessions first
+            candidates.sort(key=lambda candidate: candidate[0])
+            for last_active, entry in candidates:
+                if total <= self.max_bytes and now - last_active < self.idle_seconds:
+                    break
+                self._evict(entry)
+                total -= entry.nbytes
+
+    def stats(self):
+        with self._lock:
+            resident = {}
+            spilled_bytes = 0
+            objects = 0
+            for session_id, session in self._sessions.items():
+                for entry in session.entries.values():
+                    objects += 1
+                    if entry.resident:
+                        resident[session_id] = resident.get(session_id, 0) + entry.nbytes
+                    elif entry.spill_path is not None:
+                        spilled_bytes += entry.nbytes
+            return {
+                "sessions": len(self._sessions),
+                "objects": objects,
+                "resident_bytes": sum(resident.values()),
+                "largest_session_bytes": max(resident.values(), default=0),
+                "spilled_bytes": spilled_bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "spills": self.spills,
+                "spill_reads": self.spill_reads,
+                "reloads": self.reloads,
+            }
+
+
+session_memory = SessionMemory(
+    max_bytes=int(os.environ.get("SESSION_MEMORY_MAX_BYTES", 1024 * 1024 * 1024)),
+    idle_seconds=float(os.environ.get("SESSION_IDLE_SECONDS", 1800)),
+    spill_dir=os.environ.get("SESSION_SPILL_DIR", "spill"),
+)
+register_metrics("session_memory", session_memory.stats)
@@ -0,0 +1,249 @@
+"""
+Columnar store for bulk fetches of all geo_values of a geo_type (geo_value="*").
+
+Each partition holds one source/signal/geo_type (and time_type/as_of) sorted by
+geo_value and time_value, with an index of the rows belonging to each geo_value,
+so single-region requests are answered by slicing instead of a new API request.
+
+Partitions are kept in memory under a byte budget (SIGNAL_STORE_MAX_BYTES, least
+recently used first) and, if SIGNAL_STORE_DIR is set, persisted as Parquet files in
+a source=/signal=/geo_type=/... directory layout so they survive restarts.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from data_cache import frame_nbytes, share_frame
+from instrumentation import register_metrics
+
+PartitionKey = namedtuple(
+    "PartitionKey", ["source", "signal", "geo_type", "time_type", "as_of"]
+)
+
+
+def partition_key(signal_key):
+    """The partition holding the data requested by a SignalKey."""
+    return PartitionKey(
+        signal_key.source,
+        signal_key.signal,
+        signal_key.geo_type,
+        signal_key.time_type,
+        signal_key.as_of,
+    )
+
+
+def _is_sorted(df, times):
+    geo_values = df["geo_value"].to_numpy()
+    later = (geo_values[1:] > geo_values[:-1]) | (
+        (geo_values[1:] == geo_values[:-1]) & (times[1:] >= times[:-1])
+    )
+    return bool(later.all()) and df.index.equals(pd.RangeIndex(len(df)))
+
+
+class _Partition:
+    def __init__(self, df, init, final, expires_at):
+        times = pd.to_datetime(df["time_value"]).to_numpy()
+        # Bulk fetches arrive sorted (see analysis_tools._fetch_bulk); keep such a
+        # frame, which may be memory-mapped from the Arrow plane, instead of a copy
+        if not _is_sorted(df, times):
+            df = df.sort_values(["geo_value", "time_value"], kind="stable")
+            df = df.reset_index(drop=True)
+            times = pd.to_datetime(df["time_value"]).to_numpy()
+        self.frame = share_frame(df)
+        self.init = init
+        self.final = final
+        self.expires_at = expires_at
+        self.times = times
+
+        # geo_value -> (first row, last row + 1)
+        geo_values = self.frame["geo_value"].to_numpy()
+        self.index = {}
+        if len(geo_values):
+            boundaries = np.flatnonzero(geo_values[1:] != geo_values[:-1]) + 1
+            starts = np.concatenate([[0], boundaries])
+            stops = np.concatenate([boundaries, [len(geo_values)]])
+            for start, stop in zip(starts, stops):
+                self.index[geo_values[start]] = (int(start), int(stop))
+        self.nbytes = frame_nbytes(self.frame) + self.times.nbytes
+
+    def expired(self):
+        return self.expires_at is not None and self.expires_at < time.time()
+
+    def covers(self, init, final):
+        return self.init <= init and final <= self.final
+
+    def _time_bounds(self, start, stop, init, final):
+        times = self.times[start:stop]
+        lo = np.searchsorted(times, np.datetime64(init), side="left")
+        hi = np.searchsorted(times, np.datetime64(final), side="right")
+        return start + lo, start + hi
+
+    def slice(self, geo_value, init, final):
+        start, stop = self.index.get(geo_value, (0, 0))
+        lo, hi = self._time_bounds(start, stop, init, final)
+        return self.frame.iloc[lo:hi]
+
+    def select(self, init, final):
+        mask = (self.times >= np.datetime64(init)) & (self.times <= np.datetime64(final))
+        return self.frame[mask]
+
+
+class SignalStore:
+    def __init__(self, max_bytes, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self._partitions = OrderedDict()  # PartitionKey -> _Partition
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.slices = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _path(self, key):
+        as_of = "latest" if key.as_of is None else key.as_of
+        return os.path.join(
+            self.directory,
+            f"source={key.source}",
+            f"signal={key.signal}",
+            f"geo_type={key.geo_type}",
+            f"time_type={key.time_type}",
+            f"as_of={as_of}",
+        )
+
+    def _remove(self, key):
+        partition = self._partitions.pop(key)
+        self.current_bytes -= partition.nbytes
+
+    def _insert(self, key, partition):
+        if key in self._partitions:
+            self._remove(key)
+        if partition.nbytes > self.max_bytes:
+            return
+        while self._partitions and self.current_bytes + partition.nbytes > self.max_bytes:
+            self._remove(next(iter(self._partitions)))
+            self.evictions += 1
+        self._partitions[key] = partition
+        self.current_bytes += partition.nbytes
+
+    def put(self, key, df, init, final, ttl=None):
+        """Store the bulk fetch `df` covering the dates init..final for partition `key`."""
+        expires_at = None if not ttl else time.time() + ttl
+        partition = _Partition(df, init, final, expires_at)
+        with self._lock:
+            self._insert(key, partition)
+        if self.directory:
+            self._persist(key, partition)
+
+    def _persist(self, key, partition):
+        path = self._path(key)
+        os.makedirs(path, exist_ok=True)
+        tmp_path = os.path.join(path, f"data.parquet.{os.getpid()}.tmp")
+        partition.frame.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, os.path.join(path, "data.parquet"))
+        with open(os.path.join(path, "range.json"), "w") as f:
+            json.dump(
+                {
+                    "init": partition.init.isoformat(),
+                    "final": partition.final.isoformat(),
+                    "expires_at": partition.expires_at,
+                },
+                f,
+            )
+
+    def _load(self, key):
+        path = self._path(key)
+        try:
+            with open(os.path.join(path, "range.json")) as f:
+                meta = json.load(f)
+            df = pd.read_parquet(os.path.join(path, "data.parquet"))
+        except (OSError, ValueError):
+            return None
+        # Parquet stores dates as date32; restore the datetime.date values
+        # produced by fetch_covidcast_data
+        df["time_value"] = pd.to_datetime(df["time_value"]).dt.date
+        partition = _Partition(
+            df,
+            date.fromisoformat(meta["init"]),
+            date.fromisoformat(meta["final"]),
+            meta["expires_at"],
+        )
+        return None if partition.expired() else partition
+
+    def _get(self, key):
+        with self._lock:
+            partition = self._partitions.get(key)
+            if partition is not None and partition.expired():
+                self._remove(key)
+                partition = None
+            if partition is not None:
+                self._partitions.move_to_end(key)
+                return partition
+        if not self.directory:
+            return None
+        partition = self._load(key)
+        if partition is not None:
+            with self._lock:
+                self._insert(key, partition)
+        return partition
+
+    def covers(self, key, init, final):
+        partition = self._get(key)
+        return partition is not None and partition.covers(init, final)
+
+    def slice(self, key, geo_value, init, final):
+        """
+        Rows for one geo_value between init and final (dates), or None if the
+        partition does not hold that date range. The result may be empty if the
+        geo_value has no data; it shares the partition's read-only data.
+        """
+        partition = self._get(key)
+        if partition is None or not partition.covers(init, final):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.slices += 1
+        return partition.slice(geo_value, init, final).copy(deep=False)
+
+    def select(self, key, init, final):
+        """All geo_values between init and final (dates), or None if not held."""
+        partition = self._get(key)
+        if partition is None or not partition.covers(init, final):
+            return None
+        return partition.select(init, final)
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._partitions:
+                self._remove(key)
+        if self.directory:
+            try:
+                os.remove(os.path.join(self._path(key), "range.json"))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "partitions": len(self._partitions),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "slices": self.slices,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+signal_store = SignalStore(
+    max_bytes=int(os.environ.get("SIGNAL_STORE_MAX_BYTES", 1024**3)),
+    directory=os.environ.get("SIGNAL_STORE_DIR") or None,
+)
+
+register_metrics("signal_store", signal_store.stats)
@@ -0,0 +1,152 @@
+"""
+Single-flight coalescing of identical concurrent calls.
+
+The first caller for a given key runs the work; callers arriving with the same key
+while it is in flight wait for it and share its result. If the work fails with an
+Exception, that exception is raised in every waiting caller. Other BaseExceptions
+(Streamlit's rerun and stop requests, KeyboardInterrupt) belong to the caller that
+ran the work: they are raised there only, and the waiting callers run the work
+again themselves.
+
+The work must not draw any Streamlit UI, since the callers may be different
+sessions. Progress is shared as plain values instead (see do_with_progress): every
+caller reports it to its own callback, in its own thread.
+"""
+
+import threading
+
+from instrumentation import register_metrics
+
+# Interval at which waiting callers check for new progress
+_PROGRESS_POLL_S = 0.1
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.abandoned = False
+        self.progress = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}  # key -> _Call
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+        self.failures = 0
+        self.retries = 0
+        register_metrics(f"single_flight_{name}", self.stats)
+
+    def do(self, key, func):
+        """Run `func()` unless an identical call (same `key`) is already running."""
+        return self._do(key, lambda report: func(), None)
+
+    def do_with_progress(self, key, func, on_progress=None):
+        """
+        Like do, for work reporting its progress.
+
+        Args:
+            key: Identity of the call
+            func: Callable taking a progress callable, which it calls with any
+                arguments (e.g. the fraction done)
+            on_progress: Optional callable receiving the progress of the call, also
+                when it is run by another caller
+        """
+        return self._do(key, func, on_progress)
+
+    def _do(self, key, func, on_progress):
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                is_leader = call is None
+                if is_leader:
+                    call = self._calls[key] = _Call()
+                    self.leaders += 1
+                else:
+                    call.waiters += 1
+                    self.followers += 1
+
+            if is_leader:
+                return self._lead(key, call, func, on_progress)
+            self._follow(call, on_progress)
+            if call.abandoned:
+                with self._lock:
+                    self.retries += 1
+                continue
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+    def _lead(self, key, call, func, on_progress):
+        def report(*args):
+            call.progress = args
+            if on_progress is not None:
+                on_progress(*args)
+
+        try:
+            call.result = func(report)
+            return call.result
+        except Exception as e:
+            call.error = e
+            with self._lock:
+                self.failures += 1
+            raise
+        except BaseException:
+            call.abandoned = True
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _follow(self, call, on_progress):
+        if on_progress is None:
+            call.done.wait()
+            return
+        reported = None
+        while not call.done.wait(_PROGRESS_POLL_S):
+            progress = call.progress
+            if progress is not None and progress is not reported:
+                on_progress(*progress)
+                reported = progress
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._calls
+
+    def find(self, predicate):
+        """Return the key of an in-flight call satisfying `predicate`, or None."""
+        with self._lock:
+            return next((key for key in self._calls if predicate(key)), None)
+
+    def wait(self, key):
+        """
+        Wait for the in-flight call for `key` and return its result (raising its error).
+
+        Returns None if no such call is running or it was abandoned.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                return None
+            call.waiters += 1
+            self.followers += 1
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "leaders": self.leaders,
+                "followers": self.followers,
+                "failures": self.failures,
+                "retries": self.retries,
+            }
@@ -1,15 +1,24 @@
 import pandas as pd
-from datetime import date
+from datetime import date, datetime
 from epiweeks import Week
 from rpy2.robjects import r
 from rpy2.robjects import conversion, default_converter
 import os
+import threading
+from fetch_scheduler import set_api_key_quota
+
+# The embedded R interpreter is not thread-safe, but sessions, the fetch scheduler
+# and the chunked fetches all call it from their own threads: every use of rpy2 in
+# the process (sourcing scripts, R calls and conversions) holds this lock
+r_lock = threading.RLock()
 
 covidcast_metadata = pd.read_csv("csv_data/covidcast_metadata.csv")
 
 
-def load_data(source, signal):
-    df = pd.read_csv(f"{source}_{signal}.csv")
+def load_data(source, signal, directory="."):
+    df = pd.read_csv(
+        os.path.join(directory, f"{source}_{signal}.csv"), dtype={"geo_value": str}
+    )
     return df
 
 
@@ -111,16 +120,40 @@ def to_epiweek_range(dt1: date, dt2: date) -> tuple[int, int]:
     )
 
 
+def epirange_to_dates(init, final, time_type):
+    """
+    Inverse of to_epidate_range/to_epiweek_range: the first and last calendar day
+    covered by an epirange of YYYYMMDD dates or YYYYWW epiweeks.
+    """
+    if time_type == "day":
+        return (
+            datetime.strptime(str(init), "%Y%m%d").date(),
+            datetime.strptime(str(final), "%Y%m%d").date(),
+        )
+    if time_type == "week":
+        start_week = Week(int(str(init)[:4]), int(str(init)[4:]))
+        end_week = Week(int(str(final)[:4]), int(str(final)[4:]))
+        return start_week.startdate(), end_week.enddate()
+    raise ValueError(f"Invalid time_type: {time_type}")
+
+
 def save_the_api_key(api_key):
     # Set environment variable in R
-    r(f'Sys.setenv(DELPHI_EPIDATA_KEY="{api_key}")')
+    with r_lock:
+        r(f'Sys.setenv(DELPHI_EPIDATA_KEY="{api_key}")')
 
     # Load into R session
     r_script_path = os.path.abspath("R_analysis_tools.r")
-    with conversion.localconverter(default_converter):
+    with r_lock, conversion.localconverter(default_converter):
         try:
             r.source(r_script_path)
             api_key_r = r.get_the_api_key()
-            return str(api_key_r[0])  # Convert R StrVector to Python string
+            api_key_r = str(api_key_r[0])  # Convert R StrVector to Python string
         except Exception as e:
             print(f"Error: {str(e)}")
+            return None
+
+    # The key is global to the R session, so all requests now get the higher quota
+    if api_key_r == api_key:
+        set_api_key_quota(has_api_key=True)
+    return api_key_r
@@ -0,0 +1,150 @@
+"""
+Worker process for the job queue (see job_queue.py).
+
+Run it next to the app, from the repository root:
+
+    python worker.py --concurrency 2
+
+Each of the `--concurrency` processes (default: JOB_WORKER_CONCURRENCY, or 1) runs
+its own R session and takes one job at a time from the queue.
+"""
+
+import argparse
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+from job_queue import (
+    claim_job,
+    complete_job,
+    fail_job,
+    heartbeat,
+)
+
+HEARTBEAT_INTERVAL_S = 10
+
+
+class JobStopped(Exception):
+    """The job was cancelled, or was queued again and handed to another worker."""
+
+
+def run_lag_sweep_job(key, worker, frames, params, partial):
+    from analysis_tools import iter_lag_correlations
+    from lag_sweep import lag_order
+
+    # Resume a sweep that was cancelled or lost its worker (JSON keys are strings)
+    results = {int(lag): cor for lag, cor in (partial or {}).items()}
+    lags = lag_order(params["max_lag"])
+    missing = [lag for lag in lags if lag not in results]
+    for lag, cor in iter_lag_correlations(
+        frames["df1"], frames["df2"], params["cor_by"], missing, params["method"]
+    ):
+        results[lag] = cor
+        if not heartbeat(key, worker, len(results) / len(lags), partial=results):
+            raise JobStopped()
+    return results
+
+
+def run_epi_predict_job(key, worker, frames, params, partial):
+    from analysis_tools import run_epi_predict
+
+    def on_progress(progress, step):
+        if not heartbeat(key, worker, progress):
+            raise JobStopped()
+
+    return run_epi_predict(
+        frames["df"],
+        params["predictors"],
+        params["predicted"],
+        params["forecaster_type"],
+        params["prediction_length"],
+        on_progress=on_progress,
+    )
+
+
+JOB_HANDLERS = {
+    "lag_sweep": run_lag_sweep_job,
+    "epi_predict": run_epi_predict_job,
+}
+
+
+def _keep_alive(key, worker, stop):
+    # Single R calls can take longer than the heartbeat timeout; once the job is
+    # no longer ours, the handler notices at its next progress heartbeat
+    while not stop.wait(HEARTBEAT_INTERVAL_S):
+        if not heartbeat(key, worker):
+            return
+
+
+def run_job(job):
+    key, worker = job["key"], job["worker"]
+    stop = threading.Event()
+    keep_alive = threading.Thread(
+        target=_keep_alive, args=(key, worker, stop), daemon=True
+    )
+    keep_alive.start()
+    try:
+        handler = JOB_HANDLERS[job["kind"]]
+        result = handler(key, worker, job["frames"], job["params"], job["partial"])
+    except JobStopped:
+        print(f"Job {key} cancelled or taken over by another worker")
+        return
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        if not fail_job(key, worker, e):
+            print(f"Job {key} cancelled or taken over by another worker")
+        return
+    finally:
+        stop.set()
+    if not complete_job(key, worker, result):
+        # Another worker owns the job now: its result is the one that counts
+        print(f"Job {key} cancelled or taken over by another worker")
+
+
+def work(name, poll_interval):
+    print(f"Worker {name} started")
+    while True:
+        job = claim_job(name)
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+        print(f"Worker {name} running {job['kind']} job {job['key']}")
+        run_job(job)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run jobs from the job queue.")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=int(os.environ.get("JOB_WORKER_CONCURRENCY", 1)),
+        help="Number of jobs run in parallel (one process each)",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=1.0,
+        help="Seconds between checks for new jobs when the queue is empty",
+    )
+    args = parser.parse_args()
+
+    # Each process gets a fresh interpreter (and R session) rather than a fork
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(
+            target=work,
+            args=(f"{socket.gethostname()}-{os.getpid()}-{i}", args.poll_interval),
+            daemon=True,
+        )
+        for i in range(args.concurrency)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()